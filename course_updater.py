@@ -8,15 +8,32 @@
 # it will drop and create a scene at some stage...
 #####
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields, asdict
+import copy
 import csv
+import functools
 from datetime import datetime
 import subprocess
+import asyncio
+import selectors
 import time
 import os
 import fcntl
 import re
+import secrets
+import socket
+import socketserver
+import sqlite3
+import threading
+import unicodedata
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from contextlib import contextmanager
 import getpass
+import gzip
+import hashlib
 from splinter import Browser
 import keyring
 import json
@@ -27,10 +44,30 @@ import colorama
 # -----------------------------------------------------------------------------
 
 
+def slotted (cls):
+	"""
+	class decorator that gives a dataclass __slots__, so instances take less memory and are quicker to create
+	(as dataclass(slots=True) does on python 3.10+)
+	"""
+	names    = tuple(f.name for f in fields(cls))
+	cls_dict = dict(cls.__dict__)
+
+	# defaults are part of the generated __init__, so these class attributes can go
+	for name in names + ('__dict__', '__weakref__'):
+		cls_dict.pop(name, None)
+
+	cls_dict['__slots__'] = names
+
+	return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+@slotted
 @dataclass
 class User:
 	"""
 	Class that holds user data
+	Once complete (e.g., after import), `freeze` turns list fields into tuples.
+	All users held by a TeamsUpdater are frozen, so their list fields are read-only: make a new User to change these.
 	"""
 	id                       : str
 	name                     : str
@@ -50,12 +87,34 @@ class User:
 	tech_stream_coordinators : list = field(default_factory=list)
 	tech_stream_mentors      : list = field(default_factory=list)
 
+	# fields that hold lists, and fields with strings that many users have in common
+	list_fields   = ('class_ids', 'groups', 'groupings', 'classes', 'course_coordinators', 'project_coordinators', 'project_mentors', 'tech_stream_coordinators', 'tech_stream_mentors')
+	shared_fields = ('course_code', 'project', 'project_team', 'tech_stream')
+
 	def __getitem__ (self, key):
 		return getattr(self, key)
 
 	def __str__ (self):
 		return f'{self.name} ({self.id})'
 
+	def freeze (self, pool=None):
+		"""
+		turns list fields into tuples, which take less memory
+		with a pool (any dict, used for a batch of users), equal strings and tuples are shared between users
+		"""
+		if (pool is None):
+			pool = {}
+
+		for name in self.list_fields:
+			values = tuple(pool.setdefault(v, v) for v in getattr(self, name))
+			setattr(self, name, pool.setdefault(values, values))
+
+		for name in self.shared_fields:
+			value = getattr(self, name)
+			setattr(self, name, pool.setdefault(value, value))
+
+		return self
+
 	def role (self):
 		return ('Member', 'Owner')[self.owner]
 
@@ -69,6 +128,624 @@ class User:
 		return (grouping in self.groupings)
 
 
+@dataclass(frozen=True)
+class ClassInfo:
+	"""
+	Class that holds data on a single class (lecture, lab, tutorial, ...) of a course stream, as compiled by CourseModel
+	"""
+	class_id     : int
+	name         : str   = ''
+	stream       : str   = None
+	kind         : str   = 'class'  # 'main'|'lecture'|'lab'|'class', where 'main' is the main class id of a stream
+	description  : str   = ''
+	instructors  : tuple = ()
+	channel      : str   = ''  # ''|'public'|'private'
+	channel_name : str   = ''
+
+	@classmethod
+	def from_dict (cls, clas, stream=None):
+		""" compiles a class dict as found in project_list / streams_data """
+		# lectures are not included as classes, and labs are handled separately from regular classes
+		kind = 'class'
+		if (clas['name'].find('LE') != -1):
+			kind = 'lecture'
+		elif (clas['name'].find('LAB') != -1):
+			kind = 'lab'
+
+		return cls(
+			clas['class_id'],
+			clas['name'],
+			stream,
+			kind,
+			clas.get('description', ''),
+			tuple(clas.get('instructors', [])),
+			clas.get('channel', ''),
+			f'{clas["name"]}_{clas["class_id"]}'
+		)
+
+	def label (self):
+		return f'{self.channel_name}  [ {self.description} ]'
+
+
+class CourseModel:
+	"""
+	Read-only view of a project_list or streams_data dict ({stream name: {'classes': [...], ...}}), compiled once
+	so classes can be found by class id rather than by searching all streams.
+
+	Classes are kept in the original order. A class id listed in several streams maps to all of these, up to and
+	including the first stream that has it as its 'main_class_id'.
+	"""
+	def __init__ (self, streams_data):
+		self.streams     = {}  # stream name -> tuple of ClassInfo
+		self.class_index = {}  # class id -> tuple of ClassInfo
+
+		class_index = {}
+		main_found  = set()
+
+		for stream_name, stream_data in streams_data.items():
+			self.streams[stream_name] = self.compile_classes(stream_data, stream_name)
+
+			if ('main_class_id' in stream_data):
+				main_id = stream_data['main_class_id']
+
+				if (main_id not in main_found):
+					class_index.setdefault(main_id, []).append( ClassInfo(main_id, stream=stream_name, kind='main') )
+					main_found.add(main_id)
+
+			for info in self.streams[stream_name]:
+				if (info.class_id not in main_found):
+					class_index.setdefault(info.class_id, []).append(info)
+
+		self.class_index = {class_id: tuple(infos) for class_id, infos in class_index.items()}
+
+	@staticmethod
+	def compile_classes (stream_data, stream_name=None):
+		""" returns a tuple of ClassInfo for the classes of a single stream """
+		return tuple(ClassInfo.from_dict(clas, stream_name) for clas in stream_data.get('classes', []))
+
+	def find_classes (self, class_id):
+		""" returns all ClassInfo for a class id (or an empty tuple) """
+		return self.class_index.get(class_id, ())
+
+
+@dataclass(frozen=True)
+class GroupInfo:
+	"""
+	Class that holds what a single Moodle group name tells about its members, as parsed by GroupParser
+	Fields that are None don't apply to the group.
+	"""
+	class_id           : int = None
+	project            : str = None
+	project_mentor     : str = None  # normalised name, see TeamsUpdater._name_key
+	tech_stream        : str = None
+	tech_stream_mentor : str = None  # idem
+	project_team       : str = None
+
+
+class GroupParser:
+	"""
+	Classifies Moodle group names by running them past a list of rules, each of which may fill in some fields of a GroupInfo.
+	Groups are typically shared by many students, so each distinct group name is only parsed once.
+
+	  tech_streams : parse technical stream groups as well
+	"""
+	# TODO generalise to allow other terms than 'Project', and 'Mentor' or allow 'Demonstrator' as well
+	project_pattern        = re.compile(r'Project Group - (?P<project>.+?)')  # include \(.+?\) at end to catch (Online|On Campus)
+	project_mentor_pattern = re.compile(r'Project (?P<project>.+?) (- ){0,1}Mentor (?P<mentor>.+?)')
+	tech_mentor_pattern    = re.compile(r'Technical Stream (?P<stream>.+?) (- ){0,1}Mentor (?P<mentor>.+?)')
+
+	def __init__ (self, tech_streams=False):
+		self.rules = [self._class_id_rule, self._project_rule, self._project_mentor_rule]
+		if (tech_streams):
+			self.rules += [self._tech_stream_rule, self._tech_stream_mentor_rule]
+		self.rules.append(self._project_team_rule)
+
+		self.cache = {}
+
+	def parse (self, group):
+		""" returns a GroupInfo for a group name """
+		info = self.cache.get(group)
+
+		if (info is None):
+			fields = {}
+			for rule in self.rules:
+				fields.update(rule(group))
+
+			info = GroupInfo(**fields)
+			self.cache[group] = info
+
+		return info
+
+	# --- class ID-based matching below (fits most courses)
+
+	def _class_id_rule (self, group):
+		if (group.isdigit()):
+			return {'class_id': int(group)}
+		return {}
+
+	# --- group name based matching below (fits ENGG1000 best)
+
+	def _project_rule (self, group):
+		if (group.find('Project Group - ') != -1):
+			return {'project': self.project_pattern.sub(r'\g<project>', group)}
+		return {}
+
+	def _project_mentor_rule (self, group):
+		if (group.find('Project') != -1 and group.find('Mentor') != -1):
+			return {'project_mentor': TeamsUpdater._name_key( self.project_mentor_pattern.sub(r'\g<mentor>', group) )}
+		return {}
+
+	def _tech_stream_rule (self, group):
+		if (group.find('Technical Stream Group - ') != -1):
+			return {'tech_stream': group.replace('Technical Stream Group - ','').replace(' (OnCampus)','').replace(' (Online)','')}
+		return {}
+
+	def _tech_stream_mentor_rule (self, group):
+		if (group.find('Technical Stream') != -1 and group.find('Mentor') != -1):
+			tmentor = self.tech_mentor_pattern.sub(r'\g<mentor>', group)
+
+			if (tmentor != '-'):
+				return {'tech_stream_mentor': TeamsUpdater._name_key(tmentor)}
+		return {}
+
+	# --- common matching continues below
+
+	def _project_team_rule (self, group):
+		if (group.lower().find('team') != -1 and group.lower().find('stream') == -1):
+			return {'project_team': group.replace('Project ','').replace('Student Teams - ','')}
+		return {}
+
+
+class UserQuery:
+	"""
+	Base class for predicates to find users with (see TeamsUpdater.find_users)
+	Queries can be combined with & (and), | (or) and ~ (not).
+	"""
+	def __and__ (self, other):
+		return And(self, other)
+
+	def __or__ (self, other):
+		return Or(self, other)
+
+	def __invert__ (self):
+		return Not(self)
+
+	def matches (self, user):
+		""" returns whether a single user matches """
+		raise NotImplementedError
+
+	def select (self, index):
+		""" returns matching users in a UserIndex as a bitset (an int with the bit of each user's position set) """
+		raise NotImplementedError
+
+
+class Match (UserQuery):
+	"""
+	Matches users on a single key, being 'group', 'grouping', 'class id', 'project', 'tech_stream', 'role' or any other User attribute
+	By default, string values match part of a group or grouping name, or part of any other value (ignoring case).
+	With exact=True, only the whole value matches.
+	"""
+	def __init__ (self, key, value, exact=False):
+		self.key   = key.lower() if (key.lower() in UserIndex.keys) else key
+		self.value = value
+		self.exact = exact or not isinstance(value, str)
+
+		if (not self.exact):
+			self.value_lower = value.lower()
+
+	@classmethod
+	def from_search (cls, search_key, search_value):
+		""" returns a Match for the search_key/search_value pairs that find_users has always supported """
+		if (isinstance(search_value, str) and search_key.lower() == 'group_exact'):
+			return cls('group', search_value, exact=True)
+		
+		return cls(search_key, search_value)
+
+	def __repr__ (self):
+		return f'Match({self.key!r}, {self.value!r}, exact={self.exact})'
+
+	def _test (self, value):
+		if (self.exact or not isinstance(value, str)):
+			return value == self.value
+		elif (self.key in UserIndex.list_keys):
+			# group names are matched case-sensitively
+			return self.value in value
+		else:
+			return value.lower().find(self.value_lower) != -1
+
+	def matches (self, user):
+		return any(self._test(v) for v in UserIndex.values(user, self.key))
+
+	def select (self, index):
+		if (self.key not in index.index):
+			return UserIndex.bitset(position for position, user in enumerate(index.users) if self.matches(user))
+
+		values = index.index[self.key]
+
+		if (self.exact):
+			return values.get(self.value, 0)
+
+		# check each distinct value rather than each user
+		result = 0
+		for value, bits in values.items():
+			if (self._test(value)):
+				result |= bits
+
+		return result
+
+
+class And (UserQuery):
+	def __init__ (self, *queries):
+		self.queries = queries
+
+	def __repr__ (self):
+		return f'And{self.queries!r}'
+
+	def matches (self, user):
+		return all(q.matches(user) for q in self.queries)
+
+	def select (self, index):
+		result = index.all
+
+		for q in self.queries:
+			result &= q.select(index)
+
+			if (not result):
+				break
+
+		return result
+
+
+class Or (UserQuery):
+	def __init__ (self, *queries):
+		self.queries = queries
+
+	def __repr__ (self):
+		return f'Or{self.queries!r}'
+
+	def matches (self, user):
+		return any(q.matches(user) for q in self.queries)
+
+	def select (self, index):
+		result = 0
+
+		for q in self.queries:
+			result |= q.select(index)
+
+		return result
+
+
+class Not (UserQuery):
+	def __init__ (self, query):
+		self.query = query
+
+	def __repr__ (self):
+		return f'Not({self.query!r})'
+
+	def matches (self, user):
+		return not self.query.matches(user)
+
+	def select (self, index):
+		return index.all & ~self.query.select(index)
+
+
+class UserDict (dict):
+	"""
+	A dict of users by id, which counts its changes in `version`, so an index over it (see UserIndex) knows when it's outdated
+	Changes to the users themselves aren't counted, but these are read-only once imported (see User.freeze).
+	"""
+	def __init__ (self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.version = 0
+
+	def __setitem__ (self, key, value):
+		super().__setitem__(key, value)
+		self.version += 1
+
+	def __delitem__ (self, key):
+		super().__delitem__(key)
+		self.version += 1
+
+	def __ior__ (self, other):
+		self.update(other)
+		return self
+
+	def pop (self, *args):
+		self.version += 1
+		return super().pop(*args)
+
+	def popitem (self):
+		self.version += 1
+		return super().popitem()
+
+	def setdefault (self, key, default=None):
+		self.version += 1
+		return super().setdefault(key, default)
+
+	def update (self, *args, **kwargs):
+		super().update(*args, **kwargs)
+		self.version += 1
+
+	def clear (self):
+		super().clear()
+		self.version += 1
+
+
+class UserIndex:
+	"""
+	Inverted indexes over a user list (or dict), so queries (see UserQuery) cost a few lookups rather than a full scan
+	Results keep the order of the list, and list each user once. Note that an index doesn't notice changes to users after it was built.
+
+	Each value (a group, class id, ...) maps to a bitset over user positions, so queries evaluate as bitwise and/or/not,
+	and counting the users in a roster, or in the overlap between two, hardly costs anything (see `count`).
+	"""
+	list_keys   = {'group': 'groups', 'grouping': 'groupings', 'class id': 'class_ids'}
+	scalar_keys = {'project': 'project', 'tech_stream': 'tech_stream', 'role': 'role'}
+	keys        = {**list_keys, **scalar_keys}
+
+	def __init__ (self, users):
+		if (isinstance(users, dict)):
+			users = users.values()
+
+		self.users = list(users)
+		self.all   = (1 << len(self.users)) - 1
+		self.index = {key: {} for key in self.keys}
+
+		# collect positions first, as building a large int bit by bit gets slow
+		positions = {key: {} for key in self.keys}
+		for position, user in enumerate(self.users):
+			for key in self.keys:
+				for value in self.values(user, key):
+					positions[key].setdefault(value, []).append(position)
+
+		for key in self.keys:
+			for value, value_positions in positions[key].items():
+				self.index[key][value] = self.bitset(value_positions, len(self.users))
+
+	@staticmethod
+	def bitset (positions, size=None):
+		""" returns an int with the bits at the given positions set """
+		positions = list(positions)
+		if (size is None):
+			size = max(positions, default=-1) + 1
+
+		bits = bytearray((size + 7) // 8)
+		for position in positions:
+			bits[position >> 3] |= 1 << (position & 7)
+
+		return int.from_bytes(bits, 'little')
+
+	@staticmethod
+	def positions (bits):
+		""" returns the positions of all set bits in a bitset, lowest first """
+		# going via a binary string is much quicker than shifting large ints
+		digits    = bin(bits)[:1:-1]  # reversed, so the lowest bit comes first
+		positions = []
+		position  = digits.find('1')
+
+		while (position != -1):
+			positions.append(position)
+			position = digits.find('1', position + 1)
+
+		return positions
+
+	@classmethod
+	def values (cls, user, key):
+		""" returns the values of a user for a key as a list """
+		if (key == 'role'):
+			return [user.role()]
+		elif (key in cls.list_keys):
+			return user[cls.list_keys[key]]
+		elif (key in cls.scalar_keys):
+			return [user[cls.scalar_keys[key]]]
+		else:
+			return [user[key]]
+
+	def find (self, query):
+		""" returns a list of users matching a query """
+		return [self.users[position] for position in self.positions(query.select(self))]
+
+	def count (self, query):
+		""" returns the number of users matching a query """
+		return bin(query.select(self)).count('1')
+
+
+class SQLiteUserStore:
+	"""
+	Keeps imported users (students and staff) in a SQLite database, in memory or on disk, so they can be queried with SQL.
+	Users of several courses can share a store, as all data is kept per course code.
+
+	A store is filled by `TeamsUpdater.import_user_list` when given as `TeamsUpdater(path, store=SQLiteUserStore())`,
+	after which `find_users` and `export_student_list` run as queries on it.
+	"""
+	schema = """
+		CREATE TABLE IF NOT EXISTS users (
+			course_code  TEXT    NOT NULL,
+			id           TEXT    NOT NULL,
+			staff        INTEGER NOT NULL,
+			position     INTEGER NOT NULL,
+			name         TEXT,
+			email        TEXT,
+			owner        INTEGER,
+			project      TEXT,
+			project_team TEXT,
+			tech_stream  TEXT,
+			PRIMARY KEY (course_code, staff, id)
+		);
+		CREATE TABLE IF NOT EXISTS user_groups (
+			course_code TEXT, user_id TEXT, staff INTEGER, kind TEXT, name TEXT, position INTEGER  -- kind: 'group'|'grouping'
+		);
+		CREATE TABLE IF NOT EXISTS user_classes (
+			course_code TEXT, user_id TEXT, staff INTEGER, class_id INTEGER, position INTEGER
+		);
+		CREATE TABLE IF NOT EXISTS user_class_labels (
+			course_code TEXT, user_id TEXT, staff INTEGER, label TEXT, position INTEGER
+		);
+		CREATE TABLE IF NOT EXISTS staff_relations (
+			course_code TEXT, user_id TEXT, relation TEXT, staff_id TEXT, position INTEGER
+		);
+		CREATE INDEX IF NOT EXISTS users_project     ON users (course_code, staff, project);
+		CREATE INDEX IF NOT EXISTS users_tech_stream ON users (course_code, staff, tech_stream);
+		CREATE INDEX IF NOT EXISTS groups_by_name    ON user_groups (course_code, staff, kind, name, user_id);
+		CREATE INDEX IF NOT EXISTS groups_by_user    ON user_groups (course_code, staff, user_id);
+		CREATE INDEX IF NOT EXISTS classes_by_id     ON user_classes (course_code, staff, class_id, user_id);
+		CREATE INDEX IF NOT EXISTS classes_by_user   ON user_classes (course_code, staff, user_id);
+		CREATE INDEX IF NOT EXISTS labels_by_user    ON user_class_labels (course_code, staff, user_id);
+		CREATE INDEX IF NOT EXISTS staff_by_user     ON staff_relations (course_code, user_id, relation);
+	"""
+
+	# User attributes that are columns of the users table
+	columns = ['id', 'name', 'email', 'owner', 'project', 'project_team', 'tech_stream', 'course_code']
+
+	# User attributes with lists of staff ids
+	relations = ['course_coordinators', 'project_coordinators', 'project_mentors', 'tech_stream_coordinators', 'tech_stream_mentors']
+
+	def __init__ (self, path=':memory:'):
+		self.path = path
+		self.lock = threading.Lock()
+		self.db   = sqlite3.connect(path, check_same_thread=False)
+		self.db.executescript(self.schema)
+
+	def add_users (self, course_code, users, staff=False):
+		""" stores users for a course, replacing any stored before (either students or staff) """
+		if (isinstance(users, dict)):
+			users = users.values()
+
+		with self.lock, self.db:
+			for table in ['users', 'user_groups', 'user_classes', 'user_class_labels']:
+				self.db.execute(f'DELETE FROM {table} WHERE course_code = ? AND staff = ?', (course_code, int(staff)))
+			if (not staff):
+				self.db.execute('DELETE FROM staff_relations WHERE course_code = ?', (course_code,))
+
+			for position, u in enumerate(users):
+				key = (course_code, u.id, int(staff))
+
+				self.db.execute(
+					'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					(course_code, u.id, int(staff), position, u.name, u.email, int(u.owner), u.project, u.project_team, u.tech_stream)
+				)
+				self.db.executemany('INSERT INTO user_groups VALUES (?, ?, ?, ?, ?, ?)',
+					[key + ('group', g, i) for i, g in enumerate(u.groups)] + [key + ('grouping', g, i) for i, g in enumerate(u.groupings)])
+				self.db.executemany('INSERT INTO user_classes VALUES (?, ?, ?, ?, ?)',
+					[key + (c, i) for i, c in enumerate(u.class_ids)])
+				self.db.executemany('INSERT INTO user_class_labels VALUES (?, ?, ?, ?, ?)',
+					[key + (c, i) for i, c in enumerate(u.classes)])
+
+				if (not staff):
+					self.db.executemany('INSERT INTO staff_relations VALUES (?, ?, ?, ?, ?)',
+						[(course_code, u.id, relation, staff_id, i) for relation in self.relations for i, staff_id in enumerate(u[relation])])
+
+	def _where (self, query):
+		""" returns an SQL condition on `users u` and its parameters for a UserQuery """
+		if (isinstance(query, (And, Or))):
+			parts  = [self._where(q) for q in query.queries]
+			joiner = (' OR ', ' AND ')[isinstance(query, And)]
+			return '(' + joiner.join(p[0] for p in parts) + ')', [param for p in parts for param in p[1]]
+		elif (isinstance(query, Not)):
+			sql, params = self._where(query.query)
+			return f'NOT {sql}', params
+		elif (not isinstance(query, Match)):
+			raise ValueError(f'Cannot query {query!r} in SQLiteUserStore')
+
+		if (query.exact):
+			condition, value = '{} = ?', query.value
+		elif (query.key in UserIndex.list_keys):
+			condition, value = 'instr({}, ?) > 0', query.value  # group names are matched case-sensitively
+		else:
+			condition, value = 'instr(lower({}), ?) > 0', query.value_lower
+
+		if (query.key in ['group', 'grouping']):
+			return ('EXISTS (SELECT 1 FROM user_groups g WHERE g.course_code = u.course_code AND g.staff = u.staff AND g.user_id = u.id AND g.kind = ? AND '
+				+ condition.format('g.name') + ')'), [query.key, value]
+		elif (query.key == 'class id'):
+			# class ids are numbers, which only equal numbers (as in Match), while SQLite would match '1234' or part of it
+			if (isinstance(query.value, str)):
+				return '0', []
+
+			return ('EXISTS (SELECT 1 FROM user_classes c WHERE c.course_code = u.course_code AND c.staff = u.staff AND c.user_id = u.id AND '
+				+ condition.format('c.class_id') + ')'), [value]
+		elif (query.key == 'role'):
+			owner = [int(role == 'Owner') for role in ['Member', 'Owner'] if query._test(role)]
+			return 'u.owner IN (' + ', '.join('?' * len(owner)) + ')', owner
+		elif (query.key in self.columns):
+			return condition.format(f'u.{query.key}'), [value]
+		else:
+			raise ValueError(f'Cannot query {query.key} in SQLiteUserStore')
+
+	def find (self, course_code, query, staff=False):
+		""" returns the ids of users matching a UserQuery, in the order they were added """
+		where, params = self._where(query)
+
+		with self.lock:
+			rows = self.db.execute(
+				f'SELECT u.id FROM users u WHERE u.course_code = ? AND u.staff = ? AND {where} ORDER BY u.position',
+				[course_code, int(staff)] + params
+			).fetchall()
+
+		return [row[0] for row in rows]
+
+	def get_users (self, course_code, staff=False, ids=None):
+		""" returns a dict of (newly created) User objects, for all users of a course or those with the given ids """
+		with self.lock:
+			rows   = self.db.execute('SELECT id, name, email, owner, project, project_team, tech_stream FROM users WHERE course_code = ? AND staff = ? ORDER BY position', (course_code, int(staff))).fetchall()
+			lists  = {}
+			for table, column in [('user_groups', "kind, name"), ('user_classes', "'class_ids', class_id"), ('user_class_labels', "'classes', label")]:
+				for user_id, attr, value in self.db.execute(f'SELECT user_id, {column} FROM {table} WHERE course_code = ? AND staff = ? ORDER BY user_id, position', (course_code, int(staff))):
+					lists.setdefault((user_id, attr), []).append(value)
+			for user_id, relation, staff_id in self.db.execute('SELECT user_id, relation, staff_id FROM staff_relations WHERE course_code = ? ORDER BY user_id, relation, position', (course_code,)):
+				lists.setdefault((user_id, relation), []).append(staff_id)
+
+		users = {}
+		pool  = {}
+		for user_id, name, email, owner, project, project_team, tech_stream in rows:
+			if (ids is not None and user_id not in ids):
+				continue
+
+			u = User(user_id, name, course_code, lists.get((user_id, 'class_ids'), []), lists.get((user_id, 'group'), []), lists.get((user_id, 'grouping'), []), email, bool(owner),
+				lists.get((user_id, 'classes'), []), project, project_team, tech_stream)
+			if (not staff):
+				for relation in self.relations:
+					setattr(u, relation, lists.get((user_id, relation), []))
+
+			users[user_id] = u.freeze(pool)
+
+		return users
+
+	def student_rows (self, course_code):
+		"""
+		returns the rows of a student list export (see `TeamsUpdater.export_student_list`) in a single query
+		each staff relation is given as (ids, names, emails), with unknown staff filled in as such
+		"""
+		relation_columns = []
+		for relation in self.relations:
+			for column, default in [("r.staff_id", "r.staff_id"), ("s.name", "'Unknown staff'"), ("s.email", "r.staff_id || '@unsw.edu.au'")]:
+				relation_columns.append(f"""
+					(SELECT ifnull(group_concat(value, '{(', ', ',')[column == 'r.staff_id']}'), '-') FROM (
+						SELECT ifnull({column}, {default}) AS value FROM staff_relations r
+						LEFT JOIN users s ON s.course_code = r.course_code AND s.staff = 1 AND s.id = r.staff_id
+						WHERE r.course_code = u.course_code AND r.user_id = u.id AND r.relation = '{relation}'
+						ORDER BY r.position))""")
+
+		with self.lock:
+			rows = self.db.execute(f"""
+				SELECT u.id, u.name, u.email, u.course_code, u.project, u.project_team, u.tech_stream,
+					(SELECT group_concat(class_id, ',') FROM (SELECT class_id FROM user_classes c WHERE c.course_code = u.course_code AND c.staff = 0 AND c.user_id = u.id ORDER BY c.position)),
+					(SELECT ifnull(group_concat(label, ','), '') FROM (SELECT label FROM user_class_labels l WHERE l.course_code = u.course_code AND l.staff = 0 AND l.user_id = u.id ORDER BY l.position)),
+					{','.join(relation_columns)}
+				FROM users u
+				WHERE u.course_code = ? AND u.staff = 0
+					AND EXISTS (SELECT 1 FROM user_classes c WHERE c.course_code = u.course_code AND c.staff = 0 AND c.user_id = u.id)
+				ORDER BY u.position""", (course_code,)).fetchall()
+
+		for row in rows:
+			staff = [tuple(row[9 + 3*i : 12 + 3*i]) for i in range(len(self.relations))]
+			yield dict(zip(['id', 'name', 'email', 'course_code', 'project', 'project_team', 'tech_stream', 'class_ids', 'classes'], row[:9]), staff=staff)
+
+	def close (self):
+		with self.lock:
+			self.db.close()
+
+
 class LoginData:
 	"""
 	very basic class that safely stores login data (handy for repeated use).
@@ -121,24 +798,30 @@ class Logger:
 		self.log_file = open('course_updater.log', 'a')
 		self.log_file.write('\n\n\n~~~ NEW LOG ~~~ ~~~ ~~~ ~~~')
 
+		# messages can come from several threads at once (see PowerShellPool), this keeps them from getting mixed up
+		self.lock = threading.Lock()
+
 	def log (self, message, level='INFO'):
 		full_message = f'{level} - {message}'
 
 		# add colour coding to terminal output
 		if (level == 'CONFIRM'):
-			print(f'{colorama.Style.BRIGHT}{colorama.Fore.GREEN}{full_message}{colorama.Style.RESET_ALL}')
+			terminal_message = f'{colorama.Style.BRIGHT}{colorama.Fore.GREEN}{full_message}{colorama.Style.RESET_ALL}'
 		elif (level == 'DEBUG'):
-			print(f'{colorama.Fore.BLUE}{full_message}{colorama.Style.RESET_ALL}')
+			terminal_message = f'{colorama.Fore.BLUE}{full_message}{colorama.Style.RESET_ALL}'
 		elif (level == 'WARNING'):
-			print(f'{colorama.Fore.MAGENTA}{full_message}{colorama.Style.RESET_ALL}')
+			terminal_message = f'{colorama.Fore.MAGENTA}{full_message}{colorama.Style.RESET_ALL}'
 		elif (level == 'ERROR'):
-			print(f'{colorama.Style.BRIGHT}{colorama.Back.RED}{colorama.Fore.WHITE}{full_message}{colorama.Style.RESET_ALL}')
+			terminal_message = f'{colorama.Style.BRIGHT}{colorama.Back.RED}{colorama.Fore.WHITE}{full_message}{colorama.Style.RESET_ALL}'
 		else:
-			print(full_message)
+			terminal_message = full_message
+
+		with self.lock:
+			print(terminal_message)
 
-		self.log_file.write(f'\n{datetime.now()} {full_message}')
-		# ensure it is written rightaway to avoid loss of log data upon a crash
-		self.log_file.flush()
+			self.log_file.write(f'\n{datetime.now()} {full_message}')
+			# ensure it is written rightaway to avoid loss of log data upon a crash
+			self.log_file.flush()
 
 	def info (self, message):
 		self.log(message)
@@ -183,6 +866,164 @@ class Notifier:
 # -----------------------------------------------------------------------------
 
 
+def redact_secrets (text):
+	""" hides any passwords (as sent to `ConvertTo-SecureString`) in a command or its output """
+	return re.sub(r'(ConvertTo-SecureString -String )"[^"]*"', r'\1"***"', text)
+
+
+class CommandTranscript:
+	"""
+	Keeps the last `size` commands and their output in memory, instead of writing a file for each command.
+	These are only written to disk (as one compressed file) on request via `dump`, or when a command fails.
+	Optionally, everything is also appended to a single log file, with buffered writes.
+
+	Pass it to PowerShellWrapper (or PowerShellPool) as `transcript`, where it replaces the debug logs.
+	Sessions of a pool can share one transcript. Passwords sent to `ConvertTo-SecureString` are not kept.
+	"""
+	def __init__ (self, size=200, dump_path='cmd_logs/transcript.txt.gz', log_path=None, dump_on_error=True):
+		self.entries       = deque(maxlen=size)  # oldest entries drop off once full
+		self.dump_path     = dump_path
+		self.dump_on_error = dump_on_error
+		self.lock          = threading.Lock()
+		self.log           = None
+
+		if (log_path is not None):
+			self.log = open(log_path, 'a', buffering=1024*1024)
+
+	def __enter__ (self):
+		""" enables the use of the `with` statement """
+		return self
+
+	def __exit__ (self, type, value, traceback):
+		""" so we can exit after using the `with` statement """
+		self.close()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raise the exception to be transparent
+
+	def add (self, name, count, command, output, errors=None):
+		""" adds a command and its output, which are written to disk right away if the command failed """
+		output = str(output)   # making sure this is always a string
+		failed = bool(errors) or output.find('Error occurred while executing') != -1
+		entry  = self._format(datetime.now(), name, count, redact_secrets(command), redact_secrets(output), errors)
+
+		with self.lock:
+			self.entries.append(entry)
+
+			if (self.log is not None):
+				self.log.write(entry)
+
+			if (failed and self.dump_on_error):
+				self._dump(self.dump_path)
+
+	def _format (self, moment, name, count, command, output, errors):
+		text = f'[{moment.isoformat(timespec="milliseconds")}] {name}#{count} COMMAND: {command}\n\n{output}\n'
+		if (errors):
+			text += 'ERRORS:\n' + '\n'.join(errors) + '\n'
+		return text + '---------------------------------------\n'
+
+	def _dump (self, path):
+		with gzip.open(path, 'wt', encoding='utf-8') as f:
+			f.writelines(self.entries)
+
+	def dump (self, path=None):
+		""" writes the commands in memory to a compressed file, returns its path """
+		path = path or self.dump_path
+
+		with self.lock:
+			self._dump(path)
+
+		return path
+
+	def close (self):
+		with self.lock:
+			if (self.log is not None):
+				self.log.close()
+				self.log = None
+
+
+class CommandTrace:
+	"""
+	Records commands and the raw output lines they produce (with timing) to a compact, gzipped trace file,
+	which ReplayPowerShellWrapper plays back later without powershell or Teams. This way, a real sync
+	can be benchmarked or checked again on real-shaped data.
+
+	Pass it to a PowerShellWrapper as `trace`, one trace per wrapper. Passwords sent to `ConvertTo-SecureString` are not recorded.
+	"""
+	token_placeholder = '~CU-TOKEN~'  # framed markers are unique per run, so they're stored as this instead
+
+	def __init__ (self, path):
+		self.path    = path
+		self.file    = gzip.open(path, 'wt', encoding='utf-8')
+		self.entry   = None
+		self.token   = None
+		self.started = 0
+
+	def write_header (self, framed=False, username=None):
+		""" the header holds what's needed to replay in the same way, written by the wrapper using this trace """
+		self.file.write(json.dumps({'framed': framed, 'username': username}) + '\n')
+
+	def __enter__ (self):
+		""" enables the use of the `with` statement """
+		return self
+
+	def __exit__ (self, type, value, traceback):
+		""" so we can exit after using the `with` statement """
+		self.close()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raise the exception to be transparent
+
+	def start (self, command, token=None):
+		""" starts recording the output of a new command """
+		self._write_entry()
+
+		self.entry   = {'c': redact_secrets(command), 'o': []}
+		self.token   = token
+		self.started = time.monotonic()
+
+	def add_line (self, o):
+		""" records a line of output (None if the process ended), with the time in ms since the command was sent """
+		if (self.entry is None):
+			return
+
+		if (o is not None):
+			o = redact_secrets(o)
+			if (self.token is not None):
+				o = o.replace(self.token, self.token_placeholder)
+
+		self.entry['o'].append([int((time.monotonic() - self.started) * 1000), o])
+
+	def _write_entry (self):
+		if (self.entry is not None):
+			self.file.write(json.dumps(self.entry, separators=(',', ':')) + '\n')
+			self.entry = None
+
+	def close (self):
+		if (self.file is not None):
+			self._write_entry()
+			self.file.close()
+			self.file = None
+
+	@staticmethod
+	def load (path):
+		""" reads a trace file, returns its header and a dict with the recorded outputs of each command (in order) """
+		entries = {}
+
+		with gzip.open(path, 'rt', encoding='utf-8') as f:
+			header = json.loads(f.readline())
+
+			for line in f:
+				entry = json.loads(line)
+				entries.setdefault(entry['c'], deque()).append(entry['o'])
+
+		return header, entries
+
+
 class PowerShellWrapper:
 	"""
 	this is what happens when you know python and think you'll just call
@@ -198,8 +1039,14 @@ class PowerShellWrapper:
 	
 	very simple, very likely not to work with most edge cases.
 	"""
-	def __init__ (self, lazy_start=False, debug=True, login_method=None, username=None, password=None):
+	# powershell shows this prompt whenever it is ready for the next command
+	prompt_regex = re.compile(r'PS .+?>\s{0,1}$')
+
+	def __init__ (self, lazy_start=False, debug=True, login_method=None, username=None, password=None, framed=False, name='', transcript=None, teams_module=None, trace=None):
 		self.latest_output      = ''
+		self.latest_errors      = []    # error lines of the last command (framed mode only)
+		self.latest_status      = None  # value of `$?` after the last command (framed mode only)
+		self.latest_exit_code   = None  # value of `$LASTEXITCODE` after the last command (framed mode only)
 		self.connected_to_teams = False
 		self.count              = 0
 		self.process            = None
@@ -207,10 +1054,28 @@ class PowerShellWrapper:
 		self.username           = username
 		self.password           = password
 		self.login_method       = login_method
+		self.selector           = None
+		self.buffer             = bytearray()  # raw bytes read from the process that don't form a full line yet
+		self.lines              = deque()      # decoded lines that are read but not yet handled
+		self.framed             = framed       # wrap commands in unique markers rather than waiting for the prompt
+		self.name               = name         # tells log files apart when running several wrappers (see PowerShellPool)
+		self.log_prefix         = f'cmd_logs/{self.name}_' if self.name else 'cmd_logs/'
+		self.ready_token        = None         # set while waiting for powershell to answer the readiness probe
+		self.ready_seen         = False
+		self.transcript         = transcript   # a CommandTranscript, which replaces the debug logs when given
+		self.teams_module       = teams_module # path of a MicrosoftTeams module to use instead of the installed one
+		self.trace              = trace        # a CommandTrace, which records all commands and output for replaying later
+
+		if (self.trace is not None):
+			self.trace.write_header(self.framed, self.username)
+
+		# a transcript takes over, rather than writing files for each command
+		if (self.transcript is not None):
+			self.debug_mode = False
 
 		if (self.debug_mode):
 			try:
-				self.log = open('cmd_logs/alog.txt', 'w')
+				self.log = open(f'{self.log_prefix}alog.txt', 'w')
 			except FileNotFoundError as e:
 				print('\nHINT: ensure the cmd_logs directory exists.\n')
 				raise  # bare re-raise so no losing stack trace
@@ -231,22 +1096,69 @@ class PowerShellWrapper:
 		else:
 			return False  # re-raises the exception on return to be transparent
 
-	def ensure_started (self):
+	def ensure_started (self, wait=True, modules=None):
+		"""
+		Starts powershell if it isn't running yet. Instead of waiting a set time for it to settle, a readiness
+		probe is sent and this returns as soon as powershell answers it.
+
+		With `wait=False`, this returns straight after starting so other work can continue while powershell
+		loads (and imports any `modules`, e.g. ['MicrosoftTeams']). The next command then waits for it to be ready.
+		"""
 		if (self.process is None):
 			self.process = subprocess.Popen(
 				['pwsh'],
 				stdin    = subprocess.PIPE,
 				stdout   = subprocess.PIPE,
-				stderr   = subprocess.STDOUT,
-				encoding = 'utf-8'
+				stderr   = subprocess.STDOUT
 			)
 			fcntl.fcntl(self.process.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
 
-			# run a few commands as a self test
-			time.sleep(5)
-			self.run_command('nothing - just letting it settle', False)
-			time.sleep(5)
-			self.run_command('Write-Output "check"')
+			# wake up as soon as output arrives, rather than polling the pipe
+			self.selector = selectors.DefaultSelector()
+			self.selector.register(self.process.stdout, selectors.EVENT_READ)
+
+			self.process.stdin.write(self._readiness_probe(modules).encode('utf-8'))
+			self.process.stdin.flush()
+
+		if (wait and self.ready_token is not None):
+			while (not self._handle_ready_line(self._readline())):
+				pass
+
+	def _readiness_probe (self, modules=None):
+		""" returns a command that imports any modules and then answers with a unique token once powershell is ready """
+		self.ready_token = f'~CU-READY~{secrets.token_hex(4)}~'
+		self.ready_seen  = False
+
+		modules = list(modules or [])
+		if (self.teams_module is not None):
+			# importing by path comes first, so the installed module won't be loaded when its commands are used
+			modules = [f"'{os.path.abspath(self.teams_module)}'"] + [m for m in modules if m != 'MicrosoftTeams']
+
+		commands = [f'Import-Module {m}' for m in modules]
+		commands.append(f"Write-Output '{self.ready_token}'")
+
+		return '; '.join(commands) + os.linesep
+
+	def _handle_ready_line (self, o):
+		""" handles a line of output while waiting for the readiness probe, returns True once powershell is ready """
+		if (o is None):
+			self.ready_token = None
+			return True  # process ended, nothing to wait for anymore
+
+		if (not self.ready_seen):
+			# anything before the answer (startup messages, echoed input) isn't relevant
+			self.ready_seen = (self._find_marker(o, self.ready_token) != -1)
+			ready           = self.ready_seen and self.framed
+		else:
+			# without framing, the prompt that follows needs to be read as well, or the next command takes it as its own
+			ready = (self.prompt_regex.match(o) is not None)
+
+		if (ready):
+			if (self.debug_mode):
+				self.log.write('\n~~~~ POWERSHELL READY ~~~~\n')
+			self.ready_token = None
+
+		return ready
 
 	def close (self):
 		# disconnect and confirm any prompts that may come our way
@@ -257,85 +1169,225 @@ class PowerShellWrapper:
 			self.process.stdin.close()
 			self.process.kill()
 
+		if (self.selector != None):
+			self.selector.close()
+
 		if (self.debug_mode):
 			self.log.close()
 
-	def run_command (self, command, do_run=True, delay=0.5, return_if_found=None, convert_json=False):
+	def _add_output (self, chunk):
 		"""
-		The shakily beating heart of this wrapper.
-		It takes a command and feeds that into the powershell process, parsing any output it generates.
-
-		This method returns whenever it re-encounters the command prompt, which is usually the signal that a command was processed.
-		Alternatively, passing a string to `return_if_found` will stop once that string is encountered in the process output.
-
-		Set `convert_json` to True when expecting output that can be parsed into JSON.
+		Splits raw output from the process into lines, ready to be picked up by `_readline`.
+		The prompt doesn't end with a linefeed, so an incomplete last line is only passed on if it looks like one.
 		"""
-		self.ensure_started()
+		self.buffer += chunk
+
+		start = 0
+		while True:
+			end = self.buffer.find(b'\n', start)
+			if (end == -1):
+				break
+			self.lines.append( self.buffer[start:end+1].decode('utf-8', errors='replace').replace('\r\n', '\n') )
+			start = end + 1
+		del self.buffer[:start]
+
+		if (len(self.buffer) > 0):
+			tail = self.buffer.decode('utf-8', errors='replace')
+			if (self.prompt_regex.match(tail) is not None):
+				self.lines.append(tail)
+				self.buffer.clear()
+
+	def _fill_lines (self):
+		"""
+		Waits until the process has output available and adds whatever arrived.
+		Returns False once the process has closed its output.
+		"""
+		self.selector.select()
 
+		try:
+			chunk = os.read(self.process.stdout.fileno(), 65536)
+		except BlockingIOError:
+			return True  # spurious wakeup, nothing to read after all
+
+		if (len(chunk) == 0):
+			return False
+
+		self._add_output(chunk)
+
+		return True
+
+	def _readline (self):
+		""" returns the next line of output, waiting for the process if needed (None if the process has ended) """
+		while (len(self.lines) == 0):
+			if (not self._fill_lines()):
+				return None
+
+		return self.lines.popleft()
+
+	def _frame_command (self, command):
+		"""
+		Wraps a command so powershell marks where its output begins and ends, using a token unique to this command.
+		Errors are passed on as separate marked lines, and the end marker carries `$?` and `$LASTEXITCODE`.
+		The command is dot-sourced so any variables it sets remain available to later commands.
+		"""
+		token = f'~CU{self.count}~{secrets.token_hex(4)}~'
+		error = f"ForEach-Object {{ '{token} ERROR ' + $_ }}"
+
+		framed_command = (
+			f"Write-Output '{token} BEGIN'; $global:CUStatus = $false; "
+			f"try {{ . {{ {command}; $global:CUStatus = $? }} 2>&1 | ForEach-Object {{ "
+				f"if ($_ -is [System.Management.Automation.ErrorRecord]) {{ ($_ | Out-String -Width 4096).Trim() -split '\\r?\\n' | {error} }} else {{ $_ }} "
+			f"}} | Out-String -Stream -Width 4096 }} "
+			f"catch {{ ($_ | Out-String -Width 4096).Trim() -split '\\r?\\n' | {error} }}; "
+			f"Write-Output ('{token} END ' + $global:CUStatus + ' ' + $LASTEXITCODE)"
+		)
+
+		return framed_command, token
+
+	def _prepare_command (self, command, do_run=True, return_if_found=None, convert_json=False, json_records=None):
+		"""
+		Does the final alterations to a command before it is sent, and returns that with a fresh reading
+		state for `_handle_line`. Shared with AsyncPowerShellWrapper, which only differs in how it sends and reads.
+		"""
 		self.count += 1
 
 		# check command and do final alterations
 		command = command
-		if (convert_json):
+		if (json_records is not None):
+			# one compact line of JSON per object, with only the properties we need, so each can be decoded on arrival
+			command += f" | ForEach-Object {{ $_ | Select-Object {','.join(json_records)} | ConvertTo-Json -Compress -Depth 2 }}"
+		elif (convert_json):
 			command += ' | ConvertTo-Json'  # generates output object in JSON format
 
-		# send command to process
-		if (do_run == True):
-			if (self.debug_mode):
-				print(f'\nCOMMAND: {command}')
-				print('---------------------------------------')
-			
-			self.process.stdin.write(command + os.linesep)  # line separator is needed to get it executed
-			self.process.stdin.flush()
+		command_sent = command
+		token        = None
+		if (self.framed):
+			command_sent, token = self._frame_command(command)
+
+			self.latest_errors    = []
+			self.latest_status    = None
+			self.latest_exit_code = None
+
+		if (do_run and self.debug_mode):
+			print(f'\nCOMMAND: {command}')
+			print('---------------------------------------')
+
+		state = {
+			'command'        : command,
+			'token'          : token,
+			'return_if_found': return_if_found,
+			'started'        : not self.framed,  # framed output only starts at the begin marker
+			'output'         : '',
+			'records'        : deque() if json_records is not None else None  # decoded records, see `json_records`
+		}
 
-		# READ OUTPUT -------------------
+		if (do_run and self.trace is not None):
+			self.trace.start(command, token)
 
-		output = ''
+		return command_sent + os.linesep, state  # line separator is needed to get it executed
 
-		if (do_run):
-			# give things some time to settle
-			time.sleep(delay)
+	@staticmethod
+	def _find_marker (o, marker):
+		""" returns where the text after a marker starts in a line of output (or -1), as it may follow a prompt on the same line """
+		match = re.search(rf'(?:^|> ){re.escape(marker)}', o)
+		return match.end() if (match is not None) else -1
 
-			while True:
-				try:
-					# read stdout line by line
-					# this makes it easier to pick up significant bits of data
-					o = self.process.stdout.readline()
-
-					if re.match('PS .+?>\s{0,1}$', o) is not None:
-						if (self.debug_mode):
-							self.log.write('\n~~~~ REGEX MATCH - BREAKING LOOP ~~~~\n')
-						break
-					elif (o == command or o == command + '\n'):  # linefeed is usually added
-						if (self.debug_mode):
-							self.log.write(f'\n~~~ skipping command line: {command} ~~~\n')
-						# pass  # no need to save this
-					else:
-						output += o
-						if (self.debug_mode):
-							print(o, end='')  # avoid double linefeeds when printing
-							
-							self.log.write(o)
-
-					# check for this after o is added to output
-					if (return_if_found is not None and o.find(return_if_found) != -1):
-						if (self.debug_mode):
-							self.log.write('\n~~~ found return string ~~~\n' )
-						break
-
-				except TypeError:  # raised when a NoneType shows up, effectively signalling an empty buffer
-					time.sleep(0.1)
-				except IOError:    # also signals an empty buffer
-					time.sleep(0.1)
+	def _handle_line (self, o, state):
+		"""
+		Handles one line of output (or None if the process ended), returns True once the command is done.
+
+		Without framing, the command is done once the prompt reappears.
+		In framed mode, anything before the begin marker of this command (echoed input, prompts,
+		leftovers from an earlier command) is skipped, and reading stops at its end marker.
+		Error lines are kept in `latest_errors` but also added to the output, as callers check for error messages there.
+		"""
+		command = state['command']
+
+		if (self.trace is not None):
+			self.trace.add_line(o)
+
+		if (o is None):
+			if (self.debug_mode):
+				self.log.write('\n~~~~ PROCESS ENDED - BREAKING LOOP ~~~~\n')
+			return True
+
+		if (self.framed):
+			marked = self._find_marker(o, f"{state['token']} ")
+
+			if (marked != -1):
+				kind, _, rest = o[marked:].rstrip('\n').partition(' ')
+
+				if (kind == 'BEGIN'):
+					state['started'] = True
+					return False
+				elif (not state['started']):
+					return False
+				elif (kind == 'END'):
+					status, _, exit_code = rest.partition(' ')
+					self.latest_status    = (status == 'True')
+					self.latest_exit_code = int(exit_code) if exit_code.strip().lstrip('-').isdigit() else None
+					if (self.debug_mode):
+						self.log.write(f'\n~~~~ END MARKER ({rest}) - BREAKING LOOP ~~~~\n')
+					return True
+				elif (kind == 'ERROR'):
+					self.latest_errors.append(rest)
+					o = rest + '\n'
+			elif (not state['started']):
+				return False
+
+			if (not self._add_record(o, state)):
+				state['output'] += o
+			if (self.debug_mode):
+				print(o, end='')  # avoid double linefeeds when printing
+
+				self.log.write(o)
+		elif (self.prompt_regex.match(o) is not None):
+			if (self.debug_mode):
+				self.log.write('\n~~~~ REGEX MATCH - BREAKING LOOP ~~~~\n')
+			return True
+		elif (o == command or o == command + '\n'):  # linefeed is usually added
+			if (self.debug_mode):
+				self.log.write(f'\n~~~ skipping command line: {command} ~~~\n')
+			# pass  # no need to save this
 		else:
-			# return early to avoid getting stuck in loop below (there's no real output anyway)
-			return output
+			if (not self._add_record(o, state)):
+				state['output'] += o
+			if (self.debug_mode):
+				print(o, end='')  # avoid double linefeeds when printing
+				
+				self.log.write(o)
+
+		# check for this after o is added to output
+		if (state['return_if_found'] is not None and o.find(state['return_if_found']) != -1):
+			if (self.debug_mode):
+				self.log.write('\n~~~ found return string ~~~\n' )
+			return True
 
+		return False
+
+	def _add_record (self, o, state):
+		""" decodes a line of output into a record when expecting `json_records`, returns True if it was one """
+		if (state['records'] is None or not o.startswith('{')):
+			return False
+
+		try:
+			state['records'].append(json.loads(o))
+		except json.decoder.JSONDecodeError:
+			return False
+
+		return True
+
+	def _finish_output (self, command, output, convert_json=False, records=None):
+		""" final parsing of the output of a command, before it is returned """
 		# if output is a oneliner - negates the need for more parsing for simple responses
 		if (re.match('^.+?\n', output)):
 			output = output.replace('\n','')
 		
-		if (convert_json):
+		if (records is not None):
+			# records were decoded already, any other output (like an error message) is only returned if there are none
+			if (len(records) > 0 or len(output.strip()) == 0):
+				output = list(records)
+		elif (convert_json):
 			if (len(output) > 0 and output.lower().find('error occurred while executing') == -1):
 				try:
 					output = json.loads(output)
@@ -345,114 +1397,1331 @@ class PowerShellWrapper:
 
 		self.latest_output = output
 
-		# log command and output data for debugging purposes
-		if (self.debug_mode):
-			with open(f'cmd_logs/cmd_{self.count}.txt','w') as f:
-				f.write(f'COMMAND: {command}\n\n')
-				f.write(str(output))   # making sure this is always a string
+		# log command and output data for debugging purposes
+		if (self.debug_mode):
+			with open(f'{self.log_prefix}cmd_{self.count}.txt','w') as f:
+				f.write(f'COMMAND: {command}\n\n')
+				f.write(str(output))   # making sure this is always a string
+
+		if (self.transcript is not None):
+			self.transcript.add(self.name, self.count, command, output, self.latest_errors)
+
+		return output
+
+	def run_command (self, command, do_run=True, delay=0.5, return_if_found=None, convert_json=False, json_records=None):
+		"""
+		The shakily beating heart of this wrapper.
+		It takes a command and feeds that into the powershell process, parsing any output it generates.
+
+		This method returns whenever it re-encounters the command prompt, which is usually the signal that a command was processed.
+		Alternatively, passing a string to `return_if_found` will stop once that string is encountered in the process output.
+
+		Set `convert_json` to True when expecting output that can be parsed into JSON.
+		For commands that return a list of objects, `json_records` (a list of property names) is faster:
+		each object is sent as one compact line with just those properties, and decoded as soon as it arrives.
+		A list of dicts is returned (or the output as usual if there are none, e.g. on errors). See also `iter_json_records`.
+
+		Output is read as soon as it arrives, so `delay` is no longer needed and only kept for compatibility.
+
+		In framed mode (see `_frame_command`), the command is wrapped in unique markers instead, so completion
+		doesn't rely on spotting the prompt. Errors are also available separately via `latest_errors`.
+		"""
+		self.ensure_started()
+
+		command_sent, state = self._prepare_command(command, do_run, return_if_found, convert_json, json_records)
+
+		if (do_run is False):
+			# return early to avoid getting stuck in loop below (there's no real output anyway)
+			return ''
+
+		# send command to process
+		self._send(command_sent, state)
+
+		# read stdout line by line, as soon as the process has output for us
+		#   this makes it easier to pick up significant bits of data
+		while (not self._handle_line(self._readline(), state)):
+			pass
+
+		return self._finish_output(state['command'], state['output'], convert_json, state['records'])
+
+	def _send (self, command_sent, state):
+		""" sends a prepared command to the process """
+		self.process.stdin.write(command_sent.encode('utf-8'))
+		self.process.stdin.flush()
+
+	def iter_json_records (self, command, properties):
+		"""
+		Like `run_command` with `json_records`, but yields each record as soon as it is read, so the full
+		output never needs to be held at once. Iterate through all records before running another command.
+		"""
+		self.ensure_started()
+
+		command_sent, state = self._prepare_command(command, json_records=properties)
+
+		self._send(command_sent, state)
+
+		done = False
+		while (not done):
+			done = self._handle_line(self._readline(), state)
+
+			while (len(state['records']) > 0):
+				yield state['records'].popleft()
+
+		self._finish_output(state['command'], state['output'])
+
+	def connect_to_teams (self):
+		"""
+		Running any commands from the MicrosoftTeams pwoershell module requires an active login
+		This method logs in automatically, either by just giving a popup or by attempting a fully
+		automatic login by hiding the Office365 login process via a headless browser connection.
+
+		TODO: automated seems broken in some cases at the moment... still opens browser tab that works.
+		"""
+		self.ensure_started()
+
+		if (self.connected_to_teams):
+			return True
+		else:
+			response = ''
+
+			if (self.login_method == None or self.login_method == 'popup' or self.login_method == 'default'):
+				# login via a browser window/popup - works but needs user input via browser
+				response = self.run_command('Connect-MicrosoftTeams')
+			else:
+				self._ask_login_details()
+
+				if (self.login_method == 'automated'):
+					# login via browser window but automate all actions
+					try:
+						b = Browser('firefox', headless=False, incognito=True)
+						b.visit('https://microsoft.com/devicelogin')
+
+						# begin connecting and get authentication code
+						response = self.run_command('Connect-MicrosoftTeams',
+							return_if_found='use a web browser to open the page https://microsoft.com/devicelogin and enter the code')
+
+						self._complete_device_login(b, response)
+
+						# continue the login process and fetch final response
+						response = self.run_command('just want to see more output', False, delay=3)
+						
+						b.quit()
+					except Exception as e:
+						print(e)
+				elif (self.login_method == 'credentials'):
+					# note: this procedure doesn't work because basic authentication uni tenant doesn't support the right sign-on protocols
+					#       would be cool though...
+
+					# first, setup a credential object based on login details
+					for command in self._credential_commands():
+						self.run_command(command)
+					
+					# use credentials to connect (avoids a user prompt)
+					response = self.run_command('Connect-MicrosoftTeams -Credential $Credential')
+			
+			return self._check_connection(response)
+
+	def _ask_login_details (self):
+		""" get username and password """
+		if (self.username is None):
+			self.username = input('Username: ')
+		if (self.username.find('@') == -1):
+			self.username += '@ad.unsw.edu.au'
+		
+		if (self.password is None):
+			self.password = getpass.getpass(prompt='Password: ')
+
+	def _complete_device_login (self, b, response):
+		""" fills in the devicelogin page with the authentication code shown in `response` and our login details """
+		regex = re.compile('.+enter the code ([a-zA-Z0-9]{9}) to authenticate.+')
+		r = regex.search(response)
+
+		authentication_code = r.groups()[0]
+		print(f'Using authorisation code: {authentication_code}')
+
+		# fill in authentication code in text field
+		b.fill('otc', authentication_code)
+		# click next
+		b.find_by_id('idSIButton9').click()
+		# wait for next page
+		time.sleep(3)
+
+		# assume we're on a clean slate login (no history or existing login)
+
+		# fill in username
+		b.fill('loginfmt', self.username)
+		b.find_by_id('idSIButton9').click()
+		# wait for next page
+		time.sleep(2)
+
+		# second up, password
+		b.fill('passwd', self.password)
+		b.find_by_id('idSIButton9').click()
+		time.sleep(4)
+
+		# check if we are now logged in
+		if (not b.is_text_present('You have signed in to the MS Teams Powershell Cmdlets application')):
+			print('WARNING: devicelogin may have failed')
+
+	def _credential_commands (self):
+		""" commands that setup a credential object based on login details """
+		return [
+			f'$User = "{self.username}"',
+			f'$PWord = ConvertTo-SecureString -String "{self.password}" -AsPlainText -Force',
+			'$Credential = New-Object -TypeName System.Management.Automation.PSCredential -ArgumentList $User, $PWord'
+		]
+
+	def _check_connection (self, response):
+		""" check for succesful connection """
+		if (response.find('Token Acquisition finished successfully. An access token was returned')):
+			self.connected_to_teams = True
+		elif (response.find('TenantId')):  # just some string that will show only if succesful
+			self.connected_to_teams = True
+
+		return self.connected_to_teams
+
+
+class AsyncPowerShellWrapper (PowerShellWrapper):
+	"""
+	asyncio version of the PowerShellWrapper, so waiting for powershell doesn't hold up other work
+	on the same event loop (other courses, reading from another team, etc.).
+
+	It works the same, except that its methods must be awaited and it's used as `async with`.
+	Commands sent to one wrapper still run one at a time, so use one wrapper per stream of work to overlap.
+	"""
+	def __init__ (self, debug=True, login_method=None, username=None, password=None, framed=False, name='', transcript=None, teams_module=None, trace=None):
+		super().__init__(lazy_start=True, debug=debug, login_method=login_method, username=username, password=password, framed=framed, name=name, transcript=transcript, teams_module=teams_module, trace=trace)
+
+		# created on first use, so it belongs to the event loop that is running by then
+		self.lock = None
+
+	def __enter__ (self):
+		raise TypeError('AsyncPowerShellWrapper must be used with `async with`')
+
+	async def __aenter__ (self):
+		""" enables the use of the `async with` statement """
+		return self
+
+	async def __aexit__ (self, type, value, traceback):
+		""" so we can exit after using the `async with` statement """
+		await self.close()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raises the exception on return to be transparent
+
+	async def ensure_started (self, wait=True, modules=None):
+		""" see `PowerShellWrapper.ensure_started` """
+		if (self.lock is None):
+			self.lock = asyncio.Lock()
+
+		async with self.lock:
+			if (self.process is None):
+				self.process = await asyncio.create_subprocess_exec(
+					'pwsh',
+					stdin  = asyncio.subprocess.PIPE,
+					stdout = asyncio.subprocess.PIPE,
+					stderr = asyncio.subprocess.STDOUT
+				)
+
+				self.process.stdin.write(self._readiness_probe(modules).encode('utf-8'))
+				await self.process.stdin.drain()
+
+			if (wait and self.ready_token is not None):
+				while (not self._handle_ready_line(await self._readline())):
+					pass
+
+	async def close (self):
+		# disconnect and confirm any prompts that may come our way
+		if (self.connected_to_teams):
+			await self.run_command('Disconnect-MicrosoftTeams')
+
+		if (self.process != None):
+			self.process.stdin.close()
+			self.process.kill()
+			await self.process.wait()
+
+		if (self.debug_mode):
+			self.log.close()
+
+	async def _readline (self):
+		""" returns the next line of output, waiting for the process if needed (None if the process has ended) """
+		while (len(self.lines) == 0):
+			chunk = await self.process.stdout.read(65536)
+
+			if (len(chunk) == 0):
+				return None
+
+			self._add_output(chunk)
+
+		return self.lines.popleft()
+
+	async def _run_command (self, command, do_run=True, return_if_found=None, convert_json=False, json_records=None):
+		""" sends a command and reads its output, assumes the lock is held """
+		command_sent, state = self._prepare_command(command, do_run, return_if_found, convert_json, json_records)
+
+		if (do_run is False):
+			return ''
+
+		self.process.stdin.write(command_sent.encode('utf-8'))
+		await self.process.stdin.drain()
+
+		while (not self._handle_line(await self._readline(), state)):
+			pass
+
+		return self._finish_output(state['command'], state['output'], convert_json, state['records'])
+
+	async def run_command (self, command, do_run=True, delay=0.5, return_if_found=None, convert_json=False, json_records=None):
+		""" see `PowerShellWrapper.run_command` """
+		await self.ensure_started()
+
+		async with self.lock:
+			return await self._run_command(command, do_run, return_if_found, convert_json, json_records)
+
+	async def connect_to_teams (self):
+		""" see `PowerShellWrapper.connect_to_teams` """
+		await self.ensure_started()
+
+		if (self.connected_to_teams):
+			return True
+
+		response = ''
+
+		if (self.login_method == None or self.login_method == 'popup' or self.login_method == 'default'):
+			response = await self.run_command('Connect-MicrosoftTeams')
+		else:
+			self._ask_login_details()
+
+			if (self.login_method == 'automated'):
+				# the browser isn't async, so it runs in a separate thread to keep the loop going
+				loop = asyncio.get_running_loop()
+				try:
+					b = await loop.run_in_executor(None, functools.partial(Browser, 'firefox', headless=False, incognito=True))
+					await loop.run_in_executor(None, b.visit, 'https://microsoft.com/devicelogin')
+
+					response = await self.run_command('Connect-MicrosoftTeams',
+						return_if_found='use a web browser to open the page https://microsoft.com/devicelogin and enter the code')
+
+					await loop.run_in_executor(None, self._complete_device_login, b, response)
+
+					response = await self.run_command('just want to see more output', False)
+
+					await loop.run_in_executor(None, b.quit)
+				except Exception as e:
+					print(e)
+			elif (self.login_method == 'credentials'):
+				for command in self._credential_commands():
+					await self.run_command(command)
+
+				response = await self.run_command('Connect-MicrosoftTeams -Credential $Credential')
+
+		return self._check_connection(response)
+
+
+class ReplayPowerShellWrapper (PowerShellWrapper):
+	"""
+	Stands in for a PowerShellWrapper by playing back a trace recorded earlier (see CommandTrace),
+	so no powershell or Teams login is needed. Output is parsed just as it was originally.
+
+	Each command gets the output recorded for the same command, in the order they were recorded.
+	`time_scale` sets how fast output is given: 1 keeps the original timing, 0.5 is twice as fast,
+	and 0 (default) doesn't wait at all.
+	"""
+	def __init__ (self, path, time_scale=0, debug=False, username=None, password='***'):
+		header, self.recorded = CommandTrace.load(path)
+
+		super().__init__(lazy_start=True, debug=debug, login_method='credentials', username=username or header['username'], password=password, framed=header['framed'], name='replay')
+
+		self.time_scale = time_scale
+		self.playing    = deque()  # output lines of the current command, with their time since it was sent
+		self.started    = 0
+
+	def ensure_started (self, wait=True, modules=None):
+		""" there's no process to start """
+		pass
+
+	def close (self):
+		self.connected_to_teams = False  # nothing to disconnect from
+
+		super().close()
+
+	def _send (self, command_sent, state):
+		""" rather than sending the command, gets its recorded output ready """
+		command = redact_secrets(state['command'])
+
+		if (len(self.recorded.get(command, ())) == 0):
+			raise LookupError(f'No recorded output (left) for command: {command}')
+
+		token        = state['token'] or ''
+		self.playing = deque((t, o.replace(CommandTrace.token_placeholder, token) if o is not None else None) for t, o in self.recorded[command].popleft())
+		self.started = time.monotonic()
+
+	def _readline (self):
+		""" returns the next recorded line of output, after the recorded delay (scaled by `time_scale`) """
+		if (len(self.playing) == 0):
+			return None
+
+		t, o = self.playing.popleft()
+
+		if (self.time_scale > 0):
+			wait = self.started + t / 1000 * self.time_scale - time.monotonic()
+			if (wait > 0):
+				time.sleep(wait)
+
+		return o
+
+
+class PowerShellPool:
+	"""
+	A set of PowerShellWrapper sessions, each logged in to Teams separately, so independent
+	commands can run side by side instead of all waiting on one shell.
+
+	It can be passed to TeamsUpdater in place of a single PowerShellWrapper.
+	`run_command` uses the session claimed by the current thread (see `session`), or whichever session
+	was used last, so running commands one after another behaves just like a single shell.
+	Use `map` to spread tasks over all sessions (TeamsUpdater does so via its `dispatch` method).
+	"""
+	def __init__ (self, size=4, lazy_start=False, debug=False, login_method=None, username=None, password=None, framed=False, transcript=None, teams_module=None):
+		self.size         = max(1, size)
+		self.username     = username
+		self.password     = password
+		self.login_method = login_method
+		self.executor     = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='pwsh')
+		self.local        = threading.local()  # holds the session claimed by each thread
+		self.idle         = queue.LifoQueue()  # last in, first out, so sequential use keeps getting the same session
+
+		self.sessions = []
+		for n in range(self.size):
+			s = PowerShellWrapper(lazy_start=True, debug=debug, login_method=login_method, username=username, password=password, framed=framed, name=f'pool{n}', transcript=transcript, teams_module=teams_module)
+			self.sessions.append(s)
+			self.idle.put(s)
+
+		if (lazy_start is False):
+			self.ensure_started()
+
+	def __enter__ (self):
+		""" enables the use of the `with` statement """
+		return self
+
+	def __exit__ (self, type, value, traceback):
+		""" so we can exit after using the `with` statement """
+		self.close()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raise the exception to be transparent
+
+	@property
+	def connected_to_teams (self):
+		return all(s.connected_to_teams for s in self.sessions)
+
+	def ensure_started (self, wait=True, modules=None):
+		""" starts all sessions at once, rather than waiting for each to start in turn """
+		if (wait):
+			list(self.executor.map(lambda s: s.ensure_started(True, modules), self.sessions))
+		else:
+			for s in self.sessions:
+				s.ensure_started(False, modules)
+
+	def connect_to_teams (self):
+		""" logs in all sessions, returns True only if every session is connected """
+		# ask for any missing login details once, rather than once per session
+		if (self.login_method not in (None, 'popup', 'default')):
+			if (self.username is None):
+				self.username = input('Username: ')
+			if (self.username.find('@') == -1):
+				self.username += '@ad.unsw.edu.au'
+
+			if (self.password is None):
+				self.password = getpass.getpass(prompt='Password: ')
+
+			for s in self.sessions:
+				s.username = self.username
+				s.password = self.password
+
+		return all(self.executor.map(lambda s: s.connect_to_teams(), self.sessions))
+
+	def close (self):
+		for s in self.sessions:
+			s.close()
+
+		self.executor.shutdown()
+
+	@contextmanager
+	def session (self):
+		""" claims an idle session for the current thread, which `run_command` then sticks to until released """
+		claimed = getattr(self.local, 'session', None)
+
+		# nested use just continues with the session already claimed
+		if (claimed is not None):
+			yield claimed
+			return
+
+		s = self.idle.get()
+		self.local.session = s
+		try:
+			yield s
+		finally:
+			self.local.session = None
+			self.idle.put(s)
+
+	def run_command (self, command, *args, **kwargs):
+		""" runs a command on a session of this pool, see `PowerShellWrapper.run_command` for parameters """
+		with self.session() as s:
+			return s.run_command(command, *args, **kwargs)
+
+	def map (self, function, items):
+		"""
+		Calls `function` for each item, spread over the sessions in this pool, and returns the results in order.
+		Each call has a session to itself, so any commands it runs are never mixed with those of another call.
+		"""
+		def claim_and_call (item):
+			with self.session():
+				return function(item)
+
+		return list(self.executor.map(claim_and_call, items))
+
+
+class PowerShellDaemon:
+	"""
+	Keeps a PowerShellWrapper logged in to Teams for as long as it runs, and lets other scripts use it
+	via a local unix socket (see PowerShellDaemonClient). Repeated runs, like an hourly cron job, then
+	skip both starting powershell and logging in.
+
+	The socket is only accessible to the current user. Commands from several clients are run one at a time.
+	Each request and response is a line of JSON.
+	"""
+	default_socket_path = os.path.expanduser('~/.course_updater_pwsh.sock')
+
+	def __init__ (self, socket_path=None, process=None, login_method='credentials', username=None, password=None):
+		self.socket_path = socket_path or self.default_socket_path
+		self.lock        = threading.Lock()
+		self.server      = None
+
+		self.process = process
+		if (self.process is None):
+			self.process = PowerShellWrapper(lazy_start=True, debug=False, login_method=login_method, username=username, password=password, framed=True, name='daemon')
+
+	def __enter__ (self):
+		""" enables the use of the `with` statement """
+		return self
+
+	def __exit__ (self, type, value, traceback):
+		""" so we can exit after using the `with` statement """
+		self.close()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raise the exception to be transparent
+
+	def serve_forever (self):
+		"""
+		logs in to Teams and then handles requests until `shutdown` is called (or a client asks for it)
+		raises a RuntimeError if another daemon is already serving at the socket path
+		"""
+		# a socket left behind by an earlier daemon that didn't exit cleanly would block binding
+		#   but one that still answers belongs to a live daemon, which is left alone
+		if (self.is_running()):
+			raise RuntimeError(f'Daemon already running at {self.socket_path}')
+		elif (os.path.exists(self.socket_path)):
+			os.remove(self.socket_path)
+
+		with self.lock:
+			self.process.connect_to_teams()
+
+		daemon = self
+
+		class RequestHandler (socketserver.StreamRequestHandler):
+			def handle (self):
+				for line in self.rfile:
+					try:
+						response = daemon.handle_request(json.loads(line))
+					except Exception as e:
+						response = {'error': f'{type(e).__name__}: {e}'}
+
+					self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+					self.wfile.flush()
+
+		# keep others away from a logged in session, the socket is only created after the umask is set
+		old_umask = os.umask(0o177)
+		try:
+			self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+		finally:
+			os.umask(old_umask)
+
+		self.server.daemon_threads = True
+		self.server.serve_forever()
+
+	def is_running (self):
+		""" returns whether a daemon answers at the socket path """
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			try:
+				s.connect(self.socket_path)
+				return True
+			except (FileNotFoundError, ConnectionRefusedError):
+				return False
+
+	def handle_request (self, request):
+		""" handles a request from a client, returns a response dictionary """
+		op = request.get('op')
+
+		if (op == 'run'):
+			with self.lock:
+				output = self.process.run_command(request['command'], **request.get('kwargs', {}))
+
+				return {
+					'output'   : output,
+					'errors'   : self.process.latest_errors,
+					'status'   : self.process.latest_status,
+					'exit_code': self.process.latest_exit_code
+				}
+		elif (op == 'connect'):
+			with self.lock:
+				if (self.process.connected_to_teams is False):
+					self.process.connect_to_teams()
+				return self.status()
+		elif (op == 'status'):
+			return self.status()
+		elif (op == 'shutdown'):
+			# shutdown waits for serve_forever to exit, so it can't be called from the thread handling this request
+			threading.Thread(target=self.shutdown).start()
+			return {'shutdown': True}
+
+		return {'error': f'Unknown operation: {op}'}
+
+	def status (self):
+		return {
+			'connected': self.process.connected_to_teams,
+			'username' : self.process.username
+		}
+
+	def shutdown (self):
+		if (self.server is not None):
+			self.server.shutdown()
+
+	def close (self):
+		if (self.server is not None):
+			self.server.server_close()
+			self.server = None
+
+			if (os.path.exists(self.socket_path)):
+				os.remove(self.socket_path)
+
+		with self.lock:
+			self.process.close()
+
+
+class PowerShellDaemonClient:
+	"""
+	Stands in for a PowerShellWrapper, but sends commands to a running PowerShellDaemon
+	instead of starting powershell itself. Closing the client leaves the daemon (and its login) running.
+	"""
+	def __init__ (self, socket_path=None):
+		self.socket_path      = socket_path or PowerShellDaemon.default_socket_path
+		self.latest_output    = ''
+		self.latest_errors    = []
+		self.latest_status    = None
+		self.latest_exit_code = None
+		self.lock             = threading.Lock()
+
+		# raises an OSError if the daemon isn't running
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.connect(self.socket_path)
+		self.file = self.socket.makefile('rwb')
+
+		status = self._request({'op': 'status'})
+		self.username           = status['username']
+		self.connected_to_teams = status['connected']
+
+	def __enter__ (self):
+		""" enables the use of the `with` statement """
+		return self
+
+	def __exit__ (self, type, value, traceback):
+		""" so we can exit after using the `with` statement """
+		self.close()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raise the exception to be transparent
+
+	def _request (self, request):
+		""" sends a request to the daemon and returns its response """
+		with self.lock:
+			self.file.write(json.dumps(request).encode('utf-8') + b'\n')
+			self.file.flush()
+			line = self.file.readline()
+
+		if (not line):
+			raise ConnectionError(f'PowerShellDaemon at {self.socket_path} closed the connection')
+
+		response = json.loads(line)
+		if ('error' in response):
+			raise RuntimeError(f'PowerShellDaemon: {response["error"]}')
+
+		return response
+
+	def ensure_started (self, wait=True, modules=None):
+		""" the daemon has started powershell already """
+		pass
+
+	def connect_to_teams (self):
+		""" the daemon normally is logged in already, so this only asks it to log in again if needed """
+		self.connected_to_teams = self._request({'op': 'connect'})['connected']
+		return self.connected_to_teams
+
+	def run_command (self, command, do_run=True, delay=0.5, return_if_found=None, convert_json=False, json_records=None):
+		""" see `PowerShellWrapper.run_command` """
+		if (do_run is False):
+			return ''
+
+		response = self._request({
+			'op'     : 'run',
+			'command': command,
+			'kwargs' : {'return_if_found': return_if_found, 'convert_json': convert_json, 'json_records': json_records}
+		})
+
+		self.latest_output    = response['output']
+		self.latest_errors    = response['errors']
+		self.latest_status    = response['status']
+		self.latest_exit_code = response['exit_code']
+
+		return self.latest_output
+
+	def close (self):
+		self.file.close()
+		self.socket.close()
+
+
+class RateGovernor:
+	"""
+	Paces commands sent to the Teams backend, so syncing runs as fast as the tenant allows without being throttled.
+
+	Throttling errors are recognised (see `classify`), after which all commands wait for the Retry-After time
+	given (or an increasing backoff time without it). The number of commands in flight at once adapts as well:
+	it goes up by one after every `increase_after` commands that went fine, and halves whenever one is throttled.
+	"""
+	throttle_regex    = re.compile(r'TooManyRequests|Too many requests|throttl|(?:StatusCode|Status)\W{0,3}429', re.IGNORECASE)
+	retry_after_regex = re.compile(r'Retry-?After\W{0,4}(\d+(?:\.\d+)?)', re.IGNORECASE)
+
+	def __init__ (self, max_in_flight=4, min_in_flight=1, increase_after=10, backoff=2, max_backoff=60, max_retries=5):
+		self.max_in_flight  = max(1, max_in_flight)
+		self.min_in_flight  = max(1, min(min_in_flight, self.max_in_flight))
+		self.increase_after = increase_after
+		self.base_backoff   = backoff
+		self.max_backoff    = max_backoff
+		self.max_retries    = max_retries
+
+		self.limit          = float(self.max_in_flight)  # number of commands allowed in flight at the moment
+		self.in_flight      = 0
+		self.successes      = 0    # in a row, since the last increase or throttling
+		self.backoff        = 0    # increases while throttled without a Retry-After hint
+		self.resume_at      = 0    # time.monotonic() value before which no new commands are started
+		self.throttled      = 0    # number of throttled responses so far
+		self.condition      = threading.Condition()
+
+	@staticmethod
+	def error_text (response, errors=None):
+		""" returns the error part of a response: its error lines (framed mode), or else anything after a Teams cmdlet error """
+		if (errors):
+			return '\n'.join(errors)
+		if (not isinstance(response, str)):
+			return ''
+
+		index = response.find('Error occurred while executing')
+		return response[index:] if (index != -1) else ''
+
+	@classmethod
+	def classify (cls, response):
+		"""
+		returns whether an error tells of throttling, and the Retry-After time given (in seconds, or None)
+		only pass error text (see `error_text`), as ordinary output may well mention throttling or a 429
+		"""
+		if (not isinstance(response, str) or cls.throttle_regex.search(response) is None):
+			return False, None
+
+		retry_after = cls.retry_after_regex.search(response)
+
+		return True, float(retry_after.group(1)) if retry_after else None
+
+	def _try_acquire (self):
+		""" claims a slot if possible, otherwise returns the time to wait before trying again, assumes the lock is held """
+		wait = self.resume_at - time.monotonic()
+		if (wait > 0):
+			return wait
+
+		if (self.in_flight >= int(self.limit)):
+			return 0.05  # a slot may free up sooner, but this is only a fallback to being notified
+
+		self.in_flight += 1
+		return 0
+
+	def acquire (self):
+		""" waits until a command may be sent """
+		with self.condition:
+			wait = self._try_acquire()
+			while (wait > 0):
+				self.condition.wait(timeout=wait)
+				wait = self._try_acquire()
+
+	async def acquire_async (self):
+		""" async version of `acquire` """
+		while True:
+			with self.condition:
+				wait = self._try_acquire()
+			if (wait == 0):
+				return
+			await asyncio.sleep(wait)
+
+	def release (self, response, errors=None):
+		""" frees the slot of a command and adjusts the pace based on its errors, returns the time to wait before retrying if it was throttled (otherwise None) """
+		throttled, retry_after = self.classify(self.error_text(response, errors))
+		delay = None
+
+		with self.condition:
+			self.in_flight -= 1
+
+			if (throttled):
+				self.throttled += 1
+				self.successes = 0
+				self.limit     = max(self.min_in_flight, self.limit / 2)
+
+				if (retry_after is None):
+					self.backoff = min(self.max_backoff, max(self.base_backoff, self.backoff * 2))
+					delay        = self.backoff
+				else:
+					delay        = retry_after
+
+				self.resume_at = max(self.resume_at, time.monotonic() + delay)
+			else:
+				self.backoff    = 0
+				self.successes += 1
+
+				if (self.successes >= self.increase_after):
+					self.limit     = min(self.max_in_flight, self.limit + 1)
+					self.successes = 0
+
+			self.condition.notify_all()
+
+		return delay
+
+
+class MembershipCache:
+	"""
+	Remembers the members of teams and channels (and the channels in teams), so these needn't be fetched again
+	on every run. Entries expire after `ttl` seconds, and are kept up to date when TeamsUpdater adds or removes users.
+	With a `path`, the cache is loaded from and saved to that JSON file.
+
+	Changes made elsewhere (via the Teams app, or by another script) aren't noticed until an entry expires,
+	so use `refresh=True` on TeamsUpdater methods (or `clear`) to check for drift.
+	"""
+	def __init__ (self, path=None, ttl=3600):
+		self.path    = path
+		self.ttl     = ttl
+		self.entries = {}  # example: {'team|<team id>|All': {'time': 1620000000.0, 'data': {...}}}
+		self.lock    = threading.Lock()
+
+		if (self.path is not None):
+			try:
+				with open(self.path, 'r') as f:
+					self.entries = json.load(f)
+			except FileNotFoundError:
+				pass
+
+	@staticmethod
+	def team_key (team_id, role='All'):
+		return f'team|{team_id}|{role}'
+
+	@staticmethod
+	def channel_key (team_id, channel_name, role='All'):
+		return f'channel|{team_id}|{channel_name}|{role}'
+
+	@staticmethod
+	def channels_key (team_id, channel_type=None):
+		return f'channels|{team_id}|{channel_type}'
+
+	def get (self, key):
+		""" returns the data for a key, or None if there is none (or it expired) """
+		with self.lock:
+			entry = self.entries.get(key)
+
+			if (entry is None or time.time() - entry['time'] > self.ttl):
+				return None
+
+			return copy.deepcopy(entry['data'])
+
+	def set (self, key, data):
+		with self.lock:
+			self.entries[key] = {'time': time.time(), 'data': copy.deepcopy(data)}
+
+	def get_users (self, key):
+		""" returns a cached member list as a dict of User objects, or None """
+		users = self.get(key)
+
+		if (users is None):
+			return None
+
+		return {uid: User(uid, u['name'], '', [], [], [], u['email']).freeze() for uid, u in users.items()}
+
+	def set_users (self, key, user_list):
+		""" caches a member list (a dict of User objects) """
+		self.set(key, {uid: self._user_data(u) for uid, u in user_list.items()})
+
+	@staticmethod
+	def _user_data (user):
+		return {'name': user.name, 'email': user.email}
+
+	def invalidate (self, prefix):
+		""" forgets all entries whose key starts with `prefix` """
+		with self.lock:
+			for key in [k for k in self.entries if k.startswith(prefix)]:
+				del self.entries[key]
+
+	def clear (self):
+		with self.lock:
+			self.entries = {}
+
+	def apply (self, operation):
+		""" updates cached member lists after a succesful add or remove (see `TeamsUpdater._membership_operation`) """
+		user = operation['user']
+		role = operation['role']
+
+		if (operation['channel_name'] is None):
+			prefix = f"team|{operation['team_id']}|"
+		else:
+			prefix = f"channel|{operation['team_id']}|{operation['channel_name']}|"
+
+		if (operation['action'] == 'remove' and role == 'Owner'):
+			# removing the owner role may only demote a user, so member lists can't be adjusted with certainty
+			self.invalidate(prefix)
+			return
+
+		if (operation['action'] == 'add' and role == 'Member'):
+			# adding an owner as member leaves them an owner, so unless they're known not to be one, idem
+			owners = self.get(prefix + 'Owner')
+			if (owners is None or user.id in owners):
+				self.invalidate(prefix)
+				return
+
+		with self.lock:
+			for key, entry in self.entries.items():
+				if (not key.startswith(prefix)):
+					# users removed from a team are no longer in any of its channels either
+					if (operation['action'] == 'remove' and operation['channel_name'] is None and key.startswith(f"channel|{operation['team_id']}|")):
+						entry['data'].pop(user.id, None)
+					continue
+
+				key_role = key[len(prefix):]
+
+				if (operation['action'] == 'remove'):
+					entry['data'].pop(user.id, None)
+				elif (key_role in ('All', role)):
+					entry['data'][user.id] = self._user_data(user)
+				else:
+					entry['data'].pop(user.id, None)  # promoted to owner
+
+	def save (self):
+		""" writes the cache to its file, if it has one """
+		if (self.path is None):
+			return
+
+		with self.lock:
+			data = json.dumps(self.entries)
+
+		# write to a temporary file first, so an interrupted save doesn't leave a broken cache behind
+		with open(self.path + '.tmp', 'w') as f:
+			f.write(data)
+		os.replace(self.path + '.tmp', self.path)
+
+
+@dataclass
+class EnrolmentChangeset:
+	"""
+	What changed between two imports of a Moodle user export (see ImportFingerprints)
+	Newly enrolled users count as having all of their groups (and class ids) added, unenrolled users as having them removed.
+	"""
+	enrolled         : list = field(default_factory=list)  # user ids
+	unenrolled       : list = field(default_factory=list)
+	changed          : list = field(default_factory=list)  # user ids with a changed row, including changes not listed below
+	group_changes    : dict = field(default_factory=dict)  # user id -> (added groups, removed groups)
+	grouping_changes : dict = field(default_factory=dict)  # idem for groupings
+	class_changes    : dict = field(default_factory=dict)  # idem for class ids
+	staff            : set  = field(default_factory=set)   # ids of staff (users without class ids) among the above
+	context_changed  : bool = False  # anything else the import depends on changed (project list, stafflist, ...)
+
+	def __bool__ (self):
+		return bool(self.enrolled or self.unenrolled or self.changed or self.context_changed)
+
+	def _affected (self, changes):
+		affected = set()
+		for added, removed in changes.values():
+			affected.update(added)
+			affected.update(removed)
+		return affected
+
+	def affected_groups (self):
+		""" returns the names of all groups that gained or lost members """
+		return self._affected(self.group_changes)
+
+	def affected_groupings (self):
+		return self._affected(self.grouping_changes)
+
+	def affected_class_ids (self):
+		return self._affected(self.class_changes)
+
+	def summary (self):
+		summary = f'{len(self.enrolled)} enrolled, {len(self.unenrolled)} unenrolled, {len(self.changed)} changed ({len(self.staff)} staff)'
+		if (self.context_changed):
+			summary += ', context changed'
+		return summary
+
+
+class ImportFingerprints:
+	"""
+	Remembers a fingerprint (content hash) of every row of the previous Moodle user export, so that the next import
+	can tell which users were enrolled, unenrolled or changed (see EnrolmentChangeset), and reuse unchanged users.
+	With a `path`, fingerprints are loaded from and saved to that JSON file, so this also works across runs.
+	Use one ImportFingerprints per course.
+
+	Changesets are relative to the last import that was synced, so call `confirm` once a sync went fine.
+	Until then, changes keep adding up, and a sync that failed halfway is planned again on the next run.
+	"""
+	def __init__ (self, path=None):
+		self.path         = path
+		self.context      = None  # fingerprint of anything else the import depends on (project list, stafflist, ...)
+		self.entries      = {}    # example: {'z1234567': {'hash': '...', 'class_ids': [1234], 'groups': [...], 'groupings': [...]}}
+		self.last_context = None  # of the last import, which may not have been synced (and confirmed) yet
+		self.last_entries = {}
+		self.new_context  = None
+		self.new_entries  = {}
+		self.streams      = {}    # fingerprint of the config of each stream as last synced, see `stream_changed`
+		self.new_streams  = {}
+
+		if (self.path is not None):
+			try:
+				with open(self.path, 'r') as f:
+					data = json.load(f)
+					self.context = data['context']
+					self.entries = data['entries']
+					self.streams = data.get('streams', {})
+			except FileNotFoundError:
+				pass
+
+		self.last_context = self.context
+		self.last_entries = self.entries
+
+	@staticmethod
+	def row_hash (row):
+		""" returns a fingerprint for a csv row (a list of strings) """
+		return hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=16).hexdigest()
+
+	@staticmethod
+	def context_hash (*parts):
+		""" returns a fingerprint for any json-serialisable data """
+		return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode('utf-8'), digest_size=16).hexdigest()
+
+	def start (self, context):
+		""" starts collecting fingerprints of a new import """
+		self.new_context = context
+		self.new_entries = {}
+
+	def context_changed (self):
+		return self.new_context != self.last_context
+
+	def unchanged (self, user_id, row_hash):
+		""" returns whether a row was in the previous import as it is """
+		entry = self.last_entries.get(user_id)
+		return (entry is not None and entry['hash'] == row_hash)
+
+	def add (self, user_id, row_hash, user):
+		self.new_entries[user_id] = {
+			'hash'     : row_hash,
+			'class_ids': list(user.class_ids),
+			'groups'   : list(user.groups),
+			'groupings': list(user.groupings)
+		}
+
+	def finish (self, context=None):
+		"""
+		returns what changed since the last confirmed import as an EnrolmentChangeset (see `confirm`)
+		the context to save for the next import can be updated (if the import itself changed it)
+		"""
+		if (context is not None):
+			self.new_context = context
+
+		changes = EnrolmentChangeset(context_changed=(self.new_context != self.context))
+		empty   = {'hash': None, 'class_ids': [], 'groups': [], 'groupings': []}
+
+		for user_id in self.new_entries.keys() | self.entries.keys():
+			old = self.entries.get(user_id)
+			new = self.new_entries.get(user_id)
+
+			if (old is None):
+				changes.enrolled.append(user_id)
+			elif (new is None):
+				changes.unenrolled.append(user_id)
+			elif (old['hash'] != new['hash']):
+				changes.changed.append(user_id)
+			else:
+				continue
+
+			# rows without class ids are staff (or students halfway through unenrolment)
+			if ((old is not None and not old['class_ids']) or (new is not None and not new['class_ids'])):
+				changes.staff.add(user_id)
+
+			old = old or empty
+			new = new or empty
+
+			for changes_dict, key in [(changes.group_changes, 'groups'), (changes.grouping_changes, 'groupings'), (changes.class_changes, 'class_ids')]:
+				added   = [v for v in new[key] if v not in old[key]]
+				removed = [v for v in old[key] if v not in new[key]]
+				if (added or removed):
+					changes_dict[user_id] = (added, removed)
+
+		for ids in (changes.enrolled, changes.unenrolled, changes.changed):
+			ids.sort()
+
+		self.last_context = self.new_context
+		self.last_entries = self.new_entries
+
+		return changes
+
+	def stream_changed (self, key, context):
+		""" returns whether the config of a stream changed since the last confirmed sync, its new context is kept for `confirm` """
+		self.new_streams[key] = context
+		return (self.streams.get(key) != context)
+
+	def confirm (self):
+		""" marks the last import (and stream configs) as synced, so the next changeset is relative to it, and saves the fingerprints """
+		self.context = self.last_context
+		self.entries = self.last_entries
+		self.streams.update(self.new_streams)
+		self.new_streams = {}
+		self.save()
+
+	def save (self):
+		""" writes the fingerprints to their file, if there is one """
+		if (self.path is None):
+			return
+
+		# write to a temporary file first, so an interrupted save doesn't leave a broken file behind
+		with open(self.path + '.tmp', 'w') as f:
+			json.dump({'context': self.context, 'entries': self.entries, 'streams': self.streams}, f)
+		os.replace(self.path + '.tmp', self.path)
+
+
+def follow_lines (path, timeout=120, poll_interval=0.25, partial_suffixes=('.part', '.crdownload')):
+	"""
+	yields the lines of a file that may still be downloading, as they are written (similar to `tail -f`)
+
+	Browsers download into a temporary file (e.g. 'list.csv.part') and rename it once done, so that file is read if
+	it exists. Reading ends once the download is complete and all of it has been read. If nothing is written
+	for `timeout` seconds, a TimeoutError is raised.
+	"""
+	partials = [path + suffix for suffix in partial_suffixes]
+	deadline = time.time() + timeout
+
+	# wait for the download to start (browsers may create an empty placeholder at the final path first)
+	while True:
+		source = next((p for p in partials if os.path.exists(p)), None)
+		if (source is None and os.path.exists(path) and os.path.getsize(path) > 0):
+			source = path
+
+		if (source is not None):
+			break
+		elif (time.time() > deadline):
+			raise TimeoutError(f'No download of {path} started within {timeout} seconds')
+
+		time.sleep(poll_interval)
+
+	with open(source, newline='') as f:
+		partial_line = ''
+
+		while True:
+			line = f.readline()
+
+			if (line):
+				deadline = time.time() + timeout
+				partial_line += line
+
+				# only pass on complete lines
+				if (partial_line.endswith('\n')):
+					yield partial_line
+					partial_line = ''
+				continue
+
+			# at the end for now, check if the download is done
+			#   the open file keeps pointing at the same data when renamed, so compare against its own size
+			done = (not any(os.path.exists(p) for p in partials) and os.path.exists(path))
+			if (done and f.buffer.tell() >= os.fstat(f.fileno()).st_size):
+				if (partial_line):
+					yield partial_line
+				break
+			elif (time.time() > deadline):
+				raise TimeoutError(f'Download of {path} stalled for {timeout} seconds')
+
+			time.sleep(poll_interval)
+
+
+def follow_download (path, **kwargs):
+	"""
+	like `follow_lines`, for a download started with `MoodleUpdater.get_users_csv(wait=False)`
+	the previous file was kept as -old.csv, which is removed once the download is complete (or put back if it stalled)
+	"""
+	old_path = os.path.splitext(path)[0] + '-old.csv'
+
+	try:
+		yield from follow_lines(path, **kwargs)
+	except TimeoutError:
+		if (os.path.exists(old_path)):
+			os.replace(old_path, path)
+		raise
 
-		return output
+	if (os.path.exists(old_path)):
+		os.remove(old_path)
 
-	def connect_to_teams (self):
-		"""
-		Running any commands from the MicrosoftTeams pwoershell module requires an active login
-		This method logs in automatically, either by just giving a popup or by attempting a fully
-		automatic login by hiding the Office365 login process via a headless browser connection.
 
-		TODO: automated seems broken in some cases at the moment... still opens browser tab that works.
-		"""
-		self.ensure_started()
+class SyncDependencies:
+	"""
+	Which sources feed which team or channel roster, so that after a change in enrolments (see EnrolmentChangeset)
+	only the affected rosters need to be synced. Targets are (team id, channel name or None, role) tuples.
 
-		if (self.connected_to_teams):
-			return True
-		else:
-			response = ''
+	Sources are one of:
+	  ('staff',)          : the stafflist (e.g. stream owners), affected by any change to staff
+	  ('students',)       : the master list as a whole (or filtered in ways that can't be traced), affected by any change to students
+	  ('query', Match(..)) : users in matching groups, groupings or class ids, affected when any of these gain or lose students
+	"""
+	def __init__ (self):
+		self.edges = []  # (source, target)
 
-			if (self.login_method == None or self.login_method == 'popup' or self.login_method == 'default'):
-				# login via a browser window/popup - works but needs user input via browser
-				response = self.run_command('Connect-MicrosoftTeams')
+	@staticmethod
+	def filter_source (filter_key, filter_terms):
+		""" returns the source for the master list filtered as find_users(filter_key, filter_terms) would """
+		if (filter_key is None):
+			return ('students',)
+
+		match = Match.from_search(filter_key, filter_terms)
+		if (match.key in ['group', 'grouping', 'class id']):
+			return ('query', match)
+
+		return ('students',)
+
+	def add (self, source, target):
+		self.edges.append((source, target))
+
+	def targets (self):
+		return {target for source, target in self.edges}
+
+	def affected (self, changeset):
+		""" returns the set of targets affected by an EnrolmentChangeset """
+		# a changed context (project list, stafflist, ...) may affect any roster
+		if (changeset.context_changed):
+			return self.targets()
+
+		# only changes to students matter for queries on the master list
+		#   users with class ids before or after the change were (or are) students, e.g. those halfway through unenrolment
+		def _is_student (user_id):
+			return (user_id not in changeset.staff or user_id in changeset.class_changes)
+
+		values = {'group': set(), 'grouping': set(), 'class id': set()}
+		for key, changes in [('group', changeset.group_changes), ('grouping', changeset.grouping_changes), ('class id', changeset.class_changes)]:
+			for user_id, (added, removed) in changes.items():
+				if (_is_student(user_id)):
+					values[key].update(added)
+					values[key].update(removed)
+
+		staff_changed    = bool(changeset.staff)
+		students_changed = any(_is_student(user_id) for user_id in changeset.enrolled + changeset.unenrolled + changeset.changed)
+
+		affected = set()
+		for source, target in self.edges:
+			if (source[0] == 'staff'):
+				hit = staff_changed
+			elif (source[0] == 'students'):
+				hit = students_changed
 			else:
-				# get username and password
-				if (self.username is None):
-					self.username = input('Username: ')
-				if (self.username.find('@') == -1):
-					self.username += '@ad.unsw.edu.au'
-				
-				if (self.password is None):
-					self.password = getpass.getpass(prompt='Password: ')
+				hit = any(source[1]._test(value) for value in values[source[1].key])
 
-				if (self.login_method == 'automated'):
-					# login via browser window but automate all actions
-					try:
-						b = Browser('firefox', headless=False, incognito=True)
-						b.visit('https://microsoft.com/devicelogin')
+			if (hit):
+				affected.add(target)
 
-						# begin connecting and get authentication code
-						response = self.run_command('Connect-MicrosoftTeams',
-							return_if_found='use a web browser to open the page https://microsoft.com/devicelogin and enter the code')
+		return affected
 
-						regex = re.compile('.+enter the code ([a-zA-Z0-9]{9}) to authenticate.+')
-						r = regex.search(response)
 
-						authentication_code = r.groups()[0]
-						print(f'Using authorisation code: {authentication_code}')
+@dataclass
+class SyncPlan:
+	"""
+	All changes needed to bring teams and channels in line with course data, as worked out by `TeamsUpdater.plan_course_update`.
+	Nothing is changed until the plan is applied (see `TeamsUpdater.apply_plan`), so a plan doubles as a dry run.
+	It only holds basic types, so it can be saved and loaded as JSON.
 
-						# fill in authentication code in text field
-						b.fill('otc', authentication_code)
-						# click next
-						b.find_by_id('idSIButton9').click()
-						# wait for next page
-						time.sleep(3)
+	Memberships are in the format of `TeamsUpdater._membership_operation`, with the user given as {'id', 'name', 'email'}.
+	Promoting a member to owner is an addition with the Owner role.
+	"""
+	team_edits      : list = field(default_factory=list)  # {'team_id', 'name', 'description'}
+	channel_creates : list = field(default_factory=list)  # {'team_id', 'channel_name', 'channel_type', 'description'}
+	channel_edits   : list = field(default_factory=list)  # {'team_id', 'channel_name', 'description'}
+	memberships     : list = field(default_factory=list)
+	warnings        : list = field(default_factory=list)
 
-						# assume we're on a clean slate login (no history or existing login)
+	def __post_init__ (self):
+		self.seen = {self._membership_key(op) for op in self.memberships}
 
-						# fill in username
-						b.fill('loginfmt', self.username)
-						b.find_by_id('idSIButton9').click()
-						# wait for next page
-						time.sleep(2)
+	@staticmethod
+	def _membership_key (operation):
+		return (operation['action'], operation['team_id'], operation['channel_name'], operation['user']['id'], operation['role'])
 
-						# second up, password
-						b.fill('passwd', self.password)
-						b.find_by_id('idSIButton9').click()
-						time.sleep(4)
+	def add_membership (self, operation):
+		""" adds a membership operation (with a User object), unless the same one is in the plan already """
+		user      = operation['user']
+		operation = dict(operation, user={'id': user.id, 'name': user.name, 'email': user.email})
+		key       = self._membership_key(operation)
 
-						# check if we are now logged in
-						if (not b.is_text_present('You have signed in to the MS Teams Powershell Cmdlets application')):
-							print('WARNING: devicelogin may have failed')
+		if (key not in self.seen):
+			self.seen.add(key)
+			self.memberships.append(operation)
 
-						# continue the login process and fetch final response
-						response = self.run_command('just want to see more output', False, delay=3)
-						
-						b.quit()
-					except Exception as e:
-						print(e)
-				elif (self.login_method == 'credentials'):
-					# note: this procedure doesn't work because basic authentication uni tenant doesn't support the right sign-on protocols
-					#       would be cool though...
+	def summary (self):
+		""" returns a readable overview of all changes in the plan """
+		lines = []
 
-					# first, setup a credential object based on login details
-					self.run_command(f'$User = "{self.username}"')
-					self.run_command(f'$PWord = ConvertTo-SecureString -String "{self.password}" -AsPlainText -Force')
-					self.run_command('$Credential = New-Object -TypeName System.Management.Automation.PSCredential -ArgumentList $User, $PWord')
-					
-					# use credentials to connect (avoids a user prompt)
-					response = self.run_command('Connect-MicrosoftTeams -Credential $Credential')
-			
-			# check for succesful connection
-			if (response.find('Token Acquisition finished successfully. An access token was returned')):
-				self.connected_to_teams = True
-			elif (response.find('TenantId')):  # just some string that will show only if succesful
-				self.connected_to_teams = True
+		for e in self.team_edits:
+			lines.append(f"Team {e['team_id']}: set name to '{e['name']}' and description to '{e['description']}'")
+		for c in self.channel_creates:
+			lines.append(f"Team {c['team_id']}: create {c['channel_type'].lower()} channel {c['channel_name']}")
+		for e in self.channel_edits:
+			lines.append(f"Channel {e['channel_name']}: set description to '{e['description']}'")
+		for op in self.memberships:
+			target = f"Team {op['team_id']}" if op['channel_name'] is None else f"Channel {op['channel_name']}"
+			lines.append(f"{target}: {op['action']} {op['user']['name']} ({op['user']['id']}) as {op['role']}")
+		for w in self.warnings:
+			lines.append(f'WARNING: {w}')
+
+		additions = sum(op['action'] == 'add' for op in self.memberships)
+		lines.append(f'{len(self.team_edits)} team edits, {len(self.channel_creates)} new channels, {len(self.channel_edits)} channel edits, {additions} additions, {len(self.memberships) - additions} removals')
 
-			return self.connected_to_teams
+		return '\n'.join(lines)
+
+	def to_json (self):
+		return json.dumps(asdict(self))
+
+	@classmethod
+	def from_json (cls, text):
+		return cls(**json.loads(text))
 
 
 class TeamsUpdater:
 	"""
 	Wrapper around powershell MicrosoftTeams module commands, with additional logic to keep teams and channels in sync with an external list.
 	"""
-	def __init__ (self, path=None, stafflist={}, process=None, username=None, password=None, logger=None, prevent_self_removal=True):
+	# the properties of users in Get-TeamUser and Get-TeamChannelUser output that we actually use
+	user_record_properties = ['User', 'Name', 'Role']
+
+	def __init__ (self, path=None, stafflist={}, process=None, username=None, password=None, logger=None, prevent_self_removal=True, pool_size=1, async_process=None, batch_size=0, session_socket=None, governor=None, cache=None, store=None, fingerprints=None):
 		if (logger == None):
 			self.logger = Logger()
 		else:
@@ -468,12 +2737,31 @@ class TeamsUpdater:
 		# note that the list isn't technically a list but rather a dictionary
 		# dicts have the benefit that we can match by id/key value rightaway
 		# not optimal from a neatness point of view but it works fine
-		self.user_stafflist  = {}
+		#   users are copied, so freezing these (as all users held here) leaves the ones passed in as they are
+		self.user_stafflist  = UserDict()
 		for name in stafflist:
-			self.user_stafflist[str(name.id)] = name
+			self.user_stafflist[str(name.id)] = copy.copy(name).freeze()
 
 		# master user list (idem, a dict not a list)
-		self.user_list       = {}
+		self.user_list       = UserDict()
+
+		# lookup of email addresses to user ids (see _resolve_email)
+		self._rebuild_email_index()
+
+		# compiled project_list (set on import)
+		self.course_model = CourseModel({})
+
+		# indexes for find_users, as (users, version, UserIndex) (see UserDict)
+		self.user_indexes    = {}
+		self.user_index_lock = threading.Lock()
+
+		# optional SQLiteUserStore, filled on import
+		self.store        = store
+		self.store_course = None
+
+		# optional ImportFingerprints, to work out what changed since the previous import
+		self.fingerprints = fingerprints
+		self.changeset    = None
 
 		# user ids that should not be touched as these are uni-managed service accounts
 		self.exclusion_ids = ['svco365teamsmanage']
@@ -483,13 +2771,29 @@ class TeamsUpdater:
 		self.password  = password
 
 		# assign existing external process to connect to powershell
-		self.process   = process
+		self.process          = process
+		self.process_internal = (process is None)
+
+		# attach to a running PowerShellDaemon if there is one, which saves starting powershell and logging in
+		if (self.process is None and session_socket is not None):
+			try:
+				self.process = PowerShellDaemonClient(session_socket)  # closing the client leaves the daemon running
+				self.logger.info(f'Using PowerShellDaemon at {session_socket}')
+			except OSError as e:
+				self.logger.warning(f'No PowerShellDaemon at {session_socket} ({e}), starting PowerShell instead')
 
 		if (self.process is None):
-			self.process_internal = True
-			self.process          = PowerShellWrapper(lazy_start=True, login_method='credentials', username=self.username, password=self.password)
-		else:
-			self.process_internal = False
+			# several sessions allow for updating independent channels in parallel (see `dispatch`)
+			if (pool_size > 1):
+				self.process = PowerShellPool(pool_size, lazy_start=True, login_method='credentials', username=self.username, password=self.password)
+			else:
+				self.process = PowerShellWrapper(lazy_start=True, login_method='credentials', username=self.username, password=self.password)
+
+		# the async methods use their own AsyncPowerShellWrapper, which is created on first use if not given
+		self.async_process          = async_process
+		self.async_process_internal = (async_process is None)
+		self.async_connected        = False
+		self.async_connect_lock     = None
 
 		# optionally, safeguard against self-removal
 		if (prevent_self_removal):
@@ -497,6 +2801,19 @@ class TeamsUpdater:
 				self.username = self.process.username
 			self.exclusion_ids.append( self.username.replace('@ad.unsw.edu.au','') )
 
+		# when above 0, update_team and update_channel send their changes as scripts of up to this many operations
+		#   this saves a round trip to powershell (and the Teams backend) for each and every user
+		self.batch_size = batch_size
+
+		# optionally, pace commands and retry them when Teams throttles us (True for a default RateGovernor)
+		#   with a single session (pool_size=1), this mostly helps by waiting out throttling and retrying
+		self.governor = governor
+		if (self.governor is True):
+			self.governor = RateGovernor(max_in_flight=pool_size)
+
+		# an optional MembershipCache, which saves fetching member lists (and channels) again and again
+		self.cache = cache
+
 		# temp variables
 		self.user_channel_bug_counter = 0
 	
@@ -513,6 +2830,19 @@ class TeamsUpdater:
 		else:
 			return False  # re-raise the exception to be transparent
 
+	async def __aenter__ (self):
+		""" enables the use of the `async with` statement, needed to cleanly close the async process """
+		return self
+
+	async def __aexit__ (self, type, value, traceback):
+		""" so we can exit after using the `async with` statement """
+		await self.aclose()
+
+		if (traceback is None):  # no exception occured
+			pass
+		else:
+			return False  # re-raise the exception to be transparent
+
 	def ensure_connected (self):
 		"""
 		Ensures we're connected to Teams backend whenever this method is called
@@ -531,105 +2861,352 @@ class TeamsUpdater:
 
 		return self.connected
 	
+	async def ensure_connected_async (self):
+		""" async version of `ensure_connected`, for the AsyncPowerShellWrapper used by async methods """
+		if (self.async_process is None):
+			# sharing the transcript and Teams module of the regular process, if any
+			self.async_process = AsyncPowerShellWrapper(login_method='credentials', username=self.username, password=self.password, name='async',
+				transcript=getattr(self.process, 'transcript', None), teams_module=getattr(self.process, 'teams_module', None))
+
+		# created here rather than on init, so it belongs to the event loop that is running by now
+		if (self.async_connect_lock is None):
+			self.async_connect_lock = asyncio.Lock()
+
+		# several tasks may be waiting for the connection at once, but only the first should log in
+		async with self.async_connect_lock:
+			if (self.async_connected == False):
+				self.logger.info('Connecting to Teams via AsyncPowerShellWrapper')
+				self.async_connected = await self.async_process.connect_to_teams()
+
+				if (self.async_connected):
+					self.logger.confirm('Connected to Teams')
+				else:
+					self.logger.error('Not connected to Teams. Expect trouble...')
+
+		return self.async_connected
+	
 	def close (self):
 		""" cleanup any open connections, files open """
 		if (self.process is not None and self.process_internal):
 			self.process.close()
 
-	def import_user_list (self, course_code, coordinators, project_list, tech_stream_list=None):
+		if (self.cache is not None):
+			self.cache.save()
+
+	async def aclose (self):
+		""" async version of `close`, which also closes the AsyncPowerShellWrapper """
+		if (self.async_process is not None and self.async_process_internal):
+			await self.async_process.close()
+			self.async_process = None
+
+		self.close()
+
+	def _run_steps (self, steps):
 		"""
-		Imports a user list csv file that was exported from Moodle
+		Runs the steps of an operation, like `_add_user_to_team_steps`, and returns its result.
+
+		Steps are generators that yield the keyword arguments for each `run_command` call and get sent back its response.
+		This keeps the logic of an operation in one place, as it is shared by both the regular and async methods.
 		"""
-		self.logger.info(f'Importing data from: {self.data_path}')
+		self.ensure_connected()
 
-		count_total       = 0
-		count_instructors = 0
-		count_students    = 0
-		count_unknown     = 0
+		try:
+			step = next(steps)
+			while True:
+				step = steps.send( self._run_step(step) )
+		except StopIteration as result:
+			return result.value
 
-		groups_dict       = {}  # example: {'9383': ['Students Grouping - Project X','Students Grouping (All)']}
+	def _run_step (self, step):
+		"""
+		Runs a single step, paced by the governor (if any), which also has throttled commands wait and run again.
+		Steps with `retry` set to False are not run again, as they handle throttling themselves (see `_membership_batch_steps`).
+		"""
+		step  = dict(step)
+		retry = step.pop('retry', True)
 
-		# ----- STEP 1 - IMPORT DATA ----
+		if (self.governor is None):
+			return self.process.run_command(**step)
+
+		for attempt in range(self.governor.max_retries + 1):
+			self.governor.acquire()
+			response = None
+			try:
+				response = self.process.run_command(**step)
+			finally:
+				delay = self.governor.release(response, getattr(self.process, 'latest_errors', None))
+
+			if (delay is None or not retry):
+				break
+
+			self.logger.warning(f'Throttled by Teams, trying again in {delay:.1f}s')
+
+		return response
+
+	def _run_command (self, command, **kwargs):
+		""" runs a single Teams command (with any `run_command` arguments) as a step, so it's paced by the governor as well """
+		return self._run_step(dict(kwargs, command=command))
+
+	async def _run_steps_async (self, steps):
+		""" async version of `_run_steps`, which sends commands via the AsyncPowerShellWrapper """
+		await self.ensure_connected_async()
 
-		# before importing user data, get grouping data ready for later merging
 		try:
-			with open(self.data_path.replace('.csv', '_groupings.json'), 'r') as fg:
-				groups_dict = json.loads( fg.read() )
-		except FileNotFoundError as e:
-			self.logger.error(e)
-		
-		# open and read CSV file - assumes existence of columns named Username (for zID), First Name, Surname, and a few more
-		with open(self.data_path) as fs:
-			filereader = csv.DictReader(fs)
+			step = next(steps)
+			while True:
+				step = steps.send( await self._run_step_async(step) )
+		except StopIteration as result:
+			return result.value
+
+	async def _run_step_async (self, step):
+		""" async version of `_run_step` """
+		step  = dict(step)
+		retry = step.pop('retry', True)
+
+		if (self.governor is None):
+			return await self.async_process.run_command(**step)
+
+		for attempt in range(self.governor.max_retries + 1):
+			await self.governor.acquire_async()
+			response = None
+			try:
+				response = await self.async_process.run_command(**step)
+			finally:
+				delay = self.governor.release(response, getattr(self.async_process, 'latest_errors', None))
+
+			if (delay is None or not retry):
+				break
+
+			self.logger.warning(f'Throttled by Teams, trying again in {delay:.1f}s')
+
+		return response
+
+	def dispatch (self, tasks):
+		"""
+		Runs a list of independent tasks and returns their results in the same order.
+		Tasks are callables without arguments, for example `functools.partial(self.update_channel, ...)`.
+
+		With a PowerShellPool, tasks run in parallel on separate sessions, otherwise one after another.
+		As tasks may run in any order, keep operations that depend on each other (like syncing owners and
+		then members of the same channel) within a single task.
+		"""
+		self.ensure_connected()
+
+		if (hasattr(self.process, 'map')):
+			return self.process.map(lambda task: task(), tasks)
+		else:
+			return [task() for task in tasks]
+
+	def read_user_csv (self, course_code, path=None, groups_dict=None, follow=False, fingerprints=None, previous=None):
+		"""
+		Reads a user list csv file exported from Moodle, yielding a User for every row
+		The header is checked once to find the relevant columns, and rows are read one at a time, so memory use stays
+		flat for large files. With `follow`, a file that is still being downloaded is read as it comes in (see
+		`MoodleUpdater.get_users_csv`).
+
+		  groups_dict  : (optional) dict of group name -> list of grouping names
+		  fingerprints : (optional) ImportFingerprints to add each row to (after calling its `start`)
+		  previous     : (optional) dict of users from the previous import, which are yielded as they are if their row is unchanged
+		                 (these are frozen already, unlike newly read users, see User.freeze)
+		"""
+		if (path is None):
+			path = self.data_path
+		if (groups_dict is None):
+			groups_dict = {}
+
+		def _get (row, column):
+			# short rows are padded with None, as csv.DictReader does
+			return row[column] if (column < len(row)) else None
+
+		with contextlib.ExitStack() as stack:
+			if (follow):
+				lines = stack.enter_context(contextlib.closing(follow_download(path)))
+			else:
+				lines = stack.enter_context(open(path))
+
+			filereader = csv.reader(lines)
+			header     = next(filereader, None)
+			if (header is None):
+				return
+
+			columns = {name: index for index, name in enumerate(header)}
+
+			# number of groups shown in Moodle export varies depending on number of groups in use (Group1, Group2, ...)
+			group_columns = []
+			while (f'Group{len(group_columns) + 1}' in columns):
+				group_columns.append(columns[f'Group{len(group_columns) + 1}'])
+
+			username_column  = columns['Username']
+			first_column     = columns['First name']
+			surname_column   = columns['Surname']
+			email_column     = columns['Email address']
+			class_id_column  = columns['Class ID']
 
 			# for every user (a row in csv file), add them to the known class lists
-			for user in filereader:
-				user_id = user['Username'].lower()  # make sure it's all lowercase, for later comparisons
+			for row in filereader:
+				# blank lines come through as empty rows (csv.DictReader skipped these)
+				if (not row):
+					continue
+
+				user_id = row[username_column].lower()  # make sure it's all lowercase, for later comparisons
+
+				if (fingerprints is not None):
+					row_hash = fingerprints.row_hash(row)
+
+					# no need to parse unchanged rows again
+					if (previous is not None and user_id in previous and fingerprints.unchanged(user_id, row_hash)):
+						fingerprints.add(user_id, row_hash, previous[user_id])
+						yield previous[user_id]
+						continue
 
 				# parse class IDs and convert comma-separated field to a list of int values
 				class_ids = []
-				if (user['Class ID'] != '-'):
-					class_ids = list(map(int, user['Class ID'].split(',')))
+				if (row[class_id_column] != '-'):
+					class_ids = list(map(int, row[class_id_column].split(',')))
 
 				# parse groups and groupings
 				user_groups    = []
 				user_groupings = []
 
-				try:
-					for n in range(1,100):
-						g = user[f'Group{n}']
-						# empty values are represented as float(nan) but we only care about strings anyway, so just test for that
-						if (g is not None and type(g) is str and len(g) > 0):
-							user_groups.append(g)
-
-							# find groupings that incorporate this group
-							if (g in groups_dict):
-								for grouping in groups_dict[g]:
-									if (grouping not in user_groupings):
-										user_groupings.append(grouping)
-				except KeyError:
-					# number of groups shown in Moodle export varies depending on number of groups in use
-					# so we attempted to range over a large number and fail at some point -> expected, so we can ignore it
-					pass
+				for column in group_columns:
+					g = _get(row, column)
+					if (g):
+						user_groups.append(g)
+
+						# find groupings that incorporate this group
+						for grouping in groups_dict.get(g, []):
+							if (grouping not in user_groupings):
+								user_groupings.append(grouping)
 
 				# create User class from compiled info
 				new_user = User(
 					user_id,
-					user['First name'] + ' ' + user['Surname'],
+					row[first_column] + ' ' + row[surname_column],
 					course_code,
 					class_ids,
 					user_groups,
 					user_groupings,
-					user['Email address']
+					row[email_column]
 				)
 
-				# users without classes assigned get added to the stafflist
-				# in Moodle, no ClassID means the user is staff or a student halfway through unenrolment
-				if (user['Class ID'] == '-'):
-					# do a check to make sure this user is actually staff
-					#   adding a user to this group requires manual assignment in Moodle
-					#   as an alternative, you can add them into the user stafflist passed in at the start
-					if (new_user.in_group('Staff (DO NOT REMOVE)')):
-						new_user.owner = True
+				if (fingerprints is not None):
+					fingerprints.add(user_id, row_hash, new_user)
 
-						# don't overwrite prior stafflist user data
-						if (user_id not in self.user_stafflist):
-							self.user_stafflist[user_id] = new_user
+				yield new_user
 
-						count_instructors += 1
-					else:
-						self.logger.log(f'User {new_user} has no Class IDs but is not a staff member: skipped.', 'WARNING')
-						count_unknown += 1
+	def import_user_list (self, course_code, coordinators, project_list, tech_stream_list=None, follow=False):
+		"""
+		Imports a user list csv file that was exported from Moodle
+		With `follow`, the file is imported while it's still being downloaded (see `read_user_csv`)
+		"""
+		self.logger.info(f'Importing data from: {self.data_path}')
+
+		# get powershell and the Teams module loading in the background while we're busy parsing
+		if (hasattr(self.process, 'ensure_started')):
+			self.process.ensure_started(wait=False, modules=['MicrosoftTeams'])
+
+		count_total       = 0
+		count_instructors = 0
+		count_students    = 0
+		count_unknown     = 0
+
+		groups_dict       = {}  # example: {'9383': ['Students Grouping - Project X','Students Grouping (All)']}
+
+		imported_ids      = {}  # students in this import (a dict, to keep these unique and in order)
+		pool              = {}  # strings and tuples shared between users, see User.freeze
+
+		# ----- STEP 1 - IMPORT DATA ----
+
+		# before importing user data, get grouping data ready for later merging
+		try:
+			with open(self.data_path.replace('.csv', '_groupings.json'), 'r') as fg:
+				groups_dict = json.loads( fg.read() )
+		except FileNotFoundError as e:
+			self.logger.error(e)
+		
+		# with fingerprints, students whose rows didn't change since the previous import are reused as they are
+		previous     = None
+		reused_ids   = {}
+		staff_before = set(self.user_stafflist)
+
+		# users are parsed differently if anything else than their row changes, including who's staff
+		def _context ():
+			return self.fingerprints.context_hash(course_code, coordinators, project_list, tech_stream_list, groups_dict, sorted(self.user_stafflist))
+
+		if (self.fingerprints is not None):
+			self.fingerprints.start(_context())
+
+			if (not self.fingerprints.context_changed()):
+				previous = self.user_list
+
+		# read CSV file one user at a time - assumes existence of columns named Username (for zID), First Name, Surname, and a few more
+		for new_user in self.read_user_csv(course_code, groups_dict=groups_dict, follow=follow, fingerprints=self.fingerprints, previous=previous):
+			user_id = new_user.id
+
+			# unchanged since the previous import, so complete already
+			if (previous is not None and previous.get(user_id) is new_user):
+				reused_ids[user_id] = True
+				count_students += 1
+				continue
+
+			# users without classes assigned get added to the stafflist
+			# in Moodle, no ClassID means the user is staff or a student halfway through unenrolment
+			if (len(new_user.class_ids) == 0):
+				# do a check to make sure this user is actually staff
+				#   adding a user to this group requires manual assignment in Moodle
+				#   as an alternative, you can add them into the user stafflist passed in at the start
+				if (new_user.in_group('Staff (DO NOT REMOVE)')):
+					new_user.owner = True
+
+					# don't overwrite prior stafflist user data
+					if (user_id not in self.user_stafflist):
+						self.user_stafflist[user_id] = new_user.freeze(pool)
+
+					count_instructors += 1
 				else:
-					# add new to master list
-					self.user_list[user_id] = new_user
+					self.logger.log(f'User {new_user} has no Class IDs but is not a staff member: skipped.', 'WARNING')
+					count_unknown += 1
+			else:
+				# add new to master list
+				self.user_list[user_id] = new_user
+				imported_ids[user_id] = True
+
+				count_students += 1
+
+		if (self.fingerprints is not None):
+			self.changeset = self.fingerprints.finish(_context())
+
+			# students missing from this import are no longer part of the course (unenrolled), and neither are students
+			#   whose row lost its class ids (halfway through unenrolment), as these weren't added to the master list again
+			for user_id in [u for u in self.user_list if u not in imported_ids and u not in reused_ids]:
+				del self.user_list[user_id]
 
-					count_students += 1
+			# reused students may have mentors among staff that are new, so these need parsing again
+			if (set(self.user_stafflist) != staff_before):
+				for sid in reused_ids:
+					s = self.user_list[sid]
+					self.user_list[sid] = User(s.id, s.name, s.course_code, list(s.class_ids), list(s.groups), list(s.groupings), s.email)
+					imported_ids[sid] = True
+
+			self.logger.info(f'Changes since previous import: {self.changeset.summary()}')
+
+		# catch up the email lookup with all imported users
+		self._rebuild_email_index()
 
 		# ----- STEP 2 - ADDITIONAL PARSING -----
 
+		# staff names are looked up for every mentor group, so index these once
+		staff_names = self._staff_name_index()
+
+		# idem for classes, which are looked up by class id
+		self.course_model = CourseModel(project_list)
+
+		# and group names, which are shared by many students
+		groups = GroupParser(tech_streams=(tech_stream_list is not None))
+
 		# do additional parsing on users to extract useful data
-		for sid in self.user_list:
+		#   (users from any earlier import are done already)
+		for sid in imported_ids:
 			s = self.user_list[sid]
 
 			# avoid including staff (who have no class ids) and partially unenrolled students (also no class ids)
@@ -643,100 +3220,48 @@ class TeamsUpdater:
 
 			# loop over all groups to extract useful info
 			for g in s.groups:
+				group = groups.parse(g)
 
-				# --- class ID-based matching below (fits most courses)
-				
-				if ( g.isdigit() ):
-					# find the relevant project
-					for pkey in project_list:
-						p = project_list[pkey]
-						
+				if (group.class_id is not None):
+					# find the relevant project and classes
+					for cl in self.course_model.find_classes(group.class_id):
 						# main_class_id may not exists for courses where it's irrelevant
-						if ('main_class_id' in p and p['main_class_id'] == int(g)):
-							s.project = pkey
-							# if matching project is found, no need to continue the for loop trying other projects
-							break
-						elif ('classes' in p):
-							for cl in p['classes']:
-								if (cl['class_id'] == int(g)):
-									# lectures are not included as classes
-									if (cl['name'].find('LE') != -1):
-										pass
-									# labs are handled separately from regular classes
-									elif (cl['name'].find('LAB') != -1):
-										s.tech_stream += f"{cl['name']}_{cl['class_id']}  [ {cl['description']} ]"
-										
-										# add demonstrator info
-										for did in cl['instructors']:
-											# ensure there is indeed data on a listed demonstrator
-											if (did in self.user_stafflist):
-												s.tech_stream_mentors.append(did)
-									# regular classes
-									else:
-										s.classes.append(f"{cl['name']}_{cl['class_id']}  [ {cl['description']} ]")
-										
-										# add demonstrator info
-										for did in cl['instructors']:
-											# ensure there is indeed data on a listed demonstrator
-											if (did in self.user_stafflist):
-												s.project_mentors.append(did)
-
-				# --- group name based matching below (fits ENGG1000 best)
-
-				# TODO generalise to allow other terms than 'Project'
-				if (g.find('Project Group - ') != -1):
-					s.project = re.sub(
-						r'Project Group - (?P<project>.+?)',  # original   # include \(.+?\) at end to catch (Online|On Campus)
-						r'\g<project>',  # replacement
-						g  # source string
-					)
-
-				# TODO generalise term 'Mentor' or allow 'Demonstrator' as well
-				if (g.find('Project') != -1 and g.find('Mentor') != -1):
-					pmentor = re.sub(
-						r'Project (?P<project>.+?) (- ){0,1}Mentor (?P<mentor>.+?)',
-						r'\g<mentor>',
-						g
-					)
-					# funky whitespaces can throw us further down
-					pmentor = pmentor.replace(' ', ' ')  # these two 'whitespaces' are not the same...
-
-					# find ID based on name
-					for su in self.user_stafflist:
-						mu = self.user_stafflist[su]
-
-						# match against lower case to avoid minor spelling issues to cause mismatches
-						if (mu.name.lower() == pmentor.lower()):
-							s.project_mentors.append(mu.id)
-
-				# extract tech stream data
-				if (tech_stream_list is not None):
-					if (g.find('Technical Stream Group - ') != -1):
-						s.tech_stream = g.replace('Technical Stream Group - ','').replace(' (OnCampus)','').replace(' (Online)','')
-
-					if (g.find('Technical Stream') != -1 and g.find('Mentor') != -1):
-						tmentor = re.sub(
-							r'Technical Stream (?P<stream>.+?) (- ){0,1}Mentor (?P<mentor>.+?)',
-							r'\g<mentor>',
-							g
-						)
-						# funky whitespaces can throw us further down
-						tmentor = tmentor.replace(' ', ' ')  # these two 'whitespaces' are not the same...
-
-						# find ID based on name
-						if (tmentor != '-'):
-							for su in self.user_stafflist:
-								mu = self.user_stafflist[su]
-
-								# match against lower case to avoid minor spelling issues to cause mismatches
-								if (mu.name.lower() == tmentor.lower()):
-									s.tech_stream_mentors.append(mu.id)
-
-				# --- common matching continues below
-				
-				# find project team
-				if (g.lower().find('team') != -1 and g.lower().find('stream') == -1):
-					s.project_team = g.replace('Project ','').replace('Student Teams - ','')
+						if (cl.kind == 'main'):
+							s.project = cl.stream
+						# labs are handled separately from regular classes
+						elif (cl.kind == 'lab'):
+							s.tech_stream += cl.label()
+							
+							# add demonstrator info
+							for did in cl.instructors:
+								# ensure there is indeed data on a listed demonstrator
+								if (did in self.user_stafflist):
+									s.tech_stream_mentors.append(did)
+						# regular classes (lectures are not included as classes)
+						elif (cl.kind == 'class'):
+							s.classes.append(cl.label())
+							
+							# add demonstrator info
+							for did in cl.instructors:
+								# ensure there is indeed data on a listed demonstrator
+								if (did in self.user_stafflist):
+									s.project_mentors.append(did)
+
+				if (group.project is not None):
+					s.project = group.project
+
+				# find mentor IDs based on name
+				if (group.project_mentor is not None):
+					s.project_mentors += staff_names.get(group.project_mentor, [])
+
+				if (group.tech_stream is not None):
+					s.tech_stream = group.tech_stream
+
+				if (group.tech_stream_mentor is not None):
+					s.tech_stream_mentors += staff_names.get(group.tech_stream_mentor, [])
+
+				if (group.project_team is not None):
+					s.project_team = group.project_team
 			
 			# --- below we assume project and streams have been found
 
@@ -746,9 +3271,70 @@ class TeamsUpdater:
 			if (tech_stream_list is not None and len(s.tech_stream) > 0):
 				s.tech_stream_coordinators = tech_stream_list[s.tech_stream]['coordinators']
 
+		# students are complete now, so save some memory
+		for sid in imported_ids:
+			self.user_list[sid].freeze(pool)
+
+		# users have changed, so indexes need to be rebuilt
+		self.user_indexes = {}
+
+		if (self.store is not None):
+			self.store.add_users(course_code, self.user_stafflist, staff=True)
+			self.store.add_users(course_code, self.user_list)
+			self.store_course = course_code
+
 		count_total = count_students + count_instructors + count_unknown
 		self.logger.log(f'Imported data on {count_total} users (students: {count_students}, instructors: {count_instructors}, unknown: {count_unknown}).\n\n')
 
+		return self.changeset
+
+	def _student_rows (self):
+		""" returns the rows of a student list export from the master list (see `SQLiteUserStore.student_rows` for the format) """
+
+		""" internal parse function to go from user_id to name and email """
+		def _parse_ids_to_names_emails (id_list):
+			ids    = '-'
+			names  = '-'
+			emails = '-'
+
+			if (len(id_list) > 0):
+				ids = ','.join(id_list)
+				names  = []
+				emails = []
+
+				for index, c in enumerate(id_list):
+					if c in self.user_stafflist:
+						names.append(  self.user_stafflist[c].name  )
+						emails.append( self.user_stafflist[c].email )
+					else:
+						names.append(  'Unknown staff'    )
+						emails.append( f'{c}@unsw.edu.au' )
+
+				names  = ', '.join(names)
+				emails = ', '.join(emails)
+
+			return ids, names, emails
+
+		for sid in self.user_list:
+			s = self.user_list[sid]
+
+			# avoid including staff (who have no class ids) and partially unenrolled students (also no class ids)
+			if (len(s.class_ids) == 0):
+				continue
+
+			yield {
+				'id'          : s.id,
+				'name'        : s.name,
+				'email'       : s.email,
+				'course_code' : s.course_code,
+				'project'     : s.project,
+				'project_team': s.project_team,
+				'tech_stream' : s.tech_stream,
+				'class_ids'   : ','.join(map(str, s.class_ids)),
+				'classes'     : ','.join(s.classes),
+				'staff'       : [_parse_ids_to_names_emails(s[relation]) for relation in SQLiteUserStore.relations]
+			}
+
 	def export_student_list (self, replace_terms=None):
 		""" Exports a list of students using User class information """
 
@@ -767,44 +3353,19 @@ class TeamsUpdater:
 					header = header.replace('Tech stream', replace_terms['Tech stream'])
 			f.write(header)
 
-			""" internal parse function to go from user_id to name and email """
-			def _parse_ids_to_names_emails (id_list):
-				ids    = '-'
-				names  = '-'
-				emails = '-'
-
-				if (len(id_list) > 0):
-					ids = ','.join(id_list)
-					names  = []
-					emails = []
-
-					for index, c in enumerate(id_list):
-						if c in self.user_stafflist:
-							names.append(  self.user_stafflist[c].name  )
-							emails.append( self.user_stafflist[c].email )
-						else:
-							names.append(  'Unknown staff'    )
-							emails.append( f'{c}@unsw.edu.au' )
-
-				return ids, ', '.join(names), ', '.join(emails)
-			
-			# iterate over all students
-			for sid in self.user_list:
-				s = self.user_list[sid]
-
-				# avoid including staff (who have no class ids) and partially unenrolled students (also no class ids)
-				if (len(s.class_ids) == 0):
-					continue
+			# with a store, all data is joined in a single query
+			if (self.store is not None and self.store_course is not None):
+				rows = self.store.student_rows(self.store_course)
+			else:
+				rows = self._student_rows()
 
+			# iterate over all students
+			for s in rows:
 				# fill in staff info
-				ccoordinator_id, ccoordinator, ccoordinator_em = _parse_ids_to_names_emails(s.course_coordinators)
-				pcoordinator_id, pcoordinator, pcoordinator_em = _parse_ids_to_names_emails(s.project_coordinators)
-				pmentor_id, pmentor, pmentor_em                = _parse_ids_to_names_emails(s.project_mentors)
-				tcoordinator_id, tcoordinator, tcoordinator_em = _parse_ids_to_names_emails(s.tech_stream_coordinators)
-				tmentor_id, tmentor, tmentor_em                = _parse_ids_to_names_emails(s.tech_stream_mentors)
+				(ccoordinator_id, ccoordinator, ccoordinator_em), (pcoordinator_id, pcoordinator, pcoordinator_em), (pmentor_id, pmentor, pmentor_em), (tcoordinator_id, tcoordinator, tcoordinator_em), (tmentor_id, tmentor, tmentor_em) = s['staff']
 
 				# finally, write output for this student
-				f.write(f'\n{s.id},{s.name},{s.email},"{",".join(map(str,s.class_ids))}",{s.course_code},"{ccoordinator}","{ccoordinator_id}","{ccoordinator_em}",{s.project},"{pcoordinator}","{pcoordinator_id}","{pcoordinator_em}","{",".join(s.classes)}","{pmentor}","{pmentor_id}","{pmentor_em}","{s.project_team}","{s.tech_stream}","{tcoordinator}","{tcoordinator_id}","{tcoordinator_em}","{tmentor}","{tmentor_id}","{tmentor_em}"')
+				f.write(f'\n{s["id"]},{s["name"]},{s["email"]},"{s["class_ids"]}",{s["course_code"]},"{ccoordinator}","{ccoordinator_id}","{ccoordinator_em}",{s["project"]},"{pcoordinator}","{pcoordinator_id}","{pcoordinator_em}","{s["classes"]}","{pmentor}","{pmentor_id}","{pmentor_em}","{s["project_team"]}","{s["tech_stream"]}","{tcoordinator}","{tcoordinator_id}","{tcoordinator_em}","{tmentor}","{tmentor_id}","{tmentor_em}"')
 
 			self.logger.log(f'Exported student list to {output_path}\n\n')
 
@@ -841,7 +3402,7 @@ class TeamsUpdater:
 		""" Get basic team info """
 		self.ensure_connected()
 
-		response = self.process.run_command(
+		response = self._run_command(
 			f'Get-Team -GroupId {team_id}',
 			convert_json = True
 		)
@@ -870,11 +3431,11 @@ class TeamsUpdater:
 		
 		# TODO improve this by using convert_json = True to get team object in one go
 		# create team
-		response = self.process.run_command(
+		response = self._run_command(
 			f'$group = New-Team -DisplayName "{name}" -Description "{description}" -Visibility {visibility}{template_param}'
 		)
 		# parse response in 2nd step (returns a Group object with GroupID for the newly created team)
-		response_group_id = self.process.run_command('$group.GroupId')
+		response_group_id = self._run_command('$group.GroupId')
 		
 		# check for correct group_id format: 458b02e9-dea0-4f74-8e09-93e95f93b473
 		if (not re.match('^[\dabcdef-]{36}$', response_group_id)):
@@ -901,7 +3462,7 @@ class TeamsUpdater:
 			desc = f' -Description "{description}"'
 
 		# edit team
-		response = self.process.run_command(
+		response = self._run_command(
 			f'Set-Team -GroupId {team_id}{name}{desc}'
 		)
 
@@ -919,7 +3480,7 @@ class TeamsUpdater:
 			return False
 
 		# edit team
-		response = self.process.run_command(
+		response = self._run_command(
 			f'Set-TeamPicture -GroupId {team_id} -ImagePath {image_path}'
 		)
 
@@ -927,20 +3488,33 @@ class TeamsUpdater:
 
 		self.logger.log(f'Updated Team picture for {team_id}')
 
-	def get_team_user_list (self, team_id, role='All'):
+	def get_team_user_list (self, team_id, role='All', refresh=False):
 		"""
 		Get list of current users in team
+		With a cache, a cached list is returned unless `refresh` is True.
 		"""
-		self.ensure_connected()
+		return self._run_steps(self._get_team_user_list_steps(team_id, role, refresh))
+
+	async def get_team_user_list_async (self, team_id, role='All', refresh=False):
+		""" async version of `get_team_user_list` """
+		return await self._run_steps_async(self._get_team_user_list_steps(team_id, role, refresh))
+
+	def _get_team_user_list_steps (self, team_id, role='All', refresh=False):
+		""" steps for `get_team_user_list` (see `_run_steps`) """
+		if (self.cache is not None and not refresh):
+			user_list = self.cache.get_users(MembershipCache.team_key(team_id, role))
+			if (user_list is not None):
+				self.logger.info(f'Using cached user list for Team {team_id}')
+				return user_list
 
 		role_filter = ''
 		if (role != 'All'):
 			role_filter = f' -Role {role}'
 		
-		response = self.process.run_command(
-			f'Get-TeamUser -GroupId {team_id}{role_filter}',
-			convert_json = True
-		)
+		response = yield {
+			'command'     : f'Get-TeamUser -GroupId {team_id}{role_filter}',
+			'json_records': self.user_record_properties
+		}
 
 		# parse response
 		
@@ -955,10 +3529,72 @@ class TeamsUpdater:
 			# feed response data into list
 			user_list = self._parse_response_users(response, team_id, print_users=True)
 
+			if (self.cache is not None):
+				self.cache.set_users(MembershipCache.team_key(team_id, role), user_list)
+
 			return user_list
 
+	@staticmethod
+	def _name_key (name):
+		"""
+		normalises a name for lookups, so funky whitespace (e.g. non-breaking spaces from Moodle) and case don't cause mismatches
+		"""
+		return ' '.join(unicodedata.normalize('NFKC', name).split()).casefold()
+
+	def _staff_name_index (self):
+		""" returns a dict of normalised staff names with a list of matching staff ids each """
+		index = {}
+
+		for user_id, user in self.user_stafflist.items():
+			index.setdefault(self._name_key(user.name), []).append(user.id)
+
+		return index
+
+	@staticmethod
+	def _email_key (email):
+		""" normalises an email address or UPN for lookups, e.g. 'F.Somename@ad.unsw.edu.au' -> 'f.somename' """
+		return email.strip().lower().replace('@ad.unsw.edu.au', '')
+
+	def _rebuild_email_index (self):
+		"""
+		indexes the email addresses of all known users, so these can be resolved to user ids without a search
+		the first user with an address wins, as it would when searching through the list
+		"""
+		index = {'staff': {}, 'users': {}}
+
+		for key, users in (('staff', self.user_stafflist), ('users', self.user_list)):
+			for user_id, user in users.items():
+				if (user.email):
+					index[key].setdefault(self._email_key(user.email), user_id)
+
+		self.email_index       = index
+		self.email_index_size  = (len(self.user_stafflist), len(self.user_list))
+		self.unresolved_emails = set()
+
+	def _resolve_email (self, email):
+		""" returns the user id for an email address or UPN (stafflist first, then the master list), or None if unknown """
+		# users may have been added since the index was built, in which case it needs to catch up
+		if (self.email_index_size != (len(self.user_stafflist), len(self.user_list))):
+			self._rebuild_email_index()
+
+		key = self._email_key(email)
+
+		# don't bother looking up addresses that weren't found before
+		if (key in self.unresolved_emails):
+			return None
+
+		user_id = self.email_index['staff'].get(key) or self.email_index['users'].get(key)
+
+		if (user_id is None):
+			self.unresolved_emails.add(key)
+
+		return user_id
+
 	def _parse_response_users (self, response_data, set_name, print_users=False):
-		""" internal method for parsing Teams json.parsed response data """
+		"""
+		internal method for parsing Teams json.parsed response data
+		takes any iterable of user records, so records can be handled as they arrive (see `PowerShellWrapper.iter_json_records`)
+		"""
 		user_list     = {}
 		response_data = response_data
 
@@ -974,16 +3610,7 @@ class TeamsUpdater:
 			#   if so, we'd need to do a lookup (f.somename -> z1234567) as sending commands and
 			#   everything else still relies on user IDs being submitted
 			if (not re.match('^z[\d]{7}$', userid)):
-				# try stafflist first
-				for uw in self.user_stafflist:
-					if (self.user_stafflist[uw]['email'].replace('@ad.unsw.edu.au','') == userid):
-						userid = uw
-						break
-				# then try the regular userlist
-				for ul in self.user_list:
-					if (self.user_list[ul]['email'].replace('@ad.unsw.edu.au','') == userid):
-						userid = ul
-						break
+				userid = self._resolve_email(userid) or userid
 
 			# check userid again, if we haven't resolved the lookup, this user is skipped
 			#   note that we won't be able to properly handle any user unknown to whichever source list
@@ -1001,7 +3628,7 @@ class TeamsUpdater:
 				[],         # unknown groupings
 				d['User']
 				# TODO include role data?
-			)
+			).freeze()
 
 		if (print_users):
 			print(f'USER LIST for {set_name}')
@@ -1017,28 +3644,17 @@ class TeamsUpdater:
 
 	def remove_user_from_team (self, team_id, user=User, role='Member'):
 		""" Removing a user as role='Owner' keeps them as a team member """
-		self.ensure_connected()
+		return self._run_steps(self._remove_user_from_team_steps(team_id, user, role))
 
+	def _remove_user_from_team_steps (self, team_id, user=User, role='Member'):
+		""" steps for `remove_user_from_team` (see `_run_steps`) """
 		# skip the uni-added service accounts
 		if (user.id in self.exclusion_ids):
 			return False
 
-		response = self.process.run_command(
-			f'Remove-TeamUser -GroupId {team_id} -User {user.id}@ad.unsw.edu.au -Role {role}'
-		)
-
-		success = True
-
-		# TODO check response
-		#Remove-TeamUser: Error occurred while executing 
-		#Remove-TeamUser: Last owner cannot be removed from the team
-		if (len(response) == 0):
-			self.logger.info(f'Team {team_id}: Removed {user} as {role}')
-		else:
-			success = False
-			self.logger.error(f'Team {team_id}: Could not remove {user} as {role}')
+		response = yield {'command': f'Remove-TeamUser -GroupId {team_id} -User {user.id}@ad.unsw.edu.au -Role {role}'}
 
-		return success
+		return self._log_membership_outcome(self._membership_operation('remove', team_id, None, user, role), response)
 
 	def add_users_to_team (self, team_id, users=[User], role='Member'):
 		""" Convenience function to add a list of users in one go """
@@ -1047,77 +3663,53 @@ class TeamsUpdater:
 
 	def add_user_to_team (self, team_id, user=User, role='Member'):
 		""" Adds a user to the team. Add an existing member as an `Owner` to elevate their role. """
-		self.ensure_connected()
+		return self._run_steps(self._add_user_to_team_steps(team_id, user, role))
 
+	def _add_user_to_team_steps (self, team_id, user=User, role='Member'):
+		""" steps for `add_user_to_team` (see `_run_steps`) """
 		# skip the uni-added service accounts
 		if (user.id in self.exclusion_ids):
 			return False
 
-		response = self.process.run_command(
-			f'Add-TeamUser -GroupId {team_id} -User {user.id}@ad.unsw.edu.au -Role {role}'
-		)
-
-		# TODO check response
-		success = True
-		#Request_ResourceNotFound
-		if (len(response) == 0):
-			self.logger.info(f'Team {team_id}: Added {user} as {role}')
-		else:
-			success = False
-			self.logger.error(f'Team {team_id}: Could not add {user} as {role}')
+		response = yield {'command': f'Add-TeamUser -GroupId {team_id} -User {user.id}@ad.unsw.edu.au -Role {role}'}
 
-		return success
+		return self._log_membership_outcome(self._membership_operation('add', team_id, None, user, role), response)
 
-	def update_team (self, team_id, desired_user_list, team_user_list=None, role='All', remove_allowed=True):
+	def update_team (self, team_id, desired_user_list, team_user_list=None, role='All', remove_allowed=True, refresh=False):
 		""" Sync team membership by comparing `desired_user_list` with `channel_user_list` (latter will be fetched if not specified) """
-		self.ensure_connected()
+		return self._run_steps(self._update_team_steps(team_id, desired_user_list, team_user_list, role, remove_allowed, refresh))
 
-		count_removed = 0
-		count_added   = 0
+	async def update_team_async (self, team_id, desired_user_list, team_user_list=None, role='All', remove_allowed=True, refresh=False):
+		""" async version of `update_team` """
+		return await self._run_steps_async(self._update_team_steps(team_id, desired_user_list, team_user_list, role, remove_allowed, refresh))
 
+	def _update_team_steps (self, team_id, desired_user_list, team_user_list=None, role='All', remove_allowed=True, refresh=False):
+		""" steps for `update_team` (see `_run_steps`) """
 		desired_user_list = self.ensure_dict(desired_user_list)
 		team_user_list    = self.ensure_dict(team_user_list)
 
 		if (team_user_list is None):
 			# get the team user list
-			team_user_list = self.get_team_user_list(team_id, role)
+			team_user_list = yield from self._get_team_user_list_steps(team_id, role, refresh)
 
-		# check current teams list against desired list
-		#	remove any not on desired list
-		for user_in_teams_list in team_user_list:
-			# skip the uni-added service accounts
-			if (user_in_teams_list in self.exclusion_ids): 
-				continue
+		removals, additions = self._membership_changes(team_id, None, desired_user_list, team_user_list, role, remove_allowed)
 
-			if (user_in_teams_list not in desired_user_list):
-				# no role is indicated, so removal should remove the user rather than demote them from owner to member
-				if (remove_allowed):
-					response = self.remove_user_from_team(team_id, team_user_list[user_in_teams_list])
-					
-					if (response):
-						count_removed += 1
-				else:
-					self.logger.info(f'Team {team_id}: Skipped removing {team_user_list[user_in_teams_list]} as {role}')
-				
-		# add any not in teams list but on desired list
-		for user_in_desired_list in desired_user_list:
-			if (user_in_desired_list not in team_user_list):
-				if (role == 'All'):
-					# follow User role
-					response = self.add_user_to_team(team_id, desired_user_list[user_in_desired_list], role=desired_user_list[user_in_desired_list].role())
-				else:
-					# follow the generic role indicated
-					response = self.add_user_to_team(team_id, desired_user_list[user_in_desired_list], role)
-				
-				if (response):
-					count_added += 1
+		results = yield from self._membership_steps(removals + additions)
+
+		count_removed = sum(results[:len(removals)])
+		count_added   = sum(results[len(removals):])
 
 		self.logger.info(f'Updating team {team_id} complete (- {count_removed} / + {count_added})')
 
 		return (count_removed, count_added)
 
-	def get_channels (self, team_id, channel_type=None):
-		""" Get all the channels for a team """
+	def get_channels (self, team_id, channel_type=None, refresh=False):
+		""" Get all the channels for a team (from the cache, if any, unless `refresh` is True) """
+		if (self.cache is not None and not refresh):
+			all_channels = self.cache.get(MembershipCache.channels_key(team_id, channel_type))
+			if (all_channels is not None):
+				return all_channels
+
 		self.ensure_connected()
 
 		mtype = ''
@@ -1125,7 +3717,7 @@ class TeamsUpdater:
 			mtype = f' -MembershipType {channel_type}'  # Standard|Private
 
 		# create channel
-		response = self.process.run_command(
+		response = self._run_command(
 			f'Get-TeamChannel -GroupId {team_id}{mtype}',
 			convert_json = True
 		)
@@ -1141,6 +3733,9 @@ class TeamsUpdater:
 
 		self.logger.info(f'Got {len(all_channels)} channels in Team {team_id}')
 
+		if (self.cache is not None):
+			self.cache.set(MembershipCache.channels_key(team_id, channel_type), all_channels)
+
 		return all_channels
 
 	def create_channel (self, team_id, channel_name, channel_type='Standard', description=None):
@@ -1159,11 +3754,14 @@ class TeamsUpdater:
 			ctype = 'Standard'
 
 		# create channel
-		response = self.process.run_command(
+		response = self._run_command(
 			f'New-TeamChannel -GroupId {team_id} -DisplayName "{channel_name}" -MembershipType {ctype}{desc}',
 			convert_json = True
 		)
 
+		if (self.cache is not None):
+			self.cache.invalidate(MembershipCache.channels_key(team_id, ''))  # as a prefix, this matches all channel lists of this team
+
 		# parse response
 		if (response.find('Error occurred while executing') == -1):
 			self.logger.info(f'Created channel {channel_name} in Team {team_id}')
@@ -1191,10 +3789,14 @@ class TeamsUpdater:
 			desc = f' -Description "{description}"'
 
 		# edit channel
-		response = self.process.run_command(
+		response = self._run_command(
 			f'Set-TeamChannel -GroupId {team_id} -CurrentDisplayName "{channel_name}" {new_name}{desc}'
 		)
 
+		if (self.cache is not None):
+			self.cache.invalidate(MembershipCache.channels_key(team_id, ''))
+			self.cache.invalidate(MembershipCache.channel_key(team_id, channel_name, ''))
+
 		# TODO parse response
 		#Set-TeamChannel: Channel not found
 
@@ -1207,19 +3809,31 @@ class TeamsUpdater:
 			channels_user_lists[ch.name] = self.get_channel_user_list(ch.team_id, ch.name, role=role)
 		return channels_user_lists
 
-	def get_channel_user_list (self, team_id, channel_name, role='All'):
-		""" Get list of current users in channel, and return a dict with user ids as the keys """
-		self.ensure_connected()
+	def get_channel_user_list (self, team_id, channel_name, role='All', refresh=False):
+		""" Get list of current users in channel, and return a dict with user ids as the keys (from the cache, if any, unless `refresh` is True) """
+		return self._run_steps(self._get_channel_user_list_steps(team_id, channel_name, role, refresh))
+
+	async def get_channel_user_list_async (self, team_id, channel_name, role='All', refresh=False):
+		""" async version of `get_channel_user_list` """
+		return await self._run_steps_async(self._get_channel_user_list_steps(team_id, channel_name, role, refresh))
+
+	def _get_channel_user_list_steps (self, team_id, channel_name, role='All', refresh=False):
+		""" steps for `get_channel_user_list` (see `_run_steps`) """
+		if (self.cache is not None and not refresh):
+			member_list = self.cache.get_users(MembershipCache.channel_key(team_id, channel_name, role))
+			if (member_list is not None):
+				self.logger.info(f'Using cached user list for channel {channel_name}')
+				return member_list
 
 		# add filter if required
 		role_filter = ''
 		if (role != 'All'):
 			role_filter = f' -Role {role}'
 
-		response = self.process.run_command(
-			f'Get-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}"{role_filter}',
-			convert_json = True
-		)
+		response = yield {
+			'command'     : f'Get-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}"{role_filter}',
+			'json_records': self.user_record_properties
+		}
 
 		# TODO parse response
 		if (type(response) == 'str'):
@@ -1232,6 +3846,9 @@ class TeamsUpdater:
 		else:
 			member_list = self._parse_response_users(response, channel_name, print_users=True)
 
+			if (self.cache is not None):
+				self.cache.set_users(MembershipCache.channel_key(team_id, channel_name, role), member_list)
+
 			return member_list
 
 	def add_users_to_channel (self, team_id, channel_name, users=[User], role='Member'):
@@ -1241,15 +3858,15 @@ class TeamsUpdater:
 
 	def add_user_to_channel (self, team_id, channel_name, user=User, role='Member'):
 		""" add user to channel """
-		self.ensure_connected()
+		return self._run_steps(self._add_user_to_channel_steps(team_id, channel_name, user, role))
 
+	def _add_user_to_channel_steps (self, team_id, channel_name, user=User, role='Member'):
+		""" steps for `add_user_to_channel` (see `_run_steps`) """
 		# skip the uni-added service accounts
 		if (user.id in self.exclusion_ids):
 			return False
 
-		response = self.process.run_command(
-			f'Add-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}" -User {user.id}@ad.unsw.edu.au'
-		)
+		response = yield {'command': f'Add-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}" -User {user.id}@ad.unsw.edu.au'}
 
 		# owners need to be added as regular members first, then once more to set the owner status
 		if (response.find('User is not found in the team.') == -1 and role == 'Owner'):
@@ -1257,149 +3874,282 @@ class TeamsUpdater:
 			# if (self.user_channel_bug_counter > 5):
 			# 	self.logger.warning(f'Skipped adding {role} status for {user} due to PS module bug')
 			# else:
-			response = self.process.run_command(
-				f'Add-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}" -User {user.id}@ad.unsw.edu.au -Role {role}'
-			)
+			response = yield {'command': f'Add-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}" -User {user.id}@ad.unsw.edu.au -Role {role}'}
 
-		# parse response
-		success = True
-		# empty response is sign of success, so check for that
-		if (len(response) == 0):
-			self.logger.info(f'Channel {channel_name}: Added {user} as {role}')
-		else:
-			if (response.find('Failed to find the user on the channel roster')):
-				self.user_channel_bug_counter += 1
-			# if (response.find('User is not found in the team.') != -1 or response.find('Could not find member.') != -1 or response.find('Authorization_RequestDenied') !=-1):
-			"""
-			Add-TeamChannelUser: Error occurred while executing 
-			Code: BadRequest
-			Message: Invalid OData type specified: "Microsoft.Teams.Core.aadUserConversationMember"
-			HttpStatusCode: BadRequest
-			"""
-			success = False
-			self.logger.error(f'Channel {channel_name}: Could not add {user} as {role}')
-
-		return success
+		return self._log_membership_outcome(self._membership_operation('add', team_id, channel_name, user, role), response)
 
 	def remove_user_from_channel (self, team_id, channel_name, user=User, role='Member'):
 		""" remove user from specified channel """
-		self.ensure_connected()
+		return self._run_steps(self._remove_user_from_channel_steps(team_id, channel_name, user, role))
 
+	def _remove_user_from_channel_steps (self, team_id, channel_name, user=User, role='Member'):
+		""" steps for `remove_user_from_channel` (see `_run_steps`) """
 		# skip the uni-added service accounts
 		if (user.id in self.exclusion_ids):
 			return False
 
 		# remove from to relevant channel
-		response = self.process.run_command(
-			f'Remove-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}" -User {user.id}@ad.unsw.edu.au'
-		)
-
-		success = True
+		response = yield {'command': f'Remove-TeamChannelUser -GroupId {team_id} -DisplayName "{channel_name}" -User {user.id}@ad.unsw.edu.au'}
 
-		# by default, no response means things went fine
-		if (len(response) == 0):
-			self.logger.info(f'Channel {channel_name}: Removed {user} as {role}')
-		else:
-			success = False
-			print(response)
-			self.logger.error(f'Channel {channel_name}: Could not remove {user} as {role}')
-		
-		# TODO parse response
-		# Remove-TeamChannelUser: Error occurred while executing 
-		# Code: NotFound
-		# Message: Not Found
-		# InnerError:
-		# RequestId: 55982b3c-1319-4614-97bf-68e67ea94f90
-		# DateTimeStamp: 2020-09-19T23:46:30
-		# HttpStatusCode: NotFound
-		
-		return success
+		return self._log_membership_outcome(self._membership_operation('remove', team_id, channel_name, user, role), response)
 
-	def update_channel (self, team_id, channel_name, desired_user_list, channel_user_list=None, role='All', remove_allowed=True):
+	def update_channel (self, team_id, channel_name, desired_user_list, channel_user_list=None, role='All', remove_allowed=True, refresh=False):
 		""" Sync channel membership by comparing `desired_user_list` with `channel_user_list` (latter will be fetched if not specified) """
-		self.logger.info(f"Updating channel {channel_name} ({len(desired_user_list)} enrolments)")
+		return self._run_steps(self._update_channel_steps(team_id, channel_name, desired_user_list, channel_user_list, role, remove_allowed, refresh))
 
-		count_removed = 0
-		count_added   = 0
+	async def update_channel_async (self, team_id, channel_name, desired_user_list, channel_user_list=None, role='All', remove_allowed=True, refresh=False):
+		""" async version of `update_channel` """
+		return await self._run_steps_async(self._update_channel_steps(team_id, channel_name, desired_user_list, channel_user_list, role, remove_allowed, refresh))
+
+	def _update_channel_steps (self, team_id, channel_name, desired_user_list, channel_user_list=None, role='All', remove_allowed=True, refresh=False):
+		""" steps for `update_channel` (see `_run_steps`) """
+		self.logger.info(f"Updating channel {channel_name} ({len(desired_user_list)} enrolments)")
 
 		desired_user_list = self.ensure_dict(desired_user_list)
 		channel_user_list = self.ensure_dict(channel_user_list)
 
 		if (channel_user_list is None):
 			# get the team user list
-			channel_user_list = self.get_channel_user_list(team_id, channel_name, role)
+			channel_user_list = yield from self._get_channel_user_list_steps(team_id, channel_name, role, refresh)
+
+		removals, additions = self._membership_changes(team_id, channel_name, desired_user_list, channel_user_list, role, remove_allowed)
+
+		results = yield from self._membership_steps(removals + additions)
+
+		count_removed = sum(results[:len(removals)])
+		count_added   = sum(results[len(removals):])
+
+		self.logger.info(f'Updating channel {channel_name} complete (- {count_removed} / + {count_added})')
+
+		return (count_removed, count_added)
+
+	def _membership_changes (self, team_id, channel_name, desired_user_list, current_user_list, role='All', remove_allowed=True):
+		"""
+		Compares the desired and current members of a team (`channel_name` is None) or channel, both dicts,
+		and returns the removals and additions needed to sync them (as lists of `_membership_operation`).
+		"""
+		removals  = []
+		additions = []
+
+		if (channel_name is None):
+			target = f'Team {team_id}'
+		else:
+			target = f'Channel {channel_name}'
 
 		# check current teams list against desired list
-		#	remove any not on desired list (but check against stafflist, those are save from deletion)
-		for user_in_teams_list in channel_user_list:
+		#	remove any not on desired list (for channels, also check against stafflist, those are save from deletion)
+		for user_in_teams_list in current_user_list:
 			# skip the uni-added service accounts
 			if (user_in_teams_list in self.exclusion_ids): 
 				continue
 
-			if (user_in_teams_list not in desired_user_list and user_in_teams_list not in self.user_stafflist):
-				if (remove_allowed):
-					# no role is indicated, so removal should remove the user rather than demote them from owner to member
-					response = self.remove_user_from_channel(team_id, channel_name, channel_user_list[user_in_teams_list])
-					
-					if (response):
-						count_removed += 1
-				else:
-					self.logger.info(f'Channel {channel_name}: Skipping removing {channel_user_list[user_in_teams_list]} as {role}')
+			if (user_in_teams_list in desired_user_list):
+				continue
+
+			if (channel_name is not None and user_in_teams_list in self.user_stafflist):
+				continue
+
+			if (remove_allowed):
+				# no role is indicated, so removal should remove the user rather than demote them from owner to member
+				removals.append( self._membership_operation('remove', team_id, channel_name, current_user_list[user_in_teams_list]) )
+			else:
+				self.logger.info(f'{target}: Skipped removing {current_user_list[user_in_teams_list]} as {role}')
 				
 		# add any not in teams list but on desired list
 		for user_in_desired_list in desired_user_list:
-			if (user_in_desired_list not in channel_user_list):
-				# manage by role
+			if (user_in_desired_list not in current_user_list):
 				if (role == 'All'):
 					# follow User role
-					response = self.add_user_to_channel(team_id, channel_name, desired_user_list[user_in_desired_list], role=desired_user_list[user_in_desired_list].role())
+					additions.append( self._membership_operation('add', team_id, channel_name, desired_user_list[user_in_desired_list], desired_user_list[user_in_desired_list].role()) )
 				else:
 					# follow the generic role indicated
-					response = self.add_user_to_channel(team_id, channel_name, desired_user_list[user_in_desired_list], role)
-				
-				if (response):
-					count_added += 1
+					additions.append( self._membership_operation('add', team_id, channel_name, desired_user_list[user_in_desired_list], role) )
+
+		return removals, additions
+
+	def _membership_operation (self, action, team_id, channel_name, user, role='Member'):
+		""" describes adding or removing a user to/from a team (`channel_name` is None) or channel """
+		return {
+			'action'      : action,  # 'add'|'remove'
+			'team_id'     : team_id,
+			'channel_name': channel_name,
+			'user'        : user,
+			'role'        : role
+		}
 
-		self.logger.info(f'Updating channel {channel_name} complete (- {count_removed} / + {count_added})')
+	def _log_membership_outcome (self, operation, response):
+		""" logs how a membership operation went, based on its response, and returns whether it succeeded """
+		user   = operation['user']
+		role   = operation['role']
+		action = ('Added', 'Removed')[operation['action'] == 'remove']
+		
+		if (operation['channel_name'] is None):
+			target = f"Team {operation['team_id']}"
+		else:
+			target = f"Channel {operation['channel_name']}"
 
-		return (count_removed, count_added)
+		# empty response is sign of success, so check for that
+		if (len(response) == 0):
+			self.logger.info(f'{target}: {action} {user} as {role}')
+
+			if (self.cache is not None):
+				self.cache.apply(operation)
+
+			return True
+
+		# TODO check response
+		#Remove-TeamUser: Error occurred while executing 
+		#Remove-TeamUser: Last owner cannot be removed from the team
+		#Request_ResourceNotFound
+		if (operation['channel_name'] is not None):
+			if (operation['action'] == 'add'):
+				if (response.find('Failed to find the user on the channel roster')):
+					self.user_channel_bug_counter += 1
+				# if (response.find('User is not found in the team.') != -1 or response.find('Could not find member.') != -1 or response.find('Authorization_RequestDenied') !=-1):
+				"""
+				Add-TeamChannelUser: Error occurred while executing 
+				Code: BadRequest
+				Message: Invalid OData type specified: "Microsoft.Teams.Core.aadUserConversationMember"
+				HttpStatusCode: BadRequest
+				"""
+			else:
+				print(response)
+				# Remove-TeamChannelUser: Error occurred while executing 
+				# Code: NotFound
+				# Message: Not Found
+				# InnerError:
+				# RequestId: 55982b3c-1319-4614-97bf-68e67ea94f90
+				# DateTimeStamp: 2020-09-19T23:46:30
+				# HttpStatusCode: NotFound
+
+		self.logger.error(f"{target}: Could not {operation['action']} {user} as {role}")
+		return False
 
-	def find_users (self, search_key, search_value, list_to_search=None, return_type='list'):
-		""" convenience function to find users in a list """
-		# TODO make it easier to access the default user lists
-		list_to_search = list_to_search
-		results        = []
+	def _membership_steps (self, operations):
+		"""
+		Steps that carry out a list of membership operations (see `_membership_operation`) and return a list of
+		outcomes (True/False) in the same order. Each is run as a separate command, or with `batch_size` set, in batches.
+		"""
+		if (self.batch_size > 0):
+			results = yield from self._membership_batch_steps(operations)
+			return results
+
+		results = []
+
+		for op in operations:
+			if (op['channel_name'] is None and op['action'] == 'add'):
+				response = yield from self._add_user_to_team_steps(op['team_id'], op['user'], op['role'])
+			elif (op['channel_name'] is None):
+				response = yield from self._remove_user_from_team_steps(op['team_id'], op['user'], op['role'])
+			elif (op['action'] == 'add'):
+				response = yield from self._add_user_to_channel_steps(op['team_id'], op['channel_name'], op['user'], op['role'])
+			else:
+				response = yield from self._remove_user_from_channel_steps(op['team_id'], op['channel_name'], op['user'], op['role'])
+
+			results.append(response)
+
+		return results
+
+	def _membership_batch_script (self, items):
+		"""
+		Generates a one-line powershell script that works through a list of membership operations in one go,
+		returning a compact JSON list of what each cmdlet returned (its output or error, so empty means success).
+
+		Each item has a short key: `n` (index), `a` (ta|tr for team add/remove, ca|cr for channels),
+		`g` (team id), `c` (channel name), `u` (user), `r` (role).
+		"""
+		# data is passed as JSON in a single-quoted string, where a quote is escaped by doubling it
+		#   (non-ASCII characters, including curly quotes, are escaped by json.dumps already)
+		data = json.dumps(items, separators=(',',':')).replace("'", "''")
+
+		return (
+			"$CURun = { param($s) try { (& $s 2>&1 | Out-String).Trim() } catch { ($_ | Out-String).Trim() } }; "
+			f"$CUResults = foreach ($i in (ConvertFrom-Json '{data}')) {{ "
+				"$e = switch ($i.a) { "
+					"'ta' { & $CURun { Add-TeamUser -GroupId $i.g -User $i.u -Role $i.r } } "
+					"'tr' { & $CURun { Remove-TeamUser -GroupId $i.g -User $i.u -Role $i.r } } "
+					# owners need to be added as regular members first, then once more to set the owner status
+					"'ca' { $r = & $CURun { Add-TeamChannelUser -GroupId $i.g -DisplayName $i.c -User $i.u }; "
+						"if ($i.r -eq 'Owner' -and $r -notlike '*User is not found in the team.*') { & $CURun { Add-TeamChannelUser -GroupId $i.g -DisplayName $i.c -User $i.u -Role $i.r } } else { $r } } "
+					"'cr' { & $CURun { Remove-TeamChannelUser -GroupId $i.g -DisplayName $i.c -User $i.u } } "
+				"}; "
+				"[pscustomobject]@{ n = $i.n; e = [string]$e } "
+			"}; "
+			"ConvertTo-Json -InputObject @($CUResults) -Compress"
+		)
+
+	def _membership_batch_steps (self, operations):
+		""" steps for running membership operations in batches (see `_membership_steps`) """
+		results = [False] * len(operations)
+		items   = []
+
+		for n, op in enumerate(operations):
+			# skip the uni-added service accounts
+			if (op['user'].id in self.exclusion_ids):
+				continue
+
+			items.append({
+				'n': n,
+				'a': ('t', 'c')[op['channel_name'] is not None] + ('a', 'r')[op['action'] == 'remove'],
+				'g': op['team_id'],
+				'c': op['channel_name'] or '',
+				'u': f"{op['user'].id}@ad.unsw.edu.au",
+				'r': op['role']
+			})
+
+		# throttled operations are queued again (up to the governor's max_retries), rather than running the whole batch again
+		pending  = deque(items)
+		attempts = {}
+
+		while (len(pending) > 0):
+			batch = [pending.popleft() for i in range(min(self.batch_size, len(pending)))]
+
+			response = yield {'command': self._membership_batch_script(batch), 'retry': False}
+
+			# map outcomes back to their operation
+			#   if the script itself failed, its response is all we know for every operation in the batch
+			outcomes = {}
+			try:
+				for outcome in json.loads(response):
+					outcomes[outcome['n']] = outcome['e'] or ''
+			except (json.decoder.JSONDecodeError, TypeError, KeyError):
+				self.logger.warning(f'Could not parse batch response: {response}')
+
+			for item in batch:
+				outcome = outcomes.get(item['n'], response or 'no response')
+				error   = outcomes.get(item['n'], RateGovernor.error_text(response))
+
+				if (self.governor is not None and RateGovernor.classify(error)[0] and attempts.get(item['n'], 0) < self.governor.max_retries):
+					attempts[item['n']] = attempts.get(item['n'], 0) + 1
+					pending.append(item)
+					continue
+
+				results[item['n']] = self._log_membership_outcome(operations[item['n']], outcome)
+
+		return results
+
+	def find_users (self, search_key, search_value=None, list_to_search=None, return_type='list'):
+		"""
+		convenience function to find users in a list
+		instead of a search_key and search_value, a query can be given, e.g. Match('group', 'Staff') & ~Match('class id', 1234)
+		each user is found once, even if several of their groups (or groupings) match
+		"""
+		query = search_key
+		if (not isinstance(query, UserQuery)):
+			query = Match.from_search(search_key, search_value)
 
 		# default to master list
 		if (list_to_search is None):
 			list_to_search = self.user_list
 
-		# check if list is actually a dict, and if so convert
-		list_to_search = self.ensure_list(list_to_search)
-
-		for user in list_to_search:
-			# check whether we match (part of) a string or other types of values
-			if (isinstance(search_value, str)):
-				if (search_key.lower() == 'group'):
-					for group_name in user.groups:
-						if (search_value in group_name):
-							results.append(user)
-				elif (search_key.lower() == 'group_exact'):
-					for group_name in user.groups:
-						if (search_value == group_name):
-							results.append(user)
-				elif (search_key.lower() == 'grouping'):
-					for grouping_name in user.groupings:
-						if (search_value in grouping_name):
-							results.append(user)
-				elif (user[search_key].lower().find(search_value.lower()) != -1):
-					results.append(user)
+		# the main lists are indexed (or in the store), anything else is searched one by one
+		results = self._find_in_store(query, list_to_search)
+		if (results is None):
+			index = self._user_index(list_to_search)
+			if (index is not None):
+				results = index.find(query)
 			else:
-				if (search_key.lower() == 'class id'):
-					if (search_value in user.class_ids):
-						results.append(user)
-				elif (user[search_key] == search_value):
-					results.append(user)
+				results = [user for user in self.ensure_list(list_to_search) if query.matches(user)]
 
 		if (return_type == 'list'):
 			return results
@@ -1408,7 +4158,61 @@ class TeamsUpdater:
 			for result in results:
 				results_dict[result.id] = result
 			return results_dict
-				
+
+	def count_users (self, search_key, search_value=None, list_to_search=None):
+		"""
+		returns the number of users that find_users would return, for sizing rosters or their overlap
+		e.g. count_users(Match('class id', 9251) & Match('grouping', 'Project X') & ~Match('group', 'Staff'))
+		"""
+		query = search_key
+		if (not isinstance(query, UserQuery)):
+			query = Match.from_search(search_key, search_value)
+
+		if (list_to_search is None):
+			list_to_search = self.user_list
+
+		index = self._user_index(list_to_search)
+		if (index is not None):
+			return index.count(query)
+		else:
+			return sum(1 for user in self.ensure_list(list_to_search) if query.matches(user))
+
+	def _find_in_store (self, query, users):
+		""" returns users matching a query via the SQLiteUserStore, or None if the store can't answer it """
+		if (self.store is None or self.store_course is None or not (users is self.user_list or users is self.user_stafflist)):
+			return None
+
+		staff = users is self.user_stafflist
+
+		try:
+			ids = self.store.find(self.store_course, query, staff)
+		except ValueError:
+			return None
+
+		return [users[user_id] for user_id in ids if user_id in users]
+
+	def _user_index (self, users):
+		""" returns a (cached) UserIndex for the master list or stafflist, or None for any other list """
+		if (users is self.user_list):
+			key = 'users'
+		elif (users is self.user_stafflist):
+			key = 'staff'
+		else:
+			return None
+
+		# users may have been added, removed or replaced since the index was built
+		#   a plain dict doesn't tell, so its index is built again every time
+		version = getattr(users, 'version', None)
+
+		with self.user_index_lock:
+			indexed_users, indexed_version, index = self.user_indexes.get(key, (None, None, None))
+
+			if (indexed_users is not users or version is None or indexed_version != version):
+				index = UserIndex(users)
+				self.user_indexes[key] = (users, version, index)
+
+		return index
+
 	def ensure_list (self, input_list):
 		""" if input is actually a dict, convert to a list and return """
 		if (input_list is None):
@@ -1457,7 +4261,7 @@ class TeamsUpdater:
 					owners[co] = self.user_list[co]
 				else:
 					# add a dummy user
-					c = User(co, '~~unknown~~', [], [], [], '', True)
+					c = User(co, '~~unknown~~').freeze()
 					owners[co] = c
 
 		for oo in stream_data['other_owners']:
@@ -1466,7 +4270,7 @@ class TeamsUpdater:
 					owners[oo] = self.user_stafflist[oo]
 				else:
 					# add a dummy user
-					o = User(oo, '~~unknown~~', [], [], [], '', True)
+					o = User(oo, '~~unknown~~').freeze()
 					owners[oo] = o
 
 		for clas in stream_data['classes']:
@@ -1476,51 +4280,140 @@ class TeamsUpdater:
 						owners[demonstrator_id] =self.user_stafflist[demonstrator_id]
 					else:
 						# add a dummy user
-						d = User(demonstrator_id, '~~unknown~~', [], [], [], '', True)
+						d = User(demonstrator_id, '~~unknown~~').freeze()
 						owners[demonstrator_id] = d
 
 		return self.ensure_list(owners)
 
 	def convenience_create_class_channels (self, stream_data, current_channels):
 		""" Create class channels based on given stream data """
-		for clas in stream_data['classes']:
-			if (clas['channel']):
-				channel_name = f'{clas["name"]}_{clas["class_id"]}'
+		plan = SyncPlan()
+		self._plan_class_channels(stream_data, current_channels, plan)
+		self._apply_channel_changes(plan)
+
+	def _plan_class_channels (self, stream_data, current_channels, plan):
+		""" adds the class channels to create or edit for a stream to a SyncPlan """
+		for clas in CourseModel.compile_classes(stream_data):
+			if (clas.channel):
+				channel_name = clas.channel_name
 
 				if (channel_name in current_channels):
 					# check if type is correct - if not, warn (mismatch can't be resolved without recreating channel)
 					current_type = current_channels[channel_name]['MembershipType'].lower().replace('standard','public')
 
-					if (current_type != clas['channel']):
-						self.logger.error(f"Channel {channel_name} in {stream_data['team_id']}: Wrong membership type: not {clas['channel']}")
+					if (current_type != clas.channel):
+						message = f"Channel {channel_name} in {stream_data['team_id']}: Wrong membership type: not {clas.channel}"
+						self.logger.error(message)
+						plan.warnings.append(message)
 					
 					# check if description is correct - if not, update
-					if (current_channels[channel_name]['Description'] != clas['description']):
-						self.set_channel(stream_data['team_id'], channel_name, description=clas['description'])
+					if (current_channels[channel_name]['Description'] != clas.description):
+						plan.channel_edits.append({'team_id': stream_data['team_id'], 'channel_name': channel_name, 'description': clas.description})
 				else:
 					# create channel
 					ctype = 'Standard'
-					if (clas['channel'] == 'private'):
+					if (clas.channel == 'private'):
 						ctype = 'Private'
 
-					self.create_channel(stream_data['team_id'], channel_name, ctype, description=clas['description'])
+					plan.channel_creates.append({'team_id': stream_data['team_id'], 'channel_name': channel_name, 'channel_type': ctype, 'description': clas.description})
+
+	def _class_channel_targets (self, stream_data, owners, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True):
+		""" the desired members of each class channel in a stream, as a list of (channel name, [(role, users, remove allowed, source), ...]) (see SyncDependencies for sources) """
+		targets = []
+
+		# only need to sync private channels as those have a memberlist separate from main team
+		for clas in CourseModel.compile_classes(stream_data):
+			if (not clas.channel or clas.channel != 'private'):
+				continue
+
+			channel_name = clas.channel_name
+			roles        = []
+
+			# update owners
+			if (sync_staff):
+				roles.append(('Owner', owners, remove_staff_allowed, ('staff',)))
+			
+			# update students
+			if (sync_students):
+				class_students = self.find_users('class id', clas.class_id, return_type='dict')
+
+				roles.append(('Member', class_students, remove_students_allowed, ('query', Match('class id', clas.class_id))))
+
+			targets.append((channel_name, roles))
+
+		return targets
+
+	def _channel_targets (self, stream_data, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True):
+		"""
+		the desired members of each additional channel in a stream, as a list of (channel name, [(role, users, remove allowed, source), ...])
+		TODO - doesn't respect input parameters very well...
+		"""
+		targets = []
+
+		for channel in stream_data['channels']:
+			if (channel['channel'] != 'private'):
+				continue
+
+			roles = []
+
+			# work through owner and member configuration
+			for role in ['Owner','Member']:
+				role_name = f'{role.lower()}s' # 'owners' or 'members'
+
+				if (role_name in channel):
+					# defaults
+					users          = self.user_list
+					remove_allowed = remove_students_allowed
+					source         = ('students',)
+					
+					# implement user list changes and search filter
+					user_list    = None
+					if ('list' in channel[role_name]):
+						user_list = channel[role_name]['list'].lower()
+
+						# handle any special cases
+						if (user_list == 'stream_owners'):
+							users     = stream_data['stream_owners']
+							user_list = stream_data['stream_owners']
+							remove_allowed = remove_staff_allowed
+							source         = ('staff',)
+						# or handle general case
+						elif ('staff' in user_list or 'owner' in user_list):
+							users          = self.user_stafflist
+							user_list      = self.user_stafflist
+							remove_allowed = remove_staff_allowed
+							source         = ('staff',)
+
+					filter_key   = None
+					filter_terms = None
+					if ('filter' in channel[role_name]):
+						filter_key  = channel[role_name]['filter']
+						filter_terms = channel[role_name]['filter_terms']
+					
+						users = self.find_users(filter_key, filter_terms, list_to_search=user_list, return_type='dict')
+
+						if (source[0] == 'students'):
+							source = SyncDependencies.filter_source(filter_key, filter_terms)
+					
+					roles.append((role, users, remove_allowed, source))
+
+			targets.append((channel['name'], roles))
+
+		return targets
+
+	def _sync_channel_target (self, team_id, target):
+		""" syncs a channel with its desired members for each role (see `_channel_targets`) """
+		channel_name, roles = target
+
+		for role, users, remove_allowed, source in roles:
+			self.update_channel(team_id, channel_name, users, role=role, remove_allowed=remove_allowed)
 
 	def convenience_sync_class_channels (self, stream_data, owners, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True):
 		""" Synchronise stream class channel membership against a given user list """
-		for clas in stream_data['classes']:
-			# only need to sync private channels as those have a memberlist separate from main team
-			if (clas['channel'] and clas['channel'] == 'private'):
-				channel_name = f'{clas["name"]}_{clas["class_id"]}'
-
-				# update owners
-				if (sync_staff):
-					self.update_channel(stream_data['team_id'], channel_name, owners, role='Owner', remove_allowed=remove_staff_allowed)
-				
-				# update students
-				if (sync_students):
-					class_students = self.find_users('class id', clas['class_id'], return_type='dict')
+		targets = self._class_channel_targets(stream_data, owners, sync_staff, sync_students, remove_staff_allowed, remove_students_allowed)
 
-					self.update_channel(stream_data['team_id'], channel_name, class_students, role='Member', remove_allowed=remove_students_allowed)
+		# each channel is independent from the others, so these can be synced in parallel
+		self.dispatch([functools.partial(self._sync_channel_target, stream_data['team_id'], target) for target in targets])
 
 	def convenience_sync_channels (self, stream_data, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True):
 		"""
@@ -1528,43 +4421,10 @@ class TeamsUpdater:
 		TODO - doesn't respect input parameters very well...
 		     - could be more generic for broader use
 		"""
-		for channel in stream_data['channels']:
-			if (channel['channel'] == 'private'):
-				# work through owner and member configuration
-				for role in ['Owner','Member']:
-					role_name = f'{role.lower()}s' # 'owners' or 'members'
-
-					if (role_name in channel):
-						# defaults
-						users          = self.user_list
-						remove_allowed = remove_students_allowed
-						
-						# implement user list changes and search filter
-						user_list    = None
-						if ('list' in channel[role_name]):
-							user_list = channel[role_name]['list'].lower()
-
-							# handle any special cases
-							if (user_list == 'stream_owners'):
-								users     = stream_data['stream_owners']
-								user_list = stream_data['stream_owners']
-								remove_allowed = remove_staff_allowed
-							# or handle general case
-							elif ('staff' in user_list or 'owner' in user_list):
-								users          = self.user_stafflist
-								user_list      = self.user_stafflist
-								remove_allowed = remove_staff_allowed
-
-						filter_key   = None
-						filter_terms = None
-						if ('filter' in channel[role_name]):
-							filter_key  = channel[role_name]['filter']
-							filter_terms = channel[role_name]['filter_terms']
-						
-							users = self.find_users(filter_key, filter_terms, list_to_search=user_list, return_type='dict')
-						
-						# do actual update
-						self.update_channel(stream_data['team_id'], channel['name'], users, role=role, remove_allowed=remove_allowed)
+		targets = self._channel_targets(stream_data, sync_staff, sync_students, remove_staff_allowed, remove_students_allowed)
+
+		# channels are independent from each other, so these can be synced in parallel
+		self.dispatch([functools.partial(self._sync_channel_target, stream_data['team_id'], target) for target in targets])
 
 	def convenience_course_stream_update (self, team_name, stream_name, stream_data, course_owners='', include_staff=True, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True, set_team_picture=False):
 		""" Default stream update method, suitable for most courses """
@@ -1617,6 +4477,195 @@ class TeamsUpdater:
 
 		return team_info
 
+	def _stream_targets (self, stream_name, stream_data, course_owners='', include_staff=True, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True):
+		"""
+		the desired members of the team and channels of a stream, following the rules of `convenience_course_stream_update`
+		returns a list of (channel name or None for the team, role, users, remove allowed, source) (see SyncDependencies for sources)
+		"""
+		# ---- find stream owners ----
+		stream_owners = self.find_users('group', f'Staff {course_owners}', self.user_stafflist)
+		# initially, we may exclude staff to give time for early setup
+		if (include_staff):
+			stream_owners = self.convenience_get_stream_owners(stream_name, stream_data, stream_owners)
+		# store for later use
+		stream_data['stream_owners'] = stream_owners
+
+		targets         = []
+		channel_targets = []
+
+		if (sync_staff):
+			targets.append((None, 'Owner', stream_owners, remove_staff_allowed, ('staff',)))
+			channel_targets += self._channel_targets(stream_data, sync_staff, sync_students, remove_staff_allowed, remove_students_allowed)
+
+		channel_targets += self._class_channel_targets(stream_data, stream_owners, sync_staff, sync_students, remove_staff_allowed, remove_students_allowed)
+
+		for channel_name, roles in channel_targets:
+			for role, users, remove_allowed, source in roles:
+				targets.append((channel_name, role, users, remove_allowed, source))
+
+		return targets
+
+	def course_dependencies (self, streams_data, course_owners='', include_staff=True, sync_staff=True, sync_students=True):
+		""" returns SyncDependencies for the teams and channels of all streams in a course (see `plan_course_update`) """
+		dependencies = SyncDependencies()
+
+		for stream_name, stream_data in streams_data.items():
+			for channel_name, role, users, remove_allowed, source in self._stream_targets(stream_name, stream_data, course_owners, include_staff, sync_staff, sync_students):
+				dependencies.add(source, (stream_data['team_id'], channel_name, role))
+
+		return dependencies
+
+	def plan_course_update (self, streams_data, course_owners='', team_name_format=None, include_staff=True, sync_staff=True, sync_students=True, remove_staff_allowed=True, remove_students_allowed=True, refresh=False, changeset=None):
+		"""
+		Works out all changes for the teams and channels of every stream in `streams_data`, following the same
+		rules as `convenience_course_stream_update`, and returns these as a SyncPlan without changing anything.
+		Current member lists are fetched all at once (in parallel with a PowerShellPool).
+
+		  team_name_format : (optional) for example 'DESN2000 {stream} - 2021 T3', to keep team names and descriptions in line
+		  changeset        : (optional) EnrolmentChangeset (see `import_user_list`), to only plan the memberships of rosters it
+		                     affects (see SyncDependencies), along with those of streams whose config changed since the
+		                     last confirmed sync (see `ImportFingerprints.confirm`) and of channels yet to be created
+		"""
+		plan    = SyncPlan()
+		targets = []  # (team_id, channel_name, role, users, remove_allowed, exists)
+		skipped = 0
+
+		for stream_name, stream_data in streams_data.items():
+			team_id        = stream_data['team_id']
+			stream_targets = self._stream_targets(stream_name, stream_data, course_owners, include_staff, sync_staff, sync_students, remove_staff_allowed, remove_students_allowed)
+
+			# ---- get basic team info ----
+			team_info = self.get_team(team_id, get_channels=True)
+
+			# ---- set appearance ----
+			if (team_name_format is not None):
+				team_name   = team_name_format.format(stream=stream_name)
+				description = f'Teaching Team for {team_name}'
+
+				if (team_info['DisplayName'] != team_name or team_info['Description'] != description):
+					plan.team_edits.append({'team_id': team_id, 'name': team_name, 'description': description})
+
+			# ---- create channels ----
+			self._plan_class_channels(stream_data, team_info['channels'], plan)
+
+			for channel in stream_data['channels']:
+				if (channel['name'] not in team_info['channels'] and channel['channel']):
+					plan.channel_creates.append({'team_id': team_id, 'channel_name': channel['name'], 'channel_type': channel['channel'], 'description': channel['description']})
+
+			# ---- sync members ----
+			if (changeset is not None):
+				dependencies = SyncDependencies()
+				for channel_name, role, users, remove_allowed, source in stream_targets:
+					dependencies.add(source, (team_id, channel_name, role))
+
+				# a changed config (owners, classes, channels, ...) may affect any roster of the stream
+				#   stream owners are set here, and derived from the config, so these aren't part of it
+				config  = {key: value for key, value in stream_data.items() if key != 'stream_owners'}
+				context = ImportFingerprints.context_hash(stream_name, config, course_owners, include_staff, sync_staff, sync_students, remove_staff_allowed, remove_students_allowed)
+
+				if (self.fingerprints is None or self.fingerprints.stream_changed(f'{team_id}|{stream_name}', context)):
+					affected = dependencies.targets()
+				else:
+					affected = dependencies.affected(changeset)
+
+				# channels yet to be created need all of their members
+				stream_targets = [t for t in stream_targets if (team_id, t[0], t[1]) in affected or (t[0] is not None and t[0] not in team_info['channels'])]
+				skipped       += len(dependencies.targets()) - len(stream_targets)
+
+			for channel_name, role, users, remove_allowed, source in stream_targets:
+				targets.append((team_id, channel_name, role, users, remove_allowed, channel_name is None or channel_name in team_info['channels']))
+
+		def current_members (target):
+			team_id, channel_name, role, users, remove_allowed, exists = target
+
+			if (channel_name is None):
+				return self.get_team_user_list(team_id, role, refresh)
+			elif (exists):
+				return self.get_channel_user_list(team_id, channel_name, role, refresh)
+			else:
+				return {}  # channel is yet to be created
+
+		current = self.dispatch([functools.partial(current_members, target) for target in targets])
+
+		for target, current_user_list in zip(targets, current):
+			team_id, channel_name, role, users, remove_allowed, exists = target
+
+			if (not isinstance(current_user_list, dict)):
+				plan.warnings.append(f'Could not get {role} list of {channel_name or team_id}, skipped')
+				continue
+
+			removals, additions = self._membership_changes(team_id, channel_name, self.ensure_dict(users), current_user_list, role, remove_allowed)
+
+			for operation in removals + additions:
+				plan.add_membership(operation)
+
+		if (changeset is not None):
+			self.logger.info(f'Changes since previous import ({changeset.summary()}) affect {len(targets)} rosters, skipped {skipped} others')
+
+		self.logger.info(f'Planned {len(plan.memberships)} membership changes for {len(streams_data)} streams')
+
+		return plan
+
+	def _apply_channel_changes (self, plan):
+		""" creates and edits channels as given in a SyncPlan """
+		for c in plan.channel_creates:
+			self.create_channel(c['team_id'], c['channel_name'], c['channel_type'], description=c['description'])
+
+		for e in plan.channel_edits:
+			self.set_channel(e['team_id'], e['channel_name'], description=e['description'])
+
+	def _apply_operations (self, operations):
+		""" runs a list of membership operations, returns their outcomes """
+		return self._run_steps(self._membership_steps(operations))
+
+	def apply_plan (self, plan):
+		"""
+		Makes all changes in a SyncPlan, and returns the number of membership changes that succeeded.
+
+		Teams and channels are edited and created first, followed by team memberships, as users need to be in a team
+		before they can join its channels. Memberships are grouped by team or channel (removals first), and those
+		groups are run in parallel with a PowerShellPool, and in batches if `batch_size` is set.
+		"""
+		self.ensure_connected()
+
+		for e in plan.team_edits:
+			self.set_team(e['team_id'], new_name=e['name'], description=e['description'])
+
+		self._apply_channel_changes(plan)
+
+		# group operations by team or channel, with removals before additions
+		groups = {}
+		for op in plan.memberships:
+			operation = dict(op, user=User(op['user']['id'], op['user']['name'], email=op['user']['email']).freeze())
+			groups.setdefault((op['team_id'], op['channel_name']), ([], []))[op['action'] == 'add'].append(operation)
+
+		team_groups    = [removals + additions for (team_id, channel_name), (removals, additions) in groups.items() if channel_name is None]
+		channel_groups = [removals + additions for (team_id, channel_name), (removals, additions) in groups.items() if channel_name is not None]
+
+		count = 0
+		for group_list in (team_groups, channel_groups):
+			results = self.dispatch([functools.partial(self._apply_operations, operations) for operations in group_list])
+			count  += sum(sum(r) for r in results)
+
+		self.logger.info(f'Applied plan: {count} of {len(plan.memberships)} membership changes succeeded')
+
+		return count
+
+	def convenience_course_update (self, streams_data, dry_run=False, **kwargs):
+		"""
+		Updates the teams and channels of all streams in a course in one go, by planning and then applying all changes.
+		With `dry_run`, the planned changes are only logged. See `plan_course_update` for other parameters.
+		Returns the SyncPlan.
+		"""
+		plan = self.plan_course_update(streams_data, **kwargs)
+
+		if (dry_run):
+			self.logger.info(f'Dry run, so nothing was changed. Planned changes:\n{plan.summary()}')
+		else:
+			self.apply_plan(plan)
+
+		return plan
+
 
 class MoodleBrowser:
 	"""
@@ -1742,13 +4791,17 @@ class MoodleUpdater:
 		else:
 			return False  # re-raise the exception to be transparent
 
-	def get_users_csv (self, auto_confirm=True):
+	def get_users_csv (self, auto_confirm=True, wait=True):
 		"""
 		Downloads the user list as csv export from Moodle
 
 		Note that Moodle sets the filename and this script's browser instance can't control that.
 		It also doesn't indicate when a download may have completed, so this requires manual confirmation,
 		unless `auto_confirm` is set to `True` when it does a rudimentary file check and moves on.
+
+		With `wait=False`, the filename is returned as soon as the download starts, so the file can be imported
+		while it's still coming in with `TeamsUpdater.import_user_list(..., follow=True)`. The previous file is then
+		left as -old.csv for the importer, which removes it once the download completed (see `follow_download`).
 		"""
 		self.logger.info('Getting user data CSV file from Moodle...')
 	
@@ -1771,8 +4824,9 @@ class MoodleUpdater:
 		# temporarily move the current file if it exists
 		#   this prevents the new download to be renamed by the browser as file(1) to avoid overwriting it
 		old_filename = filename.replace('.csv', '-old.csv')
+		#   a -old.csv file left behind by an earlier run is replaced
 		if (os.path.exists(filename)):
-			os.rename(filename, old_filename)
+			os.replace(filename, old_filename)
 		
 		# select the export CSV option (which triggers a download)
 		self.logger.info('Downloading user list as CSV...')
@@ -1784,6 +4838,13 @@ class MoodleUpdater:
 		#   so this needs some intervention...
 		got_file = 'no'
 
+		if (not wait):
+			# leave it to the importer to follow the download and clean up the previous file
+			self.logger.info(f'Moodle user data is downloading to {filename}')
+
+			self.csv_file = filename
+			return filename
+
 		if (auto_confirm):
 			# add some extra buffer to be sure download completed
 			time.sleep(10)
@@ -1810,7 +4871,7 @@ class MoodleUpdater:
 
 			# rename the old file to its former name
 			if (os.path.exists(old_filename)):
-				os.rename(old_filename, filename)
+				os.replace(old_filename, filename)
 
 				return filename
 
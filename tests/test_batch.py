@@ -0,0 +1,62 @@
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import RateGovernor, TeamsUpdater, User
+
+
+class BatchProcess:
+	""" answers each batch script with the next response, keeping the items every script was sent """
+	def __init__ (self, responses):
+		self.responses     = list(responses)
+		self.batches       = []
+		self.latest_errors = []
+
+	def run_command (self, command, **kwargs):
+		data = re.search(r"ConvertFrom-Json '(.*?)'\)\)", command).group(1)
+		self.batches.append(json.loads(data.replace("''", "'")))
+
+		return self.responses.pop(0)
+
+
+def make_updater (tmp_path, responses, batch_size=10, governor=None):
+	process = BatchProcess(responses)
+	tu      = TeamsUpdater(str(tmp_path / 'course.csv'), process=process, username='z0000000', batch_size=batch_size, governor=governor)
+	tu.connected = True
+	return tu, process
+
+
+def operations (*user_ids):
+	return [
+		{'action': 'add', 'team_id': 'T', 'channel_name': None, 'user': User(user_id, f'User {user_id}'), 'role': 'Member'}
+		for user_id in user_ids
+	]
+
+
+def test_batch_outcomes_are_mapped_by_item (tmp_path):
+	tu, process = make_updater(tmp_path, ['[{"n":2,"e":""},{"n":0,"e":"Add-TeamUser: Error occurred while executing\\nUser not found"}]'])
+
+	assert tu._run_steps(tu._membership_steps(operations('z0000001', 'svco365teamsmanage', 'z0000003'))) == [False, False, True]
+	assert [item['n'] for item in process.batches[0]] == [0, 2]  # service accounts are skipped
+	assert process.batches[0][1]['a'] == 'ta'
+
+
+def test_batch_that_failed_as_a_whole_fails_each_operation (tmp_path):
+	tu, process = make_updater(tmp_path, ['ConvertFrom-Json: Error occurred while executing'], batch_size=1)
+	tu.process.responses.append('[{"n":1,"e":""}]')
+
+	assert tu._run_steps(tu._membership_steps(operations('z0000001', 'z0000002'))) == [False, True]
+
+
+def test_only_throttled_items_are_run_again (tmp_path):
+	governor    = RateGovernor(backoff=0, max_retries=1)
+	tu, process = make_updater(tmp_path, [
+		'[{"n":0,"e":"Add-TeamUser: Error occurred while executing\\nTooManyRequests"},{"n":1,"e":""}]',
+		'[{"n":0,"e":"Add-TeamUser: Error occurred while executing\\nTooManyRequests"}]'
+	], governor=governor)
+
+	assert tu._run_steps(tu._membership_steps(operations('z0000001', 'z0000002'))) == [False, True]
+	assert [[item['n'] for item in batch] for batch in process.batches] == [[0, 1], [0]]
@@ -0,0 +1,71 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import MembershipCache, User
+
+
+def make_cache ():
+	cache = MembershipCache()
+	cache.set_users(MembershipCache.team_key('T', 'Owner'), {'z0000009': User('z0000009', 'Staff Nine')})
+	cache.set_users(MembershipCache.team_key('T', 'Member'), {'z0000001': User('z0000001', 'Stu One')})
+	cache.set_users(MembershipCache.team_key('T', 'All'), {'z0000001': User('z0000001', 'Stu One'), 'z0000009': User('z0000009', 'Staff Nine')})
+	cache.set_users(MembershipCache.channel_key('T', 'Forum', 'All'), {'z0000001': User('z0000001', 'Stu One')})
+	return cache
+
+
+def operation (action, user_id, role, channel_name=None):
+	return {'action': action, 'team_id': 'T', 'channel_name': channel_name, 'user': User(user_id, f'User {user_id}'), 'role': role}
+
+
+def test_adding_member_updates_lists ():
+	cache = make_cache()
+	cache.apply(operation('add', 'z0000002', 'Member'))
+
+	assert set(cache.get(MembershipCache.team_key('T', 'Member'))) == {'z0000001', 'z0000002'}
+	assert set(cache.get(MembershipCache.team_key('T', 'All'))) == {'z0000001', 'z0000002', 'z0000009'}
+	assert set(cache.get(MembershipCache.team_key('T', 'Owner'))) == {'z0000009'}
+
+
+def test_adding_owner_as_member_invalidates_team ():
+	# Teams leaves an owner that is added as member an owner
+	cache = make_cache()
+	cache.apply(operation('add', 'z0000009', 'Member'))
+
+	assert cache.get(MembershipCache.team_key('T', 'Owner')) is None
+	assert cache.get(MembershipCache.team_key('T', 'Member')) is None
+	assert cache.get(MembershipCache.channel_key('T', 'Forum', 'All')) is not None
+
+
+def test_adding_member_without_owner_list_invalidates_team ():
+	cache = make_cache()
+	cache.invalidate(MembershipCache.team_key('T', 'Owner'))
+	cache.apply(operation('add', 'z0000002', 'Member'))
+
+	assert cache.get(MembershipCache.team_key('T', 'Member')) is None
+
+
+def test_promoting_and_removing ():
+	cache = make_cache()
+
+	cache.apply(operation('add', 'z0000001', 'Owner'))
+	assert set(cache.get(MembershipCache.team_key('T', 'Owner'))) == {'z0000001', 'z0000009'}
+	assert cache.get(MembershipCache.team_key('T', 'Member')) == {}
+
+	# removed from the team, so from its channels as well
+	cache.apply(operation('remove', 'z0000001', 'Member'))
+	assert 'z0000001' not in cache.get(MembershipCache.team_key('T', 'All'))
+	assert cache.get(MembershipCache.channel_key('T', 'Forum', 'All')) == {}
+
+	# demoting can't be followed with certainty
+	cache.apply(operation('remove', 'z0000009', 'Owner'))
+	assert cache.get(MembershipCache.team_key('T', 'All')) is None
+
+
+def test_entries_expire ():
+	cache = make_cache()
+	cache.ttl = -1
+
+	assert cache.get(MembershipCache.team_key('T', 'All')) is None
+	assert cache.get_users(MembershipCache.team_key('T', 'All')) is None
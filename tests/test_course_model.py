@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import CourseModel, ClassInfo
+
+
+def test_classes_are_found_by_class_id ():
+	model = CourseModel({
+		'A': {'main_class_id': 100, 'classes': [{'class_id': 101, 'name': 'T09A'}, {'class_id': 102, 'name': 'LE1'}, {'class_id': 200, 'name': 'H11A'}]},
+		'B': {'main_class_id': 200, 'classes': [{'class_id': 201, 'name': 'LAB1', 'channel': 'private'}]},
+		'C': {'classes': [{'class_id': 200, 'name': 'H11A'}]}
+	})
+
+	assert model.find_classes(100) == (ClassInfo(100, stream='A', kind='main'),)
+	assert [info.kind for info in model.streams['A']] == ['class', 'lecture', 'class']
+	assert model.find_classes(201)[0].channel_name == 'LAB1_201'
+
+	# a class id is found in every stream up to the one that has it as its main class id
+	assert [(info.stream, info.kind) for info in model.find_classes(200)] == [('A', 'class'), ('B', 'main')]
+	assert model.find_classes(999) == ()
@@ -0,0 +1,82 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import PowerShellDaemon, PowerShellDaemonClient
+
+
+class EchoProcess:
+	""" stands in for a logged in PowerShellWrapper """
+	connected_to_teams = False
+	username           = 'z0000000'
+	latest_errors      = []
+	latest_status      = True
+	latest_exit_code   = 0
+
+	def connect_to_teams (self):
+		self.connected_to_teams = True
+		return True
+
+	def run_command (self, command, **kwargs):
+		return f'ran {command}'
+
+	def close (self):
+		pass
+
+
+def start_daemon (socket_path):
+	daemon = PowerShellDaemon(socket_path, process=EchoProcess())
+	thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+	thread.start()
+
+	while (daemon.server is None):
+		thread.join(0.01)
+
+	return daemon, thread
+
+
+def test_client_runs_commands_on_daemon (tmp_path):
+	daemon, thread = start_daemon(str(tmp_path / 'd.sock'))
+
+	client = PowerShellDaemonClient(daemon.socket_path)
+	assert client.run_command('Get-Team') == 'ran Get-Team'
+
+	daemon.shutdown()
+	thread.join()
+	daemon.close()
+
+
+def test_second_daemon_leaves_live_one_alone (tmp_path):
+	daemon, thread = start_daemon(str(tmp_path / 'd.sock'))
+
+	second = PowerShellDaemon(daemon.socket_path, process=EchoProcess())
+	with pytest.raises(RuntimeError):
+		second.serve_forever()
+
+	assert not second.process.connected_to_teams
+	assert PowerShellDaemonClient(daemon.socket_path).run_command('Get-Team') == 'ran Get-Team'
+
+	daemon.shutdown()
+	thread.join()
+	daemon.close()
+
+
+def test_stale_socket_is_replaced (tmp_path):
+	socket_path = str(tmp_path / 'd.sock')
+
+	# a socket file nobody listens on, as left behind by a daemon that was killed
+	stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	stale.bind(socket_path)
+	stale.close()
+
+	daemon, thread = start_daemon(socket_path)
+	assert PowerShellDaemonClient(socket_path).run_command('Get-Team') == 'ran Get-Team'
+
+	daemon.shutdown()
+	thread.join()
+	daemon.close()
@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import RateGovernor, TeamsUpdater
+
+
+class ThrottlingProcess:
+	""" answers every command with a throttling error the first `throttled` times """
+	def __init__ (self, throttled, response):
+		self.throttled     = throttled
+		self.response      = response
+		self.commands      = []
+		self.latest_errors = []
+
+	def run_command (self, command, **kwargs):
+		self.commands.append(command)
+
+		if (len(self.commands) <= self.throttled):
+			self.latest_errors = ['Error occurred while executing: Too many requests. Retry-After: 0']
+			return 'Get-Team: ' + self.latest_errors[0]
+
+		self.latest_errors = []
+		return self.response
+
+
+def test_classify_only_looks_at_errors ():
+	# ordinary output may mention throttling, without being throttled
+	assert RateGovernor.classify(RateGovernor.error_text('DisplayName: Throttling 429 workshop')) == (False, None)
+
+	assert RateGovernor.classify(RateGovernor.error_text('', ['Response StatusCode: 429, Retry-After: 7'])) == (True, 7.0)
+	assert RateGovernor.classify(RateGovernor.error_text('x\nNew-Team: Error occurred while executing\nTooManyRequests')) == (True, None)
+
+
+def test_limit_halves_when_throttled_and_grows_back ():
+	governor = RateGovernor(max_in_flight=8, increase_after=2, backoff=0)
+
+	governor.acquire()
+	governor.release('', ['TooManyRequests'])
+	assert governor.limit == 4
+
+	for i in range(4):
+		governor.acquire()
+		governor.release('fine')
+	assert governor.limit == 6
+
+	# never below the minimum
+	for i in range(5):
+		governor.acquire()
+		governor.release('', ['TooManyRequests'])
+	assert governor.limit == governor.min_in_flight
+
+
+def test_team_commands_are_retried_when_throttled (tmp_path):
+	process  = ThrottlingProcess(2, {'DisplayName': 'A', 'Description': ''})
+	governor = RateGovernor(backoff=0)
+	tu       = TeamsUpdater(str(tmp_path / 'course.csv'), process=process, username='z0000000', governor=governor)
+	tu.connected = True
+
+	assert tu.get_team('T')['DisplayName'] == 'A'
+	assert process.commands == ['Get-Team -GroupId T'] * 3
+	assert governor.throttled == 2
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import GroupParser, GroupInfo
+
+
+def test_group_names_are_parsed_into_fields ():
+	parser = GroupParser(tech_streams=True)
+
+	assert parser.parse('1234') == GroupInfo(class_id=1234)
+	assert parser.parse('Project Group - Rovers (Online)') == GroupInfo(project='Rovers (Online)')
+	assert parser.parse('Project Rovers - Mentor Jane  DOE') == GroupInfo(project_mentor='jane doe')
+	assert parser.parse('Technical Stream Group - Coding (OnCampus)') == GroupInfo(tech_stream='Coding')
+	assert parser.parse('Technical Stream Coding Mentor -') == GroupInfo()
+	assert parser.parse('Project Team 12') == GroupInfo(project_team='Team 12')
+	assert parser.parse('Student Teams - Blue') == GroupInfo(project_team='Blue')
+
+
+def test_tech_stream_groups_are_only_parsed_when_asked ():
+	assert GroupParser().parse('Technical Stream Group - Coding (Online)') == GroupInfo()
+	assert GroupParser().parse('Technical Stream Coding - Mentor Jo Lee') == GroupInfo()
+	assert GroupParser(tech_streams=True).parse('Technical Stream Coding - Mentor Jo Lee') == GroupInfo(tech_stream_mentor='jo lee')
+
+
+def test_each_group_name_is_parsed_once ():
+	parser = GroupParser()
+	calls  = []
+	parser.rules.append(lambda group: calls.append(group) or {})
+
+	assert parser.parse('1234') is parser.parse('1234')
+	assert calls == ['1234']
@@ -0,0 +1,129 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import TeamsUpdater, ImportFingerprints, User, follow_download
+
+
+HEADER = 'Username,First name,Surname,Email address,Class ID,Group1,Group2'
+
+
+def write_csv (path, rows):
+	with open(path, 'w') as f:
+		f.write('\n'.join([HEADER] + rows) + '\n')
+
+
+def make_updater (path, **kwargs):
+	# a process is given so no powershell gets started
+	return TeamsUpdater(str(path), process=object(), username='z0000000', **kwargs)
+
+
+def test_fingerprints_drop_student_without_class_ids (tmp_path):
+	""" a student whose Class ID turns to '-' (halfway through unenrolment) should drop out of the master list """
+	path = tmp_path / 'course.csv'
+	tu   = make_updater(path, fingerprints=ImportFingerprints(str(tmp_path / 'fingerprints.json')))
+
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,', 'z0000002,Stu,Two,s2@x,123,123,'])
+	tu.import_user_list('C', [], {})
+	tu.fingerprints.confirm()
+	assert [u.id for u in tu.find_users('class id', 123)] == ['z0000001', 'z0000002']
+
+	write_csv(path, ['z0000001,Stu,One,s1@x,-,,', 'z0000002,Stu,Two,s2@x,123,123,'])
+	changeset = tu.import_user_list('C', [], {})
+
+	assert changeset.changed == ['z0000001']
+	assert 'z0000001' not in tu.user_list
+	assert [u.id for u in tu.find_users('class id', 123)] == ['z0000002']
+
+
+def test_fingerprints_report_context_change (tmp_path):
+	""" a new coordinator changes no rows, but may still affect any roster """
+	path = tmp_path / 'course.csv'
+	tu   = make_updater(path, fingerprints=ImportFingerprints(str(tmp_path / 'fingerprints.json')))
+
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,', 'z0000009,Staff,Nine,s9@x,-,,'])
+	tu.import_user_list('C', [], {})
+	tu.fingerprints.confirm()
+
+	changeset = tu.import_user_list('C', ['z0000009'], {})
+
+	assert changeset.context_changed
+	assert changeset.enrolled == [] and changeset.changed == []
+
+
+def test_fingerprints_keep_changes_until_confirmed (tmp_path):
+	""" a sync that failed (so wasn't confirmed) is planned again by the next run """
+	path         = tmp_path / 'course.csv'
+	fingerprints = str(tmp_path / 'fingerprints.json')
+
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,'])
+	tu = make_updater(path, fingerprints=ImportFingerprints(fingerprints))
+	tu.import_user_list('C', [], {})
+	tu.fingerprints.confirm()
+
+	# the next run imports a change, but its sync fails
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,', 'z0000002,Stu,Two,s2@x,456,456,'])
+	tu = make_updater(path, fingerprints=ImportFingerprints(fingerprints))
+	assert tu.import_user_list('C', [], {}).enrolled == ['z0000002']
+
+	tu = make_updater(path, fingerprints=ImportFingerprints(fingerprints))
+	assert tu.import_user_list('C', [], {}).enrolled == ['z0000002']
+	tu.fingerprints.confirm()
+
+	tu = make_updater(path, fingerprints=ImportFingerprints(fingerprints))
+	assert not tu.import_user_list('C', [], {})
+
+
+def test_read_user_csv_skips_blank_lines (tmp_path):
+	path = tmp_path / 'course.csv'
+	tu   = make_updater(path)
+
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,', '', 'z0000002,Stu,Two,s2@x,123,123,', ''])
+
+	assert [u.id for u in tu.read_user_csv('C')] == ['z0000001', 'z0000002']
+
+
+def test_follow_download_cleans_up_previous_file (tmp_path):
+	path = tmp_path / 'course.csv'
+	old  = tmp_path / 'course-old.csv'
+	tu   = make_updater(path)
+
+	write_csv(old, ['z0000001,Stu,One,s1@x,123,123,'])
+	write_csv(path, ['z0000002,Stu,Two,s2@x,123,123,'])
+
+	assert [u.id for u in tu.read_user_csv('C', follow=True)] == ['z0000002']
+	assert not old.exists()
+
+
+def test_follow_download_restores_previous_file_on_timeout (tmp_path):
+	path = tmp_path / 'course.csv'
+	old  = tmp_path / 'course-old.csv'
+
+	write_csv(old, ['z0000001,Stu,One,s1@x,123,123,'])
+
+	with pytest.raises(TimeoutError):
+		list(follow_download(str(path), timeout=0.1, poll_interval=0.05))
+
+	assert path.exists() and not old.exists()
+
+
+def test_users_held_are_frozen (tmp_path):
+	""" list fields of users are tuples, wherever a user came from """
+	path  = tmp_path / 'course.csv'
+	staff = User('z0000009', 'Staff Nine', groups=['Staff (DO NOT REMOVE)'])
+	tu    = make_updater(path, stafflist=[staff], fingerprints=ImportFingerprints())
+
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,', 'z0000008,Staff,Eight,s8@x,-,Staff (DO NOT REMOVE),'])
+	tu.import_user_list('C', ['z0000009'], {})
+	write_csv(path, ['z0000001,Stu,One,s1@x,123,123,', 'z0000002,Stu,Two,s2@x,123,123,', 'z0000008,Staff,Eight,s8@x,-,Staff (DO NOT REMOVE),'])
+	tu.import_user_list('C', ['z0000009'], {})  # z0000001 is reused
+
+	for user in list(tu.user_list.values()) + list(tu.user_stafflist.values()):
+		for name in User.list_fields:
+			assert isinstance(getattr(user, name), tuple), (user.id, name)
+
+	# the user passed in is left as it is
+	assert staff.groups == ['Staff (DO NOT REMOVE)']
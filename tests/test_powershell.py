@@ -0,0 +1,203 @@
+import gzip
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import PowerShellWrapper, AsyncPowerShellWrapper, ReplayPowerShellWrapper, PowerShellPool, CommandTranscript, CommandTrace
+
+
+class ScriptedWrapper (PowerShellWrapper):
+	""" answers each command with the given output lines (TOKEN is replaced by its marker), no powershell needed """
+	def __init__ (self, outputs, **kwargs):
+		super().__init__(lazy_start=True, debug=False, **kwargs)
+		self.outputs = deque(outputs)
+		self.playing = deque()
+
+	def ensure_started (self, wait=True, modules=None):
+		pass
+
+	def _send (self, command_sent, state):
+		self.playing = deque(line.replace('TOKEN', state['token'] or '') for line in self.outputs.popleft())
+
+	def _readline (self):
+		return self.playing.popleft() if len(self.playing) > 0 else None
+
+
+def test_async_wrapper_takes_options_of_regular_wrapper ():
+	transcript = CommandTranscript(dump_on_error=False)
+	wrapper    = AsyncPowerShellWrapper(debug=False, framed=True, transcript=transcript, teams_module='utilities/fake_teams/MicrosoftTeams')
+
+	assert wrapper.transcript is transcript
+	assert os.path.abspath('utilities/fake_teams/MicrosoftTeams') in wrapper._readiness_probe(['MicrosoftTeams'])
+
+
+def run_framed (lines, command='Get-Team'):
+	""" feeds output lines (with TOKEN for the marker of the command) to a framed wrapper, returns it and the output it kept """
+	wrapper             = PowerShellWrapper(lazy_start=True, debug=False, framed=True)
+	command_sent, state = wrapper._prepare_command(command)
+
+	for line in lines:
+		if (wrapper._handle_line(line.replace('TOKEN', state['token']), state)):
+			break
+	else:
+		raise AssertionError('command never ended')
+
+	return wrapper, state['output']
+
+
+def test_framed_output_is_read_between_markers ():
+	wrapper, output = run_framed([
+		'leftover of an earlier command\n',
+		"~CU0~00000000~ END True 0\n",
+		"PS /home> Write-Output 'TOKEN BEGIN'; $global:CUStatus = $false; try { . { Get-Team; ...\n",
+		'TOKEN BEGIN\n',
+		'first\n',
+		'TOKEN ERROR Get-Team: Error occurred while executing\n',
+		'second\n',
+		'TOKEN END False 1\n'
+	])
+
+	assert output == 'first\nGet-Team: Error occurred while executing\nsecond\n'
+	assert wrapper.latest_errors == ['Get-Team: Error occurred while executing']
+	assert (wrapper.latest_status, wrapper.latest_exit_code) == (False, 1)
+
+
+def test_framed_markers_may_follow_a_prompt ():
+	wrapper, output = run_framed(['PS /home> TOKEN BEGIN\n', 'only line\n', 'PS /home> TOKEN END True \n'])
+
+	assert output == 'only line\n'
+	assert (wrapper.latest_status, wrapper.latest_exit_code) == (True, None)
+
+
+def test_framed_command_gets_unique_markers ():
+	wrapper = PowerShellWrapper(lazy_start=True, debug=False, framed=True)
+	sent    = [wrapper._prepare_command('Get-Team') for i in range(3)]
+
+	assert len({state['token'] for command_sent, state in sent}) == 3
+
+	for command_sent, state in sent:
+		assert f"Write-Output '{state['token']} BEGIN'" in command_sent
+		assert f"Write-Output ('{state['token']} END '" in command_sent
+
+
+def test_output_is_split_into_lines_across_chunks ():
+	wrapper = PowerShellWrapper(lazy_start=True, debug=False)
+
+	wrapper._add_output(b'one\r\ntw')
+	wrapper._add_output(b'o\nPS /home> ')
+
+	assert list(wrapper.lines) == ['one\n', 'two\n', 'PS /home> ']
+	assert len(wrapper.buffer) == 0
+
+
+def test_readiness_probe_imports_modules_before_answering ():
+	wrapper = PowerShellWrapper(lazy_start=True, debug=False, teams_module='fake/MicrosoftTeams')
+	probe   = wrapper._readiness_probe(['MicrosoftTeams', 'Other'])
+
+	assert probe == (
+		f"Import-Module '{os.path.abspath('fake/MicrosoftTeams')}'; Import-Module Other; "
+		f"Write-Output '{wrapper.ready_token}'" + os.linesep
+	)
+
+
+def test_framed_wrapper_is_ready_at_probe_answer ():
+	wrapper = PowerShellWrapper(lazy_start=True, debug=False, framed=True)
+	wrapper._readiness_probe()
+	token   = wrapper.ready_token
+
+	assert not wrapper._handle_ready_line('PowerShell 7.4.0\n')
+	assert not wrapper._handle_ready_line(f"PS /home> Write-Output '{token}'\n")  # echoed input isn't the answer
+	assert wrapper._handle_ready_line(f'PS /home> {token}\n')
+	assert wrapper.ready_token is None
+
+
+def test_wrapper_without_framing_waits_for_prompt_after_probe_answer ():
+	wrapper = PowerShellWrapper(lazy_start=True, debug=False)
+	wrapper._readiness_probe()
+
+	assert not wrapper._handle_ready_line(f'{wrapper.ready_token}\n')
+	assert wrapper.ready_token is not None
+	assert wrapper._handle_ready_line('PS /home> ')
+	assert wrapper.ready_token is None
+
+
+def test_readiness_wait_ends_with_process ():
+	wrapper = PowerShellWrapper(lazy_start=True, debug=False, framed=True)
+	wrapper._readiness_probe()
+
+	assert wrapper._handle_ready_line(None)
+	assert wrapper.ready_token is None
+
+
+def test_trace_replays_recorded_output (tmp_path):
+	path     = str(tmp_path / 'trace.jsonl.gz')
+	login    = '$PWord = ConvertTo-SecureString -String "secret" -AsPlainText -Force'
+	outputs  = [
+		['TOKEN BEGIN\n', 'TOKEN END True 0\n'],
+		['PS /home> TOKEN BEGIN\n', 'one\n', 'two\n', 'TOKEN ERROR not found\n', 'TOKEN END False 1\n']
+	]
+
+	with CommandTrace(path) as trace:
+		recorder = ScriptedWrapper(outputs, framed=True, username='me@example.com', trace=trace)
+		recorded = [recorder.run_command(login), recorder.run_command('Get-Team')]
+
+	with gzip.open(path, 'rt', encoding='utf-8') as f:
+		text = f.read()
+
+	assert 'two' in recorded[1]
+	assert 'secret' not in text
+	assert '~CU-TOKEN~ END False 1' in text  # markers differ per run
+
+	replay = ReplayPowerShellWrapper(path, password='secret')
+
+	assert (replay.framed, replay.username) == (True, 'me@example.com')
+	assert [replay.run_command(login), replay.run_command('Get-Team')] == recorded
+	assert replay.latest_errors == ['not found']
+	assert (replay.latest_status, replay.latest_exit_code) == (False, 1)
+
+
+def test_json_records_are_decoded_per_line ():
+	wrapper = ScriptedWrapper([
+		['{"User":"z1234567","Role":"Owner"}\n', '{"User":"z7654321","Role":"Member"}\n', 'PS /home> '],
+		['Get-TeamUser: Error occurred while executing\n', 'PS /home> '],
+		['PS /home> ']
+	])
+
+	assert wrapper.run_command('Get-TeamUser', json_records=['User', 'Role']) == [
+		{'User': 'z1234567', 'Role': 'Owner'}, {'User': 'z7654321', 'Role': 'Member'}
+	]
+	assert wrapper.run_command('Get-TeamUser', json_records=['User', 'Role']) == 'Get-TeamUser: Error occurred while executing'
+	assert wrapper.run_command('Get-TeamUser', json_records=['User', 'Role']) == []
+
+
+def test_json_records_are_yielded_as_read ():
+	wrapper = ScriptedWrapper([['TOKEN BEGIN\n', '{"Id":1}\n', '{"Id":2}\n', 'TOKEN END True 0\n']], framed=True)
+	records = wrapper.iter_json_records('Get-Team', ['Id'])
+
+	assert next(records) == {'Id': 1}
+	assert len(wrapper.playing) == 2  # the rest isn't read yet
+	assert list(records) == [{'Id': 2}]
+
+
+def test_pool_keeps_commands_of_a_call_on_one_session ():
+	pool = PowerShellPool(size=3, lazy_start=True)
+	for s in pool.sessions:
+		s.run_command = lambda command, s=s: (time.sleep(0.01), f'{s.name}:{command}')[1]
+
+	def task (n):
+		first  = pool.run_command(f'first {n}')
+		second = pool.run_command(f'second {n}')
+		return first, second
+
+	results = pool.map(task, range(9))
+	pool.close()
+
+	for n, (first, second) in enumerate(results):
+		session, _, command = first.partition(':')
+		assert command == f'first {n}'  # results stay in order
+		assert second == f'{session}:second {n}'
+
+	assert len({first.partition(':')[0] for first, second in results}) > 1
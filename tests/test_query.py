@@ -0,0 +1,116 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import TeamsUpdater, User, UserIndex, Match, And, Or, Not
+
+
+def make_users ():
+	users = {}
+
+	for i in range(60):
+		project = ['Purple House', 'R2R', 'Solar Cable Car'][i % 3]
+		users[f'z{i:07d}'] = User(
+			f'z{i:07d}',
+			f'Stu {i}',
+			'C',
+			class_ids = [9000 + i % 4] + ([9100] if i % 5 == 0 else []),
+			groups    = [f'Project {project}', f'Project {project} - Team {i % 2}', f'{9000 + i % 4}'],
+			groupings = [f'Students Grouping - Project {project}', 'Students Grouping (All)'],
+			owner     = (i % 10 == 0),
+			project   = project
+		)
+
+	return users
+
+
+def scan (users, search_key, search_value):
+	""" the full scan find_users used to do, which lists a user once for every matching group or grouping """
+	results = []
+
+	for user in users.values():
+		if (isinstance(search_value, str)):
+			if (search_key.lower() == 'group'):
+				results += [user for group_name in user.groups if search_value in group_name]
+			elif (search_key.lower() == 'group_exact'):
+				results += [user for group_name in user.groups if search_value == group_name]
+			elif (search_key.lower() == 'grouping'):
+				results += [user for grouping_name in user.groupings if search_value in grouping_name]
+			elif (user[search_key].lower().find(search_value.lower()) != -1):
+				results.append(user)
+		else:
+			if (search_key.lower() == 'class id'):
+				if (search_value in user.class_ids):
+					results.append(user)
+			elif (user[search_key] == search_value):
+				results.append(user)
+
+	return results
+
+
+@pytest.fixture
+def tu (tmp_path):
+	tu = TeamsUpdater(str(tmp_path / 'course.csv'), process=object(), username='z0000000')
+	tu.user_list.update(make_users())
+	return tu
+
+
+@pytest.mark.parametrize('search_key, search_value', [
+	('group', 'Project'),
+	('group', 'Team 1'),
+	('group_exact', 'Project R2R'),
+	('group_exact', 'Project'),
+	('grouping', 'Students Grouping'),
+	('grouping', 'project'),
+	('class id', 9001),
+	('class id', 9100),
+	('project', 'purple'),
+	('name', 'STU 1'),
+	('owner', True)
+])
+def test_find_users_matches_scan_once_per_user (tu, search_key, search_value):
+	expected = list({user.id: user for user in scan(tu.user_list, search_key, search_value)}.values())
+
+	assert tu.find_users(search_key, search_value) == expected
+	assert tu.find_users(search_key, search_value, return_type='dict') == {user.id: user for user in expected}
+	assert tu.count_users(search_key, search_value) == len(expected)
+
+
+def test_find_users_lists_each_user_once (tu):
+	# every student is in two 'Project ...' groups, which the scan listed twice
+	assert len(scan(tu.user_list, 'group', 'Project')) == 2 * len(tu.user_list)
+	assert tu.find_users('group', 'Project') == list(tu.user_list.values())
+
+
+@pytest.mark.parametrize('query', [
+	Match('class id', 9001) & Match('grouping', 'R2R'),
+	Match('class id', 9001) | Match('class id', 9100),
+	~Match('group', 'Purple'),
+	Not(Match('role', 'Owner')) & Or(Match('project', 'solar'), Match('group', 'Team 0', exact=True)),
+	And(Match('role', 'Owner'), ~Match('class id', 9000)),
+	Match('group', 'Team 0', exact=True)
+])
+def test_index_matches_each_user (query):
+	users = make_users()
+
+	assert UserIndex(users).find(query) == [user for user in users.values() if query.matches(user)]
+
+
+def test_index_follows_changes_to_user_lists (tu):
+	assert [u.id for u in tu.find_users('class id', 9100)] == ['z0000000', 'z0000005', 'z0000010', 'z0000015', 'z0000020', 'z0000025', 'z0000030', 'z0000035', 'z0000040', 'z0000045', 'z0000050', 'z0000055']
+
+	# one user replaced and one removed, then another added: the number of users stays the same
+	tu.user_list['z0000000'] = User('z0000000', 'Stu 0', 'C', class_ids=[9001])
+	del tu.user_list['z0000005']
+	tu.user_list['z0000099'] = User('z0000099', 'Stu 99', 'C', class_ids=[9100])
+
+	assert [u.id for u in tu.find_users('class id', 9100)][:3] == ['z0000010', 'z0000015', 'z0000020']
+	assert tu.find_users('class id', 9100)[-1].id == 'z0000099'
+
+	tu.user_stafflist['z0000009'] = User('z0000009', 'Staff 9', 'C', groups=['Staff (DO NOT REMOVE)'])
+	assert [u.id for u in tu.find_users('group', 'Staff', tu.user_stafflist)] == ['z0000009']
+	tu.user_stafflist['z0000009'] = User('z0000009', 'Staff 9', 'C', groups=['Former staff'])
+	assert tu.find_users('group', 'Staff (', tu.user_stafflist) == []
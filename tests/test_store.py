@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import SQLiteUserStore, TeamsUpdater, User, UserIndex, Match, Not
+
+from test_query import make_users
+
+
+QUERIES = [
+	Match('group', 'Project'),
+	Match('group', 'project'),
+	Match('group', 'Project R2R', exact=True),
+	Match('group', 'Project R2R - Team 1', exact=True),
+	Match('grouping', 'Students Grouping (All)', exact=True),
+	Match('grouping', 'Solar'),
+	Match('class id', 9100),
+	Match('class id', '910'),
+	Match('project', 'PURPLE'),
+	Match('project', 'R2R', exact=True),
+	Match('name', 'stu 1'),
+	Match('role', 'Owner'),
+	Match('role', 'member'),
+	Match('role', 'er'),
+	Not(Match('role', 'Owner')),
+	~Match('group', 'Team 0') & Match('class id', 9001),
+	Match('class id', 9000) | ~Match('grouping', 'Purple'),
+	Not(Match('group', 'Staff'))
+]
+
+
+@pytest.fixture
+def users ():
+	users = make_users()
+	users['z0000099'] = User('z0000099', 'No Groups', 'C', class_ids=[9003])
+	return users
+
+
+@pytest.mark.parametrize('query', QUERIES, ids=repr)
+def test_store_matches_index (users, query):
+	store = SQLiteUserStore()
+	store.add_users('C', users)
+	store.add_users('D', {'z0000001': User('z0000001', 'Other course', 'D', [9100], ['Project R2R'])})
+
+	assert store.find('C', query) == [user.id for user in UserIndex(users).find(query)]
+
+
+def test_store_rejects_what_it_cannot_query (users):
+	store = SQLiteUserStore()
+	store.add_users('C', users)
+
+	with pytest.raises(ValueError):
+		store.find('C', Match('classes', 'TUT'))
+
+
+def test_find_users_via_store_matches_index (tmp_path, users):
+	tu = TeamsUpdater(str(tmp_path / 'course.csv'), process=object(), username='z0000000', store=SQLiteUserStore())
+	tu.user_list.update(users)
+	tu.store.add_users('C', tu.user_list)
+	tu.store_course = 'C'
+
+	for query in QUERIES:
+		assert tu._find_in_store(query, tu.user_list) == tu._user_index(tu.user_list).find(query)
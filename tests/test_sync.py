@@ -0,0 +1,100 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from course_updater import SyncDependencies, SyncPlan, EnrolmentChangeset, Match, TeamsUpdater, ImportFingerprints, User
+
+
+def make_dependencies ():
+	dependencies = SyncDependencies()
+	dependencies.add(('staff',), ('team', None, 'Owner'))
+	dependencies.add(('query', Match('class id', 123)), ('team', 'TUT_123', 'Member'))
+	dependencies.add(('query', Match('class id', 456)), ('team', 'TUT_456', 'Member'))
+	return dependencies
+
+
+def test_student_losing_class_ids_affects_class_channel ():
+	""" a student whose Class ID turns to '-' counts as staff in the changeset, yet leaves their class """
+	changeset = EnrolmentChangeset(
+		changed       = ['z0000001'],
+		group_changes = {'z0000001': ([], ['123'])},
+		class_changes = {'z0000001': ([], [123])},
+		staff         = {'z0000001'}
+	)
+
+	assert ('team', 'TUT_123', 'Member') in make_dependencies().affected(changeset)
+	assert ('team', 'TUT_456', 'Member') not in make_dependencies().affected(changeset)
+
+
+def test_staff_group_changes_dont_affect_class_channels ():
+	changeset = EnrolmentChangeset(changed=['z0000009'], group_changes={'z0000009': (['123'], [])}, staff={'z0000009'})
+
+	assert make_dependencies().affected(changeset) == {('team', None, 'Owner')}
+
+
+def test_context_change_affects_all_targets ():
+	changeset = EnrolmentChangeset(context_changed=True)
+
+	assert changeset
+	assert make_dependencies().affected(changeset) == make_dependencies().targets()
+
+
+def plan_stream (tu, stream_data, channels, changeset):
+	""" plans a sync of one stream, against a team with the given channels and no members yet """
+	tu.connected             = True
+	tu.get_team              = lambda team_id, get_channels=False: {'DisplayName': 'A', 'Description': 'Teaching Team for A', 'channels': channels}
+	tu.get_team_user_list    = lambda *args: {}
+	tu.get_channel_user_list = lambda *args: {}
+
+	return tu.plan_course_update({'A': stream_data}, team_name_format='{stream}', changeset=changeset)
+
+
+def test_plan_with_changeset_follows_stream_config_and_new_channels (tmp_path):
+	tu = TeamsUpdater(str(tmp_path / 'course.csv'), process=object(), username='z0000000', fingerprints=ImportFingerprints())
+	tu.user_list['z0000001'] = User('z0000001', 'Stu One', 'C', [123], ['123'])
+
+	stream_data = {
+		'team_id'      : 'T',
+		'coordinators' : ['z0000009'],
+		'other_owners' : [],
+		'main_class_id': 123,
+		'classes'      : [{'name': 'TUT', 'class_id': 123, 'channel': 'private', 'description': 'd', 'instructors': []}],
+		'channels'     : []
+	}
+	unchanged = EnrolmentChangeset()
+
+	# the first sync plans everything, including members of the class channel that is yet to be created
+	plan = plan_stream(tu, stream_data, {}, unchanged)
+	assert [c['channel_name'] for c in plan.channel_creates] == ['TUT_123']
+	assert {(m['channel_name'], m['user']['id']) for m in plan.memberships} >= {(None, 'z0000009'), ('TUT_123', 'z0000001')}
+	tu.fingerprints.confirm()
+
+	# once synced, nothing changed means no memberships to plan, but channels are still checked
+	channels = {'TUT_123': {'MembershipType': 'Private', 'Description': 'd'}}
+	assert plan_stream(tu, stream_data, channels, unchanged).memberships == []
+	assert [c['channel_name'] for c in plan_stream(tu, stream_data, {}, unchanged).channel_creates] == ['TUT_123']
+
+	# a new coordinator in the stream config is planned, without any enrolment changes
+	stream_data['coordinators'].append('z0000008')
+	plan = plan_stream(tu, stream_data, channels, unchanged)
+	assert (None, 'z0000008') in {(m['channel_name'], m['user']['id']) for m in plan.memberships}
+
+
+def test_plan_survives_json_round_trip ():
+	plan = SyncPlan(channel_creates=[{'team_id': 'T', 'channel_name': 'TUT_123', 'channel_type': 'Private', 'description': ''}], warnings=['no owners'])
+	add  = {'action': 'add', 'team_id': 'T', 'channel_name': 'TUT_123', 'user': User('z0000001', 'Stu One'), 'role': 'Member'}
+
+	plan.add_membership(add)
+	plan.add_membership(dict(add))  # the same operation is only planned once
+	assert plan.memberships == [dict(add, user={'id': 'z0000001', 'name': 'Stu One', 'email': User('z0000001', 'Stu One').email})]
+
+	loaded = SyncPlan.from_json(plan.to_json())
+
+	assert loaded == plan
+	assert loaded.summary() == plan.summary()
+
+	# a loaded plan still knows what it holds
+	loaded.add_membership(add)
+	loaded.add_membership(dict(add, role='Owner'))
+	assert len(loaded.memberships) == 2
@@ -0,0 +1,77 @@
+"""
+Times a full team and channel sync against the fake MicrosoftTeams module (see fake_teams), so no tenant is needed.
+Half of the desired users are in the team already, and a quarter of the team members are to be removed.
+
+Usage: python3 benchmark_fake_teams.py [number of users] [batch size] [latency in ms] [error rate] [throttle rate]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+sys.path.append('..')
+
+from course_updater import User, Logger, PowerShellWrapper, TeamsUpdater
+
+if __name__ == '__main__':
+	args          = sys.argv[1:] + [None] * 5
+	user_count    = int(args[0] or 500)
+	batch_size    = int(args[1] or 0)
+	latency_ms    = int(args[2] or 0)
+	error_rate    = float(args[3] or 0)
+	throttle_rate = float(args[4] or 0)
+
+	team_id = '00000000-0000-0000-0000-00000000beef'
+	owner   = 'z0000000@ad.unsw.edu.au'
+
+	desired  = [User(f'z{n:07d}', f'Student {n}') for n in range(1, user_count + 1)]
+	existing = [f'z{n:07d}@ad.unsw.edu.au' for n in range(user_count // 2, user_count + user_count // 4)]
+
+	# the team to start with, for the fake module to load on import
+	state = {
+		'names': {f'{u.id}@ad.unsw.edu.au': u.name for u in desired},
+		'teams': {
+			team_id: {
+				'DisplayName': 'Benchmark course',
+				'Description': '',
+				'Visibility' : 'Private',
+				'Users'      : dict([(owner, 'Owner')] + [(u, 'Member') for u in existing]),
+				'Channels'   : {'Class 1': {'MembershipType': 'Private', 'Users': {owner: 'Owner'}}}
+			}
+		}
+	}
+
+	with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+		json.dump(state, f)
+
+	os.environ['CU_FAKE_TEAMS_STATE']         = f.name
+	os.environ['CU_FAKE_TEAMS_LATENCY_MS']    = str(latency_ms)
+	os.environ['CU_FAKE_TEAMS_ERROR_RATE']    = str(error_rate)
+	os.environ['CU_FAKE_TEAMS_THROTTLE_RATE'] = str(throttle_rate)
+
+	module_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_teams', 'MicrosoftTeams')
+
+	process = PowerShellWrapper(debug=False, framed=True, login_method='credentials', username=owner, password='fake', teams_module=module_path)
+
+	with TeamsUpdater(process=process, username=owner, logger=Logger(), batch_size=batch_size) as tu:
+		start = time.time()
+		tu.ensure_connected()
+		connected = time.time()
+
+		tu.update_team(team_id, desired)
+		team_done = time.time()
+
+		tu.update_channel(team_id, 'Class 1', desired[:user_count // 10])
+		channel_done = time.time()
+
+		stats = process.run_command('Get-FakeTeamsStats', convert_json=True)
+
+	process.close()
+	os.remove(f.name)
+
+	print(f'\n{user_count} users, batch size {batch_size}, latency {latency_ms} ms, error rate {error_rate}, throttle rate {throttle_rate}')
+	print(f'  connect : {connected - start:.2f}s')
+	print(f'  team    : {team_done - connected:.2f}s')
+	print(f'  channel : {channel_done - team_done:.2f}s')
+	print(f'  fake module stats: {stats}')
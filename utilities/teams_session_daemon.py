@@ -0,0 +1,26 @@
+"""
+Keeps a PowerShell session logged in to Teams, so later runs of course scripts can skip the login.
+Pass `session_socket=PowerShellDaemon.default_socket_path` to TeamsUpdater to make use of it.
+
+Usage: python3 teams_session_daemon.py [socket path]
+Stop it with ctrl+c. If a daemon is already running at the socket path, this exits right away.
+"""
+
+import sys
+sys.path.append('..')
+
+from course_updater import LoginData, PowerShellDaemon
+
+if __name__ == '__main__':
+	socket_path = sys.argv[1] if len(sys.argv) > 1 else None
+
+	login = LoginData()
+
+	with PowerShellDaemon(socket_path, username=login.username, password=login.password) as daemon:
+		print(f'Serving Teams session at {daemon.socket_path}')
+		try:
+			daemon.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		except RuntimeError as e:
+			sys.exit(str(e))